@@ -188,13 +188,16 @@ class Gateway(object):
         '''
         state_changed = False
         remote_connections = {}
+        hub_remote_gateways = {}  # hub uri : (hub, remote gateways), to retrieve them a hub at a time
         for remote_gateway in remote_gateway_hub_index.keys() + self.pulled_interface.list_remote_gateway_names():
             remote_connections[remote_gateway] = {}
-            try:
-                for hub in remote_gateway_hub_index[remote_gateway]:
-                    remote_connections[remote_gateway].update(hub.get_remote_connection_state(remote_gateway))
-            except KeyError:
-                pass  # remote gateway no longer exists on the hub network
+            # an empty list if the remote gateway no longer exists on the hub network
+            for hub in remote_gateway_hub_index.get(remote_gateway, []):
+                hub_remote_gateways.setdefault(hub.uri, (hub, []))[1].append(remote_gateway)
+        for hub, remote_gateways in hub_remote_gateways.values():
+            remote_connection_states = hub.get_remote_connection_states(remote_gateways)
+            for remote_gateway in remote_gateways:
+                remote_connections[remote_gateway].update(remote_connection_states[remote_gateway])
         new_pulls, lost_pulls = self.pulled_interface.update(remote_connections, self._unique_name)
         for connection_type in utils.connection_types:
             for pull in new_pulls[connection_type]:
@@ -255,17 +258,24 @@ class Gateway(object):
             local_connection_index, self.master.generate_advertisement_connection_details)
         # public_interface is of type gateway_msgs.Rule[]
         public_interface = self.public_interface.getInterface()
+        added = []
+        removed = []
         for connection_type in utils.connection_types:
             for new_connection in new_conns[connection_type]:
                 rospy.loginfo("Gateway : adding connection to public interface %s" %
                               utils.format_rule(new_connection.rule))
-                self.hub_manager.advertise(new_connection)
+                added.append(new_connection)
                 state_changed = True
             for lost_connection in lost_conns[connection_type]:
                 rospy.loginfo("Gateway : removing connection from public interface %s" %
                               utils.format_rule(lost_connection.rule))
-                self.hub_manager.unadvertise(lost_connection)
+                removed.append(lost_connection)
                 state_changed = True
+        if added or removed:
+            # all of this tick's changes in one go
+            for hub, connection, error in self.hub_manager.update_advertisements(added, removed):
+                rospy.logwarn("Gateway : failed to update the public interface on the hub %s [%s][%s]" %
+                              (utils.format_rule(connection.rule), hub.name, str(error)))
         if state_changed:
             self._publish_gateway_info()
         return public_interface
@@ -365,6 +375,14 @@ class Gateway(object):
         '''
         self.watcher_thread.trigger_update = True
 
+    def hub_change_notification(self):
+        '''
+          Called by the hub change listener threads when another gateway has
+          changed something we need to act on (e.g. sent us a flip request).
+          Triggers a watcher loop update.
+        '''
+        self.watcher_thread.trigger_update = True
+
     def ros_service_advertise(self, request):
         '''
           Puts/Removes a number of rules on the public interface watchlist.
@@ -10,6 +10,8 @@
 import threading
 import rospy
 import re
+import collections
+import math
 import utils
 from gateway_msgs.msg import RemoteRuleWithStatus as FlipStatus
 import gateway_msgs.msg as gateway_msgs
@@ -24,6 +26,148 @@ from rocon_hub_client.exceptions import HubConnectionLostError, \
     HubNameNotFoundError, HubNotFoundError
 
 from .exceptions import GatewayUnavailableError
+from . import key_store
+
+###############################################################################
+# Constants
+###############################################################################
+
+# Scalar fields each gateway posts about itself on the hub
+# (rocon:<gateway>:<field>), as used to build gateway_msgs.RemoteGateway.
+gateway_info_fields = ['firewall',
+                       'ip',
+                       'available',
+                       'time_since_last_seen',
+                       'latency:min',
+                       'latency:avg',
+                       'latency:max',
+                       'latency:mdev',
+                       'network:info_available',
+                       'network:type',
+                       'wireless:bitrate',
+                       'wireless:quality',
+                       'wireless:signal_level',
+                       'wireless:noise_level'
+                       ]
+
+# Keys each gateway owns on the hub (rocon:<gateway>:<key>) when the hub is
+# using the gateway info hash schema. Used to clean up without a key search.
+gateway_keys = ['info',
+                'advertisements',
+                'advertisements:version',
+                'flips',
+                'pulls',
+                'flip_ins',
+                'flip_events',
+                'public_key',
+                ':ping',
+                ':alive'  # the hub watcher's, when it is tracking liveness with expiry events
+                ]
+
+# Keys each gateway owns on the hub when the hub is using the legacy schema,
+# i.e. with a key per information field.
+legacy_gateway_keys = ([key for key in gateway_keys if key != 'info'] +
+                       gateway_info_fields +
+                       ['encryption'])
+
+# Network statistics are only written when they change, but all of them are
+# rewritten this often (seconds) in case the hub has lost them.
+NETWORK_STATISTICS_REWRITE_PERIOD = 60.0
+
+# How long data cached on the strength of the hub's change notifications
+# is trusted before it is refetched anyway (seconds).
+CHANGE_NOTIFICATION_FALLBACK_PERIOD = 60.0
+
+# How long the directory of gateways on the hub (see _get_gateway_directory)
+# is reused when change notifications can't be relied on to invalidate it
+# (seconds). Short enough to be refreshed every watcher tick, long enough
+# to be shared by all the lookups made during the tick.
+GATEWAY_DIRECTORY_TTL = 1.0
+
+# Flip events are only a doorbell, the flip_ins sets are the source of truth,
+# so the event lists are kept short and left to expire if nobody reads them.
+FLIP_EVENTS_MAX_LENGTH = 100
+FLIP_EVENTS_TTL = 60  # seconds
+FLIP_EVENTS_POLL_TIMEOUT = 1  # seconds, how often the reader checks if it should stop
+
+# Flip request transitions on a gateway's flip_ins hash (hub schema version
+# SCHEMA_KEYED_FLIP_INS and up), run atomically on the hub (redis 2.6 and up)
+# along with the change notification and flip event that go with them - see
+# GatewayHub._run_flip_script.
+#
+#   KEYS : flip_ins hash, flip event list of the gateway to let know
+#   ARGV : change channel, change notification, flip events max length,
+#          flip events ttl, script specific arguments
+_flip_script_notify = '''
+local function notify()
+    redis.call('PUBLISH', ARGV[1], ARGV[2])
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    redis.call('LTRIM', KEYS[2], -tonumber(ARGV[3]), -1)
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+'''
+flip_scripts = {
+    # set the field (a new request), ARGV[5] field, ARGV[6] value
+    'set': _flip_script_notify + '''
+redis.call('HSET', KEYS[1], ARGV[5], ARGV[6])
+notify()
+return 1
+''',
+    # set the field only if it still has the expected value (accept, block),
+    # ARGV[5] field, ARGV[6] expected value, ARGV[7] new value
+    'compare_and_set': _flip_script_notify + '''
+if redis.call('HGET', KEYS[1], ARGV[5]) ~= ARGV[6] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[5], ARGV[7])
+notify()
+return 1
+''',
+    # delete fields (unflips), ARGV[5..] fields, returns the number deleted
+    'delete': _flip_script_notify + '''
+local deleted = redis.call('HDEL', KEYS[1], unpack(ARGV, 5))
+if deleted > 0 then
+    notify()
+end
+return deleted
+'''
+}
+
+# Maximum number of decrypted flip request connections, and of unwrapped
+# session keys, kept around (see GatewayHub._decrypt_flip_in_connection).
+DECRYPTION_CACHE_SIZE = 1000
+
+# Value of the 'encryption' gateway field for gateways that can decrypt
+# hybrid (session key) encrypted flip requests, see utils.hybrid_encrypt.
+# Gateways that don't post it only understand raw RSA encryption.
+HYBRID_ENCRYPTION = 'hybrid'
+
+# Backoff (seconds) while waiting for a remote gateway's public key to appear
+# in send_flip_request, in case the registration notification is missed.
+PUBLIC_KEY_WAIT_MIN_PERIOD = 0.01
+PUBLIC_KEY_WAIT_MAX_PERIOD = 1.0
+
+# Number of hub health check round trip times kept for the latency statistics.
+HEALTH_CHECK_LATENCY_SAMPLES = 20
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def latency_fields(latency_stats):
+    '''
+      Convert latency statistics into gateway information fields.
+
+      @param latency_stats : ping statistics to the gateway from the hub
+      @type list : 4-tuple of float values [min, avg, max, mean deviation]
+      @return values keyed by their name in gateway_info_fields
+      @rtype dict
+    '''
+    return {'latency:min': latency_stats[0],
+            'latency:avg': latency_stats[1],
+            'latency:max': latency_stats[2],
+            'latency:mdev': latency_stats[3]}
 
 ###############################################################################
 # Redis Connection Checker
@@ -36,7 +180,7 @@ class HubConnectionCheckerThread(threading.Thread):
       Pings redis periodically to figure out if redis is still alive.
     '''
 
-    def __init__(self, ip, port, hub_connection_lost_hook):
+    def __init__(self, ip, port, hub_connection_lost_hook, connection_class=hub_client.HubConnection):
         threading.Thread.__init__(self)
         self.daemon = True  # clean shut down of thread when hub connection is lost
         self.ping_frequency = 0.2  # Too spammy? # TODO Need to parametrize
@@ -44,21 +188,118 @@ class HubConnectionCheckerThread(threading.Thread):
         self.ip = ip
         self.port = port
         self.pinger = rocon_python_utils.network.Pinger(self.ip, self.ping_frequency)
+        self._health_check = hub_client.HubHealthCheck(self.ip, self.port, connection_class)
+        self._round_trip_times = collections.deque(maxlen=HEALTH_CHECK_LATENCY_SAMPLES)  # seconds
 
     def get_latency(self):
-        return self.pinger.get_latency()
+        '''
+          Latency statistics for the hub. These come from the icmp pinger, or if
+          it has nothing to show (e.g. icmp is blocked), from the round trip times
+          of the health checks.
+
+          @return [min, avg, max, mean deviation] in milliseconds
+          @rtype list of float
+        '''
+        latency = self.pinger.get_latency()
+        if latency and any(latency):
+            return latency
+        round_trip_times = [1000.0 * round_trip_time for round_trip_time in list(self._round_trip_times)]
+        if not round_trip_times:
+            return [0.0, 0.0, 0.0, 0.0]
+        avg = sum(round_trip_times) / len(round_trip_times)
+        mdev = math.sqrt(max(0.0, sum(t * t for t in round_trip_times) / len(round_trip_times) - avg * avg))
+        return [min(round_trip_times), avg, max(round_trip_times), mdev]
 
     def run(self):
         # This runs in the background to gather the latest connection statistics
         # Note - it's not used in the keep alive check
         self.pinger.start()
         rate = rocon_python_comms.WallRate(self.ping_frequency)
-        alive = True
-        while alive:
-            alive = hub_client.ping_hub(self.ip, self.port)
+        while True:
+            # liveness is whether the hub answers (within the socket timeout) at all,
+            # a slow answer only shows up in the latency
+            round_trip_time = self._health_check.check()
+            if round_trip_time is None:
+                break
+            self._round_trip_times.append(round_trip_time)
             rate.sleep()
+        self._health_check.close()
         self._hub_connection_lost_hook()
 
+###############################################################################
+# Change Listener
+###############################################################################
+
+
+class HubChangeListenerThread(threading.Thread):
+
+    '''
+      Listens on the hub's change notification channel and relays every
+      notification to the gateway hub. The pubsub connection must already
+      be subscribed before the thread is started.
+    '''
+
+    def __init__(self, pubsub, change_notification_hook):
+        threading.Thread.__init__(self)
+        self.daemon = True  # clean shut down of thread when hub connection is lost
+        self._pubsub = pubsub
+        self._change_notification_hook = change_notification_hook
+
+    def shutdown(self):
+        '''
+          Unsubscribe, which ends the listen loop, and release the pubsub
+          connection. Disconnecting also ends the loop if the hub has stopped
+          responding.
+        '''
+        try:
+            self._pubsub.unsubscribe()
+            self.join(1.0)
+        except (redis.exceptions.ConnectionError, AttributeError):
+            pass
+        self._pubsub.reset()
+
+    def run(self):
+        try:
+            for message in self._pubsub.listen():
+                if message['type'] == 'message':
+                    self._change_notification_hook(message['data'])
+        except (redis.exceptions.ConnectionError, AttributeError, ValueError):
+            # hub connection has gone down or has been disconnected by us, the
+            # connection checker thread takes care of disengaging the hub.
+            pass
+
+
+class FlipEventListenerThread(threading.Thread):
+
+    '''
+      Blocks on this gateway's flip event list (rocon:<gateway>:flip_events)
+      so that flip requests, their acceptance/blocking and unflips are acted
+      on as soon as they are posted rather than on the next watcher poll.
+      BLPOP holds a connection from the pool for itself while it waits.
+    '''
+
+    def __init__(self, redis_server, key, flip_event_hook):
+        threading.Thread.__init__(self)
+        self.daemon = True  # clean shut down of thread when hub connection is lost
+        self._redis_server = redis_server
+        self._key = key
+        self._flip_event_hook = flip_event_hook
+        self._trigger_shutdown = False
+
+    def shutdown(self):
+        self._trigger_shutdown = True
+
+    def run(self):
+        try:
+            while not self._trigger_shutdown:
+                result = self._redis_server.blpop(self._key, FLIP_EVENTS_POLL_TIMEOUT)
+                if result is not None and not self._trigger_shutdown:
+                    unused_key, flip_event = result
+                    self._flip_event_hook(flip_event)
+        except (redis.exceptions.ConnectionError, AttributeError, ValueError):
+            # hub connection has gone down or has been disconnected by us
+            pass
+
 ##############################################################################
 # Hub
 ##############################################################################
@@ -66,7 +307,7 @@ class HubConnectionCheckerThread(threading.Thread):
 
 class GatewayHub(rocon_hub_client.Hub):
 
-    def __init__(self, ip, port, whitelist, blacklist):
+    def __init__(self, ip, port, whitelist, blacklist, connection_class=redis.Connection, engine=None):
         '''
           @param remote_gateway_request_callbacks : to handle redis responses
           @type list of function pointers (back to GatewaySync class
@@ -74,26 +315,71 @@ class GatewayHub(rocon_hub_client.Hub):
           @param ip : redis server ip
           @param port : redis server port
 
+          @param connection_class : redis connection class, e.g. rocon_hub_client.fake_hub.FakeHubConnection
+          @type redis.Connection subclass
+          @param engine : if given, the reads made every watcher loop go through it
+          @type rocon_hub_client.HubEngine
+
           @raise HubNameNotFoundError, HubNotFoundError
         '''
         try:
-            super(GatewayHub, self).__init__(ip, port, whitelist, blacklist)  # can just do super() in python3
+            super(GatewayHub, self).__init__(ip, port, whitelist, blacklist, connection_class, engine)  # can just do super() in python3
         except HubNotFoundError:
             raise
         except HubNameNotFoundError:
             raise
         self._hub_connection_lost_gateway_hook = None
         self._firewall = 0
+        # write the compact wire format (and refuse pickles) once every gateway on the hub understands it
+        self._compact = self.schema_version >= hub_api.SCHEMA_COMPACT_WIRE_FORMAT
+        # gateway information fields last published to the hub (see publish_network_statistics)
+        self._published_fields = {}
+        self._published_fields_time = 0.0  # when all of them were last written
+        # change notifications (see _process_change_notification)
+        self._hub_change_notification_hook = None
+        self._change_listener_thread = None
+        self._flip_event_listener_thread = None
+        # guards the change counts and every cache invalidated by them (down to the public keys below) -
+        # they are filled on the hub's worker, but invalidated on the change and flip event listener threads
+        self._change_lock = threading.Lock()
+        self._change_counts = {}  # 'gateway:kind' : number of change notifications
+        # 'gateway:kind' (or ('gateway:kind', entry)) : (change count, timestamp, cached value)
+        self._change_cache = {}
+        self._change_cache_swept = time.time()  # when stale entries were last dropped from the above
+        self._registration_changes = 0  # number of (un)registrations noticed
+        # (registration changes, timestamp, {gateway name : firewall flag, None until retrieved})
+        self._gateway_directory = None
+        self._flip_targets = set()  # remote gateways we have sent flip requests to
+        # advertisements versioned by their owners (see get_remote_connection_states)
+        self._versioned_advertisements = self.schema_version >= hub_api.SCHEMA_ADVERTISEMENT_VERSIONS
+        # remote gateway : (advertisements version, change count, timestamp, connections)
+        self._advertisement_snapshots = {}
+        self._public_keys = {}  # remote gateway : (serialized public key, public key)
+        # (encrypted type_info, encrypted xmlrpc_uri) : (type_info, xmlrpc_uri), least recently used first
+        self._decrypted_connections = collections.OrderedDict()
+        self._flip_ins_seen = {}  # flip_ins field : value, as last retrieved (see _update_flip_request_status)
+        # hybrid encryption session keys
+        self._session_keys = {}  # (remote gateway, serialized public key) : (session key, wrapped session key)
+        self._received_session_keys = collections.OrderedDict()  # wrapped : session key, least recently used first
+        # guards the four above - flip requests are retrieved on the hub's worker, but
+        # accepted or blocked on the gateway's watcher thread
+        self._flip_ins_lock = threading.Lock()
+        # hub side flip scripts (see _run_flip_script)
+        self._flip_scripting = self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS
+        self._flip_script_digests = {}  # script name : sha1 digest
+        self._registration_condition = threading.Condition()  # notified when a gateway registers
 
         # Setting up some basic parameters in-case we use this API without registering a gateway
         self._redis_keys['gatewaylist'] = hub_api.create_rocon_hub_key('gatewaylist')
+        self._redis_channels['changes'] = hub_api.create_rocon_hub_key('changes')
         self._unique_gateway_name = ''
 
     ##########################################################################
     # Hub Connections
     ##########################################################################
 
-    def register_gateway(self, firewall, unique_gateway_name, hub_connection_lost_gateway_hook, gateway_ip):
+    def register_gateway(self, firewall, unique_gateway_name, hub_connection_lost_gateway_hook, gateway_ip,
+                         hub_change_notification_hook=None):
         '''
           Register a gateway with the hub.
 
@@ -102,6 +388,8 @@ class GatewayHub(rocon_hub_client.Hub):
           @param hub_connection_lost_gateway_hook : used to trigger Gateway.disengage_hub(hub)
                  on lost hub connections in redis pubsub listener thread.
           @gateway_ip
+          @param hub_change_notification_hook : called (from the change listener thread) when
+                 another gateway has changed something this gateway should act on.
 
           @raise HubConnectionLostError if for some reason, the redis server has become unavailable.
         '''
@@ -109,34 +397,59 @@ class GatewayHub(rocon_hub_client.Hub):
             raise HubConnectionLostError()
         self._unique_gateway_name = unique_gateway_name
         self._redis_keys['gateway'] = hub_api.create_rocon_key(unique_gateway_name)
-        self._redis_keys['firewall'] = hub_api.create_rocon_gateway_key(unique_gateway_name, 'firewall')
         self._firewall = 1 if firewall else 0
+        self._published_fields = {}
+        self._published_fields_time = 0.0
         self._hub_connection_lost_gateway_hook = hub_connection_lost_gateway_hook
         if not self._redis_server.sadd(self._redis_keys['gatewaylist'], self._redis_keys['gateway']):
             # should never get here - unique should be unique
             pass
         self.mark_named_gateway_available(self._redis_keys['gateway'])
-        self._redis_server.set(self._redis_keys['firewall'], self._firewall)
-        # I think we just used this for debugging, but we might want to hide it in
+        # The ip - I think we just used this for debugging, but we might want to hide it in
         # future (it's the ros master hostname/ip)
-        self._redis_keys['ip'] = hub_api.create_rocon_gateway_key(unique_gateway_name, 'ip')
-        self._redis_server.set(self._redis_keys['ip'], gateway_ip)
+        self._set_gateway_fields(self._redis_server, unique_gateway_name,
+                                 {'firewall': self._firewall, 'ip': gateway_ip, 'encryption': HYBRID_ENCRYPTION})
 
-        self.private_key, public_key = utils.generate_private_public_key()
+        # shared by all hub connections, only generated once per process
+        self.private_key, public_key = key_store.get_private_public_key()
         self._redis_keys['public_key'] = hub_api.create_rocon_gateway_key(unique_gateway_name, 'public_key')
         self._redis_server.set(self._redis_keys['public_key'], utils.serialize_key(public_key))
 
         # Mark this gateway as now available
         self._redis_server.sadd(self._redis_keys['gatewaylist'], self._redis_keys['gateway'])
         self.hub_connection_checker_thread = HubConnectionCheckerThread(
-            self.ip, self.port, self._hub_connection_lost_hook)
+            self.ip, self.port, self._hub_connection_lost_hook, self.connection_class)
         self.hub_connection_checker_thread.start()
         self.connection_lost_lock = threading.Lock()
 
+        # Listen for changes posted by other gateways
+        self._hub_change_notification_hook = hub_change_notification_hook
+        self._redis_pubsub_server.subscribe(self._redis_channels['changes'])
+        self._change_listener_thread = HubChangeListenerThread(self._redis_pubsub_server,
+                                                               self._process_change_notification)
+        self._change_listener_thread.start()
+        # Anything left in the flip event list is from a previous registration, we
+        # resync from the flip_ins set anyway.
+        self._redis_keys['flip_events'] = hub_api.create_rocon_gateway_key(unique_gateway_name, 'flip_events')
+        self._redis_server.delete(self._redis_keys['flip_events'])
+        self._flip_event_listener_thread = FlipEventListenerThread(self._redis_server,
+                                                                   self._redis_keys['flip_events'],
+                                                                   self._process_change_notification)
+        self._flip_event_listener_thread.start()
+
         # Let hub know we are alive
         ping_key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, ':ping')
-        self._redis_server.set(ping_key, True)
-        self._redis_server.expire(ping_key, gateway_msgs.ConnectionStatistics.MAX_TTL)
+        pipe = self._redis_server.pipeline()
+        pipe.set(ping_key, True)
+        pipe.expire(ping_key, gateway_msgs.ConnectionStatistics.MAX_TTL)
+        if self._versioned_advertisements:
+            # start every registration from a new version, so snapshots of a previous
+            # incarnation of this gateway never look current
+            pipe.set(hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements:version'),
+                     int(time.time() * 1000))
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'registered')
+        pipe.execute()
+        self._note_change(change_notification)
 
     def _hub_connection_lost_hook(self):
         '''
@@ -158,6 +471,11 @@ class GatewayHub(rocon_hub_client.Hub):
           @return: success or failure of the operation
           @rtype: bool
         '''
+        if self._flip_event_listener_thread is not None:
+            self._flip_event_listener_thread.shutdown()
+        self._hub_change_notification_hook = None
+        if self._change_listener_thread is not None:
+            self._change_listener_thread.shutdown()
         try:
             self.unregister_named_gateway(self._redis_keys['gateway'])
         except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
@@ -171,39 +489,45 @@ class GatewayHub(rocon_hub_client.Hub):
 
     def publish_network_statistics(self, statistics):
         '''
-          Publish network interface information to the hub
+          Publish network interface information to the hub. Everything is sent
+          in a single pipelined transaction and only the values that have
+          changed since the last publish are written, except once every
+          NETWORK_STATISTICS_REWRITE_PERIOD when they are all rewritten.
 
           @param statistics
           @type gateway_msgs.RemoteGateway
         '''
-        try:
-            network_info_available = hub_api.create_rocon_gateway_key(
-                self._unique_gateway_name, 'network:info_available')
-            self._redis_server.set(network_info_available, statistics.network_info_available)
-            if not statistics.network_info_available:
-                return
-            network_type = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'network:type')
-            self._redis_server.set(network_type, statistics.network_type)
-            # Let hub know that we are alive - even for wired connections. Perhaps something can
-            # go wrong for them too, though no idea what. Anyway, writing one entry is low cost
-            # and it makes the logic easier on the hub side.
-            ping_key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, ':ping')
-            self._redis_server.set(ping_key, True)
-            self._redis_server.expire(ping_key, gateway_msgs.ConnectionStatistics.MAX_TTL)
-            # Update latency statistics
-            latency = self.hub_connection_checker_thread.get_latency()
-            self.update_named_gateway_latency_stats(self._unique_gateway_name, latency)
+        fields = {'network:info_available': statistics.network_info_available}
+        if statistics.network_info_available:
+            fields['network:type'] = statistics.network_type
+            fields.update(latency_fields(self.hub_connection_checker_thread.get_latency()))
             # If wired, don't worry about wireless statistics.
-            if statistics.network_type == gateway_msgs.RemoteGateway.WIRED:
-                return
-            wireless_bitrate_key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'wireless:bitrate')
-            self._redis_server.set(wireless_bitrate_key, statistics.wireless_bitrate)
-            wireless_link_quality = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'wireless:quality')
-            self._redis_server.set(wireless_link_quality, statistics.wireless_link_quality)
-            wireless_signal_level = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'wireless:signal_level')
-            self._redis_server.set(wireless_signal_level, statistics.wireless_signal_level)
-            wireless_noise_level = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'wireless:noise_level')
-            self._redis_server.set(wireless_noise_level, statistics.wireless_noise_level)
+            if statistics.network_type != gateway_msgs.RemoteGateway.WIRED:
+                fields['wireless:bitrate'] = statistics.wireless_bitrate
+                fields['wireless:quality'] = statistics.wireless_link_quality
+                fields['wireless:signal_level'] = statistics.wireless_signal_level
+                fields['wireless:noise_level'] = statistics.wireless_noise_level
+        rewrite = time.time() - self._published_fields_time >= NETWORK_STATISTICS_REWRITE_PERIOD
+        changed_fields = dict((field, value) for field, value in fields.iteritems()
+                              if rewrite or self._published_fields.get(field, None) != value)
+        if not changed_fields and not statistics.network_info_available:
+            return
+        try:
+            pipe = self._redis_server.pipeline()
+            if changed_fields:
+                self._set_gateway_fields(pipe, self._unique_gateway_name, changed_fields)
+            if statistics.network_info_available:
+                # Let hub know that we are alive - even for wired connections. Perhaps something can
+                # go wrong for them too, though no idea what. Anyway, writing one entry is low cost
+                # and it makes the logic easier on the hub side.
+                ping_key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, ':ping')
+                pipe.set(ping_key, True)
+                pipe.expire(ping_key, gateway_msgs.ConnectionStatistics.MAX_TTL)
+            pipe.execute()
+            if rewrite:
+                self._published_fields = {}
+                self._published_fields_time = time.time()
+            self._published_fields.update(changed_fields)
         except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
             rospy.logerr("Gateway: Unable to update network interface information")
 
@@ -212,35 +536,25 @@ class GatewayHub(rocon_hub_client.Hub):
           Remove all gateway info for given gateway key from the hub.
         '''
         try:
-            gateway_keys = self._redis_server.keys(gateway_key + ":*")
+            # all of the gateway's keys are known, no need to search (and block the hub) for them
+            if self.schema_version >= hub_api.SCHEMA_GATEWAY_INFO_HASH:
+                keys = [gateway_key + ":" + key for key in gateway_keys]
+            else:
+                keys = [gateway_key + ":" + key for key in legacy_gateway_keys]
             pipe = self._redis_server.pipeline()
-            pipe.delete(*gateway_keys)
+            if keys:
+                pipe.delete(*keys)
             pipe.srem(self._redis_keys['gatewaylist'], gateway_key)
+            change_notification = self._notify_change(pipe, hub_api.key_base_name(gateway_key), 'unregistered')
             pipe.execute()
+            self._note_change(change_notification)
+            self._change_lock.acquire()
+            self._public_keys.pop(hub_api.key_base_name(gateway_key), None)
+            self._advertisement_snapshots.pop(hub_api.key_base_name(gateway_key), None)
+            self._change_lock.release()
         except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
             pass
 
-    def update_named_gateway_latency_stats(self, gateway_name, latency_stats):
-        '''
-          For a given gateway, update the latency statistics
-
-          #param gateway_name : gateway name, not the redis key
-          @type str
-          @param latency_stats : ping statistics to the gateway from the hub
-          @type list : 4-tuple of float values [min, avg, max, mean deviation]
-        '''
-        try:
-            min_latency_key = hub_api.create_rocon_gateway_key(gateway_name, 'latency:min')
-            avg_latency_key = hub_api.create_rocon_gateway_key(gateway_name, 'latency:avg')
-            max_latency_key = hub_api.create_rocon_gateway_key(gateway_name, 'latency:max')
-            mdev_latency_key = hub_api.create_rocon_gateway_key(gateway_name, 'latency:mdev')
-            self._redis_server.set(min_latency_key, latency_stats[0])
-            self._redis_server.set(avg_latency_key, latency_stats[1])
-            self._redis_server.set(max_latency_key, latency_stats[2])
-            self._redis_server.set(mdev_latency_key, latency_stats[3])
-        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
-            rospy.logerr("Gateway: unable to update latency stats for " + gateway_name)
-
     def mark_named_gateway_available(self, gateway_key, available=True,
                                      time_since_last_seen=0.0):
         '''
@@ -256,10 +570,295 @@ class GatewayHub(rocon_hub_client.Hub):
                  been since the gateway was last seen (in seconds)
           @type float
         '''
-        available_key = gateway_key + ":available"
-        self._redis_server.set(available_key, available)
-        time_since_last_seen_key = gateway_key + ":time_since_last_seen"
-        self._redis_server.set(time_since_last_seen_key, int(time_since_last_seen))
+        self._set_gateway_fields(self._redis_server, hub_api.key_base_name(gateway_key),
+                                 {'available': available,
+                                  'time_since_last_seen': int(time_since_last_seen)})
+
+    def mark_named_gateways_available(self, availabilities):
+        '''
+          Mark several gateways (un)available in one go, see mark_named_gateway_available.
+
+          @param availabilities : (available, time since last seen) keyed by gateway key (not the name)
+          @type dict
+          @return whether the hub was updated
+          @rtype bool
+        '''
+        if not availabilities:
+            return True
+        try:
+            pipe = self._redis_server.pipeline()
+            for gateway_key, (available, time_since_last_seen) in availabilities.iteritems():
+                self._set_gateway_fields(pipe, hub_api.key_base_name(gateway_key),
+                                         {'available': available,
+                                          'time_since_last_seen': int(time_since_last_seen)})
+            pipe.execute()
+            return True
+        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
+            rospy.logerr("Gateway: unable to update the availability of the gateways on the hub")
+            return False
+
+    def get_named_gateway_ping_ttls(self, gateways):
+        '''
+          Time to live of the ping keys (refreshed by the gateways as long as they
+          are alive) of several gateways, in a single round trip.
+
+          @param gateways : gateway names, not the redis keys
+          @type list of str
+          @return the ttls (seconds) keyed by gateway name, None for keys without a ttl
+          @rtype dict
+        '''
+        if not gateways:
+            return {}
+        try:
+            pipe = self._redis_reader.pipeline()
+            for gateway in gateways:
+                pipe.ttl(hub_api.create_rocon_gateway_key(gateway, ':ping'))
+            return dict(zip(gateways, pipe.execute()))
+        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
+            return {}
+
+    def _set_gateway_fields(self, redis_server, gateway, fields):
+        '''
+          Store scalar information fields for a gateway on the hub using the
+          layout appropriate for the hub's schema version.
+
+          @param redis_server : the redis server, or a pipeline to queue the commands on
+          @type redis.Redis or redis.client.Pipeline
+          @param gateway : gateway name, not the redis key
+          @type str
+          @param fields : values keyed by their name in gateway_info_fields
+          @type dict
+        '''
+        if self.schema_version >= hub_api.SCHEMA_GATEWAY_INFO_HASH:
+            redis_server.hmset(hub_api.create_rocon_gateway_key(gateway, 'info'), fields)
+        else:
+            for field, value in fields.iteritems():
+                redis_server.set(hub_api.create_rocon_gateway_key(gateway, field), value)
+
+    def _get_gateway_field(self, redis_server, gateway, field):
+        '''
+          Retrieve a single information field for a gateway.
+
+          @param redis_server : the redis server, or a pipeline to queue the command on
+          @type redis.Redis or redis.client.Pipeline
+          @param gateway : gateway name, not the redis key
+          @type str
+          @param field : name of the field
+          @type str
+          @return the value (None if not set), or the pipeline if queued on a pipeline
+          @rtype str
+        '''
+        if self.schema_version >= hub_api.SCHEMA_GATEWAY_INFO_HASH:
+            return redis_server.hget(hub_api.create_rocon_gateway_key(gateway, 'info'), field)
+        else:
+            return redis_server.get(hub_api.create_rocon_gateway_key(gateway, field))
+
+    def _queue_gateway_fields_retrieval(self, pipe, gateway):
+        '''
+          Queue the retrieval of all of a gateway's information fields on a pipeline.
+          Convert the results with _parse_gateway_fields.
+
+          @param pipe : pipeline to queue the commands on
+          @type redis.client.Pipeline
+          @param gateway : gateway name, not the redis key
+          @type str
+          @return the number of results the pipeline will return for these commands
+          @rtype int
+        '''
+        if self.schema_version >= hub_api.SCHEMA_GATEWAY_INFO_HASH:
+            pipe.hgetall(hub_api.create_rocon_gateway_key(gateway, 'info'))
+            return 1
+        for field in gateway_info_fields:
+            pipe.get(hub_api.create_rocon_gateway_key(gateway, field))
+        return len(gateway_info_fields)
+
+    def _parse_gateway_fields(self, results):
+        '''
+          Convert the pipeline results of a _queue_gateway_fields_retrieval call.
+
+          @param results : the pipeline results for the queued commands
+          @type list
+          @return values (None if not set) keyed by their name in gateway_info_fields
+          @rtype dict
+        '''
+        if self.schema_version >= hub_api.SCHEMA_GATEWAY_INFO_HASH:
+            fields = results[0] or {}
+            return dict((field, fields.get(field, None)) for field in gateway_info_fields)
+        return dict(zip(gateway_info_fields, results))
+
+    ##########################################################################
+    # Change Notifications
+    ##########################################################################
+
+    def _notify_change(self, redis_server, gateway, kind):
+        '''
+          Publish a change notification for one of a gateway's data sets on the
+          hub. Once the change is written, pass the notification to _note_change
+          to invalidate our own cached copy straight away rather than waiting for
+          the notification to come back around - not before, or a concurrent read
+          could cache the old data under the new change count.
+
+          @param redis_server : the redis server, or a pipeline to queue the publish on
+          @type redis.Redis or redis.client.Pipeline
+          @param gateway : gateway name, not the redis key
+          @type str
+          @param kind : the modified data set (e.g. advertisements, flip_ins)
+          @type str
+          @return the change notification
+          @rtype str
+        '''
+        change_notification = hub_api.create_change_notification(gateway, kind)
+        redis_server.publish(self._redis_channels['changes'], change_notification)
+        return change_notification
+
+    def _note_change(self, change_notification):
+        gateway, kind = hub_api.parse_change_notification(change_notification)
+        self._change_lock.acquire()
+        self._change_counts[change_notification] = self._change_counts.get(change_notification, 0) + 1
+        if kind in ['registered', 'unregistered']:
+            self._registration_changes += 1
+        if kind == 'unregistered':
+            # nothing cached for it will be of use again
+            for cache_key in [k for k in self._change_cache
+                              if hub_api.parse_change_notification(k if isinstance(k, str) else k[0])[0] == gateway]:
+                del self._change_cache[cache_key]
+        self._change_lock.release()
+
+    def _process_change_notification(self, change_notification):
+        '''
+          Handle a change notification from the hub (called from the change
+          listener thread). Invalidates the cached data for the changed gateway
+          and wakes up the gateway if it may need to act on the change.
+
+          @param change_notification : notification published by a gateway (see _notify_change)
+          @type str
+        '''
+        gateway, kind = hub_api.parse_change_notification(change_notification)
+        self._note_change(change_notification)
+        if kind in ['registered', 'unregistered']:
+            # anything we cached for an old incarnation of this gateway is invalid
+            self._note_change(hub_api.create_change_notification(gateway, 'advertisements'))
+            self._note_change(hub_api.create_change_notification(gateway, 'flip_ins'))
+            self._note_change(hub_api.create_change_notification(gateway, 'public_key'))
+            self._change_lock.acquire()
+            self._public_keys.pop(gateway, None)
+            self._advertisement_snapshots.pop(gateway, None)
+            self._change_lock.release()
+        if kind == 'registered':
+            self._registration_condition.acquire()
+            self._registration_condition.notify_all()  # wake anyone waiting for its public key
+            self._registration_condition.release()
+        if gateway == self._unique_gateway_name:
+            relevant = (kind == 'flip_ins')  # a flip request (or unflip) for us
+        elif kind == 'flip_ins':
+            self._change_lock.acquire()
+            relevant = gateway in self._flip_targets  # status of one of our flip requests may have changed
+            self._change_lock.release()
+        else:
+            relevant = kind in ['registered', 'unregistered', 'advertisements']
+        if relevant and self._hub_change_notification_hook is not None:
+            self._hub_change_notification_hook()
+
+    def _push_flip_event(self, redis_server, recipient, flip_ins_owner):
+        '''
+          Let a gateway know straight away that a flip_ins set it is interested
+          in has changed, i.e. its own (flip requests, unflips) or that of a
+          gateway it sent flip requests to (acceptance, blocking). The event
+          is the same message as the change notification, so it is handled
+          by _process_change_notification on the recipient's side.
+
+          @param redis_server : the redis server, or a pipeline to queue the push on
+          @type redis.Redis or redis.client.Pipeline
+          @param recipient : gateway name of the recipient
+          @type str
+          @param flip_ins_owner : gateway name whose flip_ins set changed
+          @type str
+        '''
+        key = hub_api.create_rocon_gateway_key(recipient, 'flip_events')
+        redis_server.rpush(key, hub_api.create_change_notification(flip_ins_owner, 'flip_ins'))
+        redis_server.ltrim(key, -FLIP_EVENTS_MAX_LENGTH, -1)
+        redis_server.expire(key, FLIP_EVENTS_TTL)
+
+    def _change_notifications_reliable(self):
+        '''
+          Change notifications can only be relied on if every gateway on the hub
+          publishes them and we are still listening for them.
+
+          @rtype bool
+        '''
+        return (self.schema_version >= hub_api.SCHEMA_CHANGE_NOTIFICATIONS and
+                self._change_listener_thread is not None and self._change_listener_thread.is_alive())
+
+    def _get_change_count(self, gateway, kind):
+        '''
+          Number of change notifications seen for one of a gateway's data sets.
+
+          @param gateway : gateway name, not the redis key
+          @type str
+          @param kind : the data set (e.g. advertisements, flip_ins)
+          @type str
+          @return the count, or None if change notifications can't be relied on
+          @rtype int or None
+        '''
+        if not self._change_notifications_reliable():
+            return None
+        return self._count_changes(hub_api.create_change_notification(gateway, kind))
+
+    def _count_changes(self, change_notification):
+        '''
+          @param change_notification : the data set's notification (see _notify_change)
+          @type str
+          @return number of change notifications seen for the data set
+          @rtype int
+        '''
+        self._change_lock.acquire()
+        change_count = self._change_counts.get(change_notification, 0)
+        self._change_lock.release()
+        return change_count
+
+    def _get_cached(self, gateway, kind, fetch, entry=None):
+        '''
+          Retrieve one of a gateway's data sets, reusing the copy fetched last time
+          if no change notification has arrived for it since. Only possible on hubs
+          where every gateway is guaranteed to publish change notifications. The data
+          is refetched after CHANGE_NOTIFICATION_FALLBACK_PERIOD regardless.
+
+          @param gateway : gateway name, not the redis key
+          @type str
+          @param kind : the data set (e.g. advertisements, flip_ins)
+          @type str
+          @param fetch : function retrieving the data set from the hub
+          @type function
+          @param entry : if only part of the data set is fetched, a key identifying that part
+          @type str
+
+          @return the data set as returned by fetch
+        '''
+        change_count = self._get_change_count(gateway, kind)
+        if change_count is None:
+            return fetch()
+        change_notification = hub_api.create_change_notification(gateway, kind)
+        cache_key = change_notification if entry is None else (change_notification, entry)
+        self._change_lock.acquire()
+        cached = self._change_cache.get(cache_key, None)
+        self._change_lock.release()
+        if cached is not None:
+            cached_change_count, timestamp, value = cached
+            if (cached_change_count == change_count and
+                    time.time() - timestamp < CHANGE_NOTIFICATION_FALLBACK_PERIOD):
+                return value
+        value = fetch()
+        now = time.time()
+        self._change_lock.acquire()
+        self._change_cache[cache_key] = (change_count, now, value)
+        if now - self._change_cache_swept >= CHANGE_NOTIFICATION_FALLBACK_PERIOD:
+            # drop the entries that would be refetched anyway, e.g. of flip requests long gone
+            for stale_cache_key in [k for k, (unused_count, timestamp, unused_value) in self._change_cache.iteritems()
+                                    if now - timestamp >= CHANGE_NOTIFICATION_FALLBACK_PERIOD]:
+                del self._change_cache[stale_cache_key]
+            self._change_cache_swept = now
+        self._change_lock.release()
+        return value
 
     ##########################################################################
     # Hub Data Retrieval
@@ -274,10 +873,55 @@ class GatewayHub(rocon_hub_client.Hub):
           @return remote gateway information
           @rtype gateway_msgs.RemotGateway or None
         '''
-        firewall = self._redis_server.get(hub_api.create_rocon_gateway_key(gateway, 'firewall'))
+        return self.remote_gateways_info([gateway])[0]
+
+    def remote_gateways_info(self, gateways):
+        '''
+          Return remote gateway information for a list of gateway string ids. All
+          the information is retrieved from the hub in a single pipelined round
+          trip, regardless of the number of gateways requested.
+
+          @param gateways : gateway id strings to search for
+          @type list of str
+          @return remote gateway information, ordered as the request (None for gateways not found)
+          @rtype list of gateway_msgs.RemoteGateway or None
+        '''
+        pipe = self._redis_reader.pipeline()
+        number_of_field_results = 0
+        for gateway in gateways:
+            number_of_field_results = self._queue_gateway_fields_retrieval(pipe, gateway)
+            pipe.smembers(hub_api.create_rocon_gateway_key(gateway, 'advertisements'))
+            pipe.smembers(hub_api.create_rocon_gateway_key(gateway, 'flips'))
+            pipe.smembers(hub_api.create_rocon_gateway_key(gateway, 'pulls'))
+        results = pipe.execute()
+        remote_gateways = []
+        stride = number_of_field_results + 3
+        for index, gateway in enumerate(gateways):
+            gateway_results = results[index * stride:(index + 1) * stride]
+            fields = self._parse_gateway_fields(gateway_results[:number_of_field_results])
+            encoded_advertisements, encoded_flips, encoded_pulls = gateway_results[number_of_field_results:]
+            remote_gateways.append(self._create_remote_gateway_info(
+                gateway, fields, encoded_advertisements, encoded_flips, encoded_pulls))
+        return remote_gateways
+
+    def _create_remote_gateway_info(self, gateway, fields, encoded_advertisements, encoded_flips, encoded_pulls):
+        '''
+          Build the remote gateway information from the raw values retrieved from the hub.
+
+          @param gateway : gateway id string
+          @type str
+          @param fields : raw hub values keyed by their name in gateway_info_fields (see _parse_gateway_fields)
+          @type dict
+          @param encoded_advertisements, encoded_flips, encoded_pulls : serialized set members
+          @type set of str
+
+          @return remote gateway information
+          @rtype gateway_msgs.RemotGateway or None
+        '''
+        firewall = fields['firewall']
         if firewall is None:
             return None  # equivalent to saying no gateway of this id found
-        ip = self._redis_server.get(hub_api.create_rocon_gateway_key(gateway, 'ip'))
+        ip = fields['ip']
         if ip is None:
             return None  # hub information not available/correct
         remote_gateway = gateway_msgs.RemoteGateway()
@@ -285,70 +929,89 @@ class GatewayHub(rocon_hub_client.Hub):
         remote_gateway.ip = ip
         remote_gateway.firewall = True if int(firewall) else False
         remote_gateway.public_interface = []
-        encoded_advertisements = self._redis_server.smembers(
-            hub_api.create_rocon_gateway_key(gateway, 'advertisements'))
         for encoded_advertisement in encoded_advertisements:
-            advertisement = utils.deserialize_connection(encoded_advertisement)
+            try:
+                advertisement = utils.deserialize_connection(encoded_advertisement, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             remote_gateway.public_interface.append(advertisement.rule)
         remote_gateway.flipped_interface = []
-        encoded_flips = self._redis_server.smembers(hub_api.create_rocon_gateway_key(gateway, 'flips'))
         for encoded_flip in encoded_flips:
-            [target_gateway, name, connection_type, node] = utils.deserialize(encoded_flip)
+            try:
+                [target_gateway, name, connection_type, node] = utils.deserialize(encoded_flip, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             remote_rule = gateway_msgs.RemoteRule(target_gateway, gateway_msgs.Rule(connection_type, name, node))
             remote_gateway.flipped_interface.append(remote_rule)
         remote_gateway.pulled_interface = []
-        encoded_pulls = self._redis_server.smembers(hub_api.create_rocon_gateway_key(gateway, 'pulls'))
         for encoded_pull in encoded_pulls:
-            [target_gateway, name, connection_type, node] = utils.deserialize(encoded_pull)
+            try:
+                [target_gateway, name, connection_type, node] = utils.deserialize(encoded_pull, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             remote_rule = gateway_msgs.RemoteRule(target_gateway, gateway_msgs.Rule(connection_type, name, node))
             remote_gateway.pulled_interface.append(remote_rule)
 
         # Gateway health/network connection statistics indicators
-        gateway_available_key = hub_api.create_rocon_gateway_key(gateway, 'available')
-        remote_gateway.conn_stats.gateway_available = \
-            self._parse_redis_bool(self._redis_server.get(gateway_available_key))
-        time_since_last_seen_key = hub_api.create_rocon_gateway_key(gateway, 'time_since_last_seen')
-        remote_gateway.conn_stats.time_since_last_seen = \
-            self._parse_redis_int(self._redis_server.get(time_since_last_seen_key))
-
-        ping_latency_min_key = hub_api.create_rocon_gateway_key(gateway, 'latency:min')
-        remote_gateway.conn_stats.ping_latency_min = \
-            self._parse_redis_float(self._redis_server.get(ping_latency_min_key))
-        ping_latency_max_key = hub_api.create_rocon_gateway_key(gateway, 'latency:max')
-        remote_gateway.conn_stats.ping_latency_max = \
-            self._parse_redis_float(self._redis_server.get(ping_latency_max_key))
-        ping_latency_avg_key = hub_api.create_rocon_gateway_key(gateway, 'latency:avg')
-        remote_gateway.conn_stats.ping_latency_avg = \
-            self._parse_redis_float(self._redis_server.get(ping_latency_avg_key))
-        ping_latency_mdev_key = hub_api.create_rocon_gateway_key(gateway, 'latency:mdev')
-        remote_gateway.conn_stats.ping_latency_mdev = \
-            self._parse_redis_float(self._redis_server.get(ping_latency_mdev_key))
+        remote_gateway.conn_stats.gateway_available = self._parse_redis_bool(fields['available'])
+        # only refreshed by the hub's watcher every gateway_unavailable_timeout (see rocon_hub.watcher)
+        remote_gateway.conn_stats.time_since_last_seen = self._parse_redis_int(fields['time_since_last_seen'])
+        remote_gateway.conn_stats.ping_latency_min = self._parse_redis_float(fields['latency:min'])
+        remote_gateway.conn_stats.ping_latency_max = self._parse_redis_float(fields['latency:max'])
+        remote_gateway.conn_stats.ping_latency_avg = self._parse_redis_float(fields['latency:avg'])
+        remote_gateway.conn_stats.ping_latency_mdev = self._parse_redis_float(fields['latency:mdev'])
 
         # Gateway network connection indicators
-        network_info_available_key = hub_api.create_rocon_gateway_key(gateway, 'network:info_available')
-        remote_gateway.conn_stats.network_info_available = \
-            self._parse_redis_bool(self._redis_server.get(network_info_available_key))
+        remote_gateway.conn_stats.network_info_available = self._parse_redis_bool(fields['network:info_available'])
         if not remote_gateway.conn_stats.network_info_available:
             return remote_gateway
-        network_type_key = hub_api.create_rocon_gateway_key(gateway, 'network:type')
-        remote_gateway.conn_stats.network_type = \
-            self._parse_redis_int(self._redis_server.get(network_type_key))
+        remote_gateway.conn_stats.network_type = self._parse_redis_int(fields['network:type'])
         if remote_gateway.conn_stats.network_type == gateway_msgs.RemoteGateway.WIRED:
             return remote_gateway
-        wireless_bitrate_key = hub_api.create_rocon_gateway_key(gateway, 'wireless:bitrate')
-        remote_gateway.conn_stats.wireless_bitrate = \
-            self._parse_redis_float(self._redis_server.get(wireless_bitrate_key))
-        wireless_link_quality_key = hub_api.create_rocon_gateway_key(gateway, 'wireless:quality')
-        remote_gateway.conn_stats.wireless_link_quality = \
-            self._parse_redis_int(self._redis_server.get(wireless_link_quality_key))
-        wireless_signal_level_key = hub_api.create_rocon_gateway_key(gateway, 'wireless:signal_level')
-        remote_gateway.conn_stats.wireless_signal_level = \
-            self._parse_redis_float(self._redis_server.get(wireless_signal_level_key))
-        wireless_noise_level_key = hub_api.create_rocon_gateway_key(gateway, 'wireless:noise_level')
-        remote_gateway.conn_stats.wireless_noise_level = \
-            self._parse_redis_float(self._redis_server.get(wireless_noise_level_key))
+        remote_gateway.conn_stats.wireless_bitrate = self._parse_redis_float(fields['wireless:bitrate'])
+        remote_gateway.conn_stats.wireless_link_quality = self._parse_redis_int(fields['wireless:quality'])
+        remote_gateway.conn_stats.wireless_signal_level = self._parse_redis_float(fields['wireless:signal_level'])
+        remote_gateway.conn_stats.wireless_noise_level = self._parse_redis_float(fields['wireless:noise_level'])
         return remote_gateway
 
+    def _get_gateway_directory(self):
+        '''
+          Retrieve the gateways registered on the hub. The directory is reused
+          until a gateway (un)registers, or for GATEWAY_DIRECTORY_TTL if change
+          notifications can't be relied on, so that the many lookups made in a
+          single watcher tick cost one retrieval. Firewall flags are only
+          retrieved when asked for (see get_remote_gateway_firewall_flag) and
+          kept in the directory along with the gateways.
+
+          @return firewall flags (None if not retrieved yet) keyed by gateway name (shared, don't modify it)
+          @rtype dict of str : bool
+
+          @raise redis.ConnectionError, AttributeError
+        '''
+        reliable = self._change_notifications_reliable()
+        self._change_lock.acquire()
+        registration_changes = self._registration_changes
+        gateway_directory = self._gateway_directory
+        self._change_lock.release()
+        try:
+            cached_registration_changes, timestamp, directory = gateway_directory
+            age = time.time() - timestamp
+            if reliable:
+                current = (cached_registration_changes == registration_changes and
+                           age < CHANGE_NOTIFICATION_FALLBACK_PERIOD)
+            else:
+                current = age < GATEWAY_DIRECTORY_TTL
+            if current:
+                return directory
+        except TypeError:
+            pass  # nothing cached yet
+        directory = dict((hub_api.key_base_name(gateway_key), None)
+                         for gateway_key in self._redis_reader.smembers(self._redis_keys['gatewaylist']))
+        self._change_lock.acquire()
+        self._gateway_directory = (registration_changes, time.time(), directory)
+        self._change_lock.release()
+        return directory
+
     def list_remote_gateway_names(self):
         '''
           Return a list of the gateways (name list, not redis keys).
@@ -360,10 +1023,9 @@ class GatewayHub(rocon_hub_client.Hub):
             return []
         gateways = []
         try:
-            gateway_keys = self._redis_server.smembers(self._redis_keys['gatewaylist'])
-            for gateway in gateway_keys:
-                if hub_api.key_base_name(gateway) != self._unique_gateway_name:
-                    gateways.append(hub_api.key_base_name(gateway))
+            for gateway in self._get_gateway_directory():
+                if gateway != self._unique_gateway_name:
+                    gateways.append(gateway)
         except (redis.ConnectionError, AttributeError) as unused_e:
             # redis misbehaves a little here, sometimes it doesn't catch a disconnection properly
             # see https://github.com/robotics-in-concert/rocon_multimaster/issues/251 so it
@@ -412,16 +1074,129 @@ class GatewayHub(rocon_hub_client.Hub):
           @return dictionary of remote advertisements
           @rtype dictionary of connection type keyed connection values
        '''
-        connections = utils.create_empty_connection_type_dictionary()
-        key = hub_api.create_rocon_gateway_key(remote_gateway, 'advertisements')
+        return self.get_remote_connection_states([remote_gateway])[remote_gateway]
+
+    def get_remote_connection_states(self, remote_gateways):
+        '''
+          Retrieve the public interfaces of several remote gateways. On hubs where
+          advertisements are versioned, a single MGET of the versions tells which
+          gateways' advertisements changed since the last call and only those are
+          refetched (in one more round trip).
+
+          @param remote_gateways : hash names for remote gateways
+          @type list of str
+          @return dictionaries of remote advertisements keyed by remote gateway name
+          @rtype dict of str : dictionary of connection type keyed connection values
+        '''
         try:
-            public_interface = self._redis_server.smembers(key)
-            for connection_str in public_interface:
-                connection = utils.deserialize_connection(connection_str)
-                connections[connection.rule.type].append(connection)
+            if self._versioned_advertisements:
+                states = self._get_versioned_advertisements(remote_gateways)
+            else:
+                states = {}
+                for remote_gateway in remote_gateways:
+                    states[remote_gateway] = self._get_cached(
+                        remote_gateway, 'advertisements',
+                        lambda: self._parse_advertisements(self._redis_reader.smembers(
+                            hub_api.create_rocon_gateway_key(remote_gateway, 'advertisements'))))
         except redis.exceptions.ConnectionError:
             # will arrive here if the hub happens to have been lost last update and arriving here
-            pass
+            return dict((remote_gateway, utils.create_empty_connection_type_dictionary())
+                        for remote_gateway in remote_gateways)
+        # copy the lists so callers can't modify the cached copies
+        return dict((remote_gateway, dict((connection_type, list(connection_list))
+                                          for connection_type, connection_list in connections.iteritems()))
+                    for remote_gateway, connections in states.iteritems())
+
+    def _get_versioned_advertisements(self, remote_gateways):
+        '''
+          Retrieve the parsed advertisements of remote gateways, refetching only
+          those whose advertisements version has changed since they were last
+          retrieved. As with _get_cached, snapshots without a change notification
+          since are reused without even checking the version.
+
+          @param remote_gateways : hash names for remote gateways
+          @type list of str
+          @return parsed advertisements keyed by remote gateway name (shared, don't modify them)
+          @rtype dict of str : dictionary of connection type keyed connection values
+
+          @raise redis.exceptions.ConnectionError
+        '''
+        states = {}
+        change_counts = {}
+        for remote_gateway in remote_gateways:
+            change_counts[remote_gateway] = self._get_change_count(remote_gateway, 'advertisements')
+        unchecked = []
+        self._change_lock.acquire()
+        snapshots = dict((remote_gateway, self._advertisement_snapshots[remote_gateway])
+                         for remote_gateway in remote_gateways if remote_gateway in self._advertisement_snapshots)
+        self._change_lock.release()
+        for remote_gateway in remote_gateways:
+            try:
+                unused_version, change_count, timestamp, connections = snapshots[remote_gateway]
+                if (change_count is not None and change_count == change_counts[remote_gateway] and
+                        time.time() - timestamp < CHANGE_NOTIFICATION_FALLBACK_PERIOD):
+                    states[remote_gateway] = connections
+                    continue
+            except KeyError:
+                pass
+            unchecked.append(remote_gateway)
+        if not unchecked:
+            return states
+        versions = self._redis_reader.mget(
+            [hub_api.create_rocon_gateway_key(remote_gateway, 'advertisements:version')
+             for remote_gateway in unchecked])
+        changed = []
+        refreshed = {}  # remote gateway : new snapshot (None to drop it)
+        for remote_gateway, version in zip(unchecked, versions):
+            if version is None:
+                # not (or no longer) registered, or not versioning its advertisements
+                refreshed[remote_gateway] = None
+                states[remote_gateway] = utils.create_empty_connection_type_dictionary()
+                continue
+            try:
+                snapshot_version, unused_change_count, unused_timestamp, connections = snapshots[remote_gateway]
+                if snapshot_version == version:
+                    refreshed[remote_gateway] = (version, change_counts[remote_gateway], time.time(), connections)
+                    states[remote_gateway] = connections
+                    continue
+            except KeyError:
+                pass
+            changed.append(remote_gateway)
+        if changed:
+            pipe = self._redis_reader.pipeline()  # transactional, the version matches the members
+            for remote_gateway in changed:
+                pipe.smembers(hub_api.create_rocon_gateway_key(remote_gateway, 'advertisements'))
+                pipe.get(hub_api.create_rocon_gateway_key(remote_gateway, 'advertisements:version'))
+            results = pipe.execute()
+            for index, remote_gateway in enumerate(changed):
+                encoded_advertisements, version = results[2 * index:2 * index + 2]
+                connections = self._parse_advertisements(encoded_advertisements)
+                if version is not None:
+                    refreshed[remote_gateway] = (version, change_counts[remote_gateway], time.time(), connections)
+                states[remote_gateway] = connections
+        self._change_lock.acquire()
+        for remote_gateway, snapshot in refreshed.iteritems():
+            if snapshot is None:
+                self._advertisement_snapshots.pop(remote_gateway, None)
+            else:
+                self._advertisement_snapshots[remote_gateway] = snapshot
+        self._change_lock.release()
+        return states
+
+    def _parse_advertisements(self, encoded_advertisements):
+        '''
+          @param encoded_advertisements : members of a gateway's advertisements set
+          @type set of str
+          @return dictionary of remote advertisements
+          @rtype dictionary of connection type keyed connection values
+        '''
+        connections = utils.create_empty_connection_type_dictionary()
+        for connection_str in encoded_advertisements:
+            try:
+                connection = utils.deserialize_connection(connection_str, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
+            connections[connection.rule.type].append(connection)
         return connections
 
     def get_remote_gateway_firewall_flag(self, gateway):
@@ -437,9 +1212,22 @@ class GatewayHub(rocon_hub_client.Hub):
 
           @raise GatewayUnavailableError when specified gateway is not on the hub
         '''
-        firewall = self._redis_server.get(hub_api.create_rocon_gateway_key(gateway, 'firewall'))
+        directory = {}
+        try:
+            directory = self._get_gateway_directory()
+            firewall = directory[gateway]
+            if firewall is not None:
+                return firewall
+        except (KeyError, redis.ConnectionError, AttributeError):
+            pass  # maybe registered since the directory was retrieved, check with the hub
+        firewall = self._get_gateway_field(self._redis_reader, gateway, 'firewall')
         if firewall is not None:
-            return True if int(firewall) else False
+            firewall = True if int(firewall) else False
+            self._change_lock.acquire()
+            if gateway in directory:
+                directory[gateway] = firewall  # for the next lookup
+            self._change_lock.release()
+            return firewall
         else:
             raise GatewayUnavailableError
 
@@ -455,7 +1243,10 @@ class GatewayHub(rocon_hub_client.Hub):
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements')
         public_interface = self._redis_server.smembers(key)
         for connection_str in public_interface:
-            connection = utils.deserialize_connection(connection_str)
+            try:
+                connection = utils.deserialize_connection(connection_str, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             connections[connection.rule.type].append(connection)
         return connections
 
@@ -495,8 +1286,13 @@ class GatewayHub(rocon_hub_client.Hub):
           @raise .exceptions.ConnectionTypeError: if connection arg is invalid.
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements')
-        msg_str = utils.serialize_connection(connection)
-        self._redis_server.sadd(key, msg_str)
+        msg_str = utils.serialize_connection(connection, self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.sadd(key, msg_str)
+        self._bump_advertisements_version(pipe)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'advertisements')
+        pipe.execute()
+        self._note_change(change_notification)
 
     def unadvertise(self, connection):
         '''
@@ -507,8 +1303,106 @@ class GatewayHub(rocon_hub_client.Hub):
           @raise .exceptions.ConnectionTypeError: if connectionarg is invalid.
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements')
-        msg_str = utils.serialize_connection(connection)
-        self._redis_server.srem(key, msg_str)
+        msg_str = utils.serialize_connection(connection, self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.srem(key, msg_str)
+        self._bump_advertisements_version(pipe)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'advertisements')
+        pipe.execute()
+        self._note_change(change_notification)
+
+    def update_advertisements(self, added, removed):
+        '''
+          Add and remove several connections to/from the public interface in a
+          single round trip (e.g. all the changes found in one watcher tick).
+          Individual failures don't stop the others from being applied.
+
+          @param added : connections to advertise
+          @type list of utils.Connection
+          @param removed : connections to unadvertise
+          @type list of utils.Connection
+          @return the connections that failed, with the reason
+          @rtype list of (utils.Connection, Exception)
+
+          @raise redis.exceptions.ConnectionError if the hub couldn't be reached at all
+        '''
+        key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements')
+        failures = []
+        queued = []
+        pipe = self._redis_server.pipeline()
+        for connections, command in [(added, pipe.sadd), (removed, pipe.srem)]:
+            for connection in connections:
+                try:
+                    command(key, utils.serialize_connection(connection, self._compact))
+                except ValueError as e:  # couldn't serialize
+                    failures.append((connection, e))
+                    continue
+                queued.append(connection)
+        if not queued:
+            return failures
+        self._bump_advertisements_version(pipe)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'advertisements')
+        results = pipe.execute(raise_on_error=False)
+        self._note_change(change_notification)
+        for connection, result in zip(queued, results):
+            if isinstance(result, Exception):
+                failures.append((connection, result))
+        return failures
+
+    def sync_advertisements(self, connections):
+        '''
+          Make the public interface on the hub match the given connections, e.g.
+          on (re)connecting to a hub. Only the differences with what the hub
+          already has are written, all in a single transaction.
+
+          @param connections : the complete public interface
+          @type dictionary of connection type keyed connection values
+          @return the number of advertisements added and removed
+          @rtype (int, int)
+        '''
+        key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements')
+        advertisements = set(utils.serialize_connection(connection, self._compact)
+                             for connection_list in connections.values() for connection in connection_list)
+        existing_advertisements = self._redis_server.smembers(key)
+        added = list(advertisements - existing_advertisements)
+        removed = list(existing_advertisements - advertisements)
+        if not added and not removed:
+            return 0, 0
+        try:
+            self._write_advertisement_differences(key, added, removed, variadic=True)
+        except redis.exceptions.ResponseError:
+            # redis < 2.4 only accepts one member per SADD/SREM
+            self._write_advertisement_differences(key, added, removed, variadic=False)
+        return len(added), len(removed)
+
+    def _write_advertisement_differences(self, key, added, removed, variadic):
+        pipe = self._redis_server.pipeline()
+        if variadic:
+            if added:
+                pipe.sadd(key, *added)
+            if removed:
+                pipe.srem(key, *removed)
+        else:
+            for advertisement in added:
+                pipe.sadd(key, advertisement)
+            for advertisement in removed:
+                pipe.srem(key, advertisement)
+        self._bump_advertisements_version(pipe)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'advertisements')
+        pipe.execute()
+        self._note_change(change_notification)
+
+    def _bump_advertisements_version(self, pipe):
+        '''
+          Queue an increment of this gateway's advertisements version. Queue it
+          on the same (transactional) pipeline as the modification so readers never
+          see one without the other.
+
+          @param pipe : pipeline the advertisements are being modified on
+          @type redis.client.Pipeline
+        '''
+        if self._versioned_advertisements:
+            pipe.incr(hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'advertisements:version'))
 
     def post_flip_details(self, gateway, name, connection_type, node):
         '''
@@ -525,8 +1419,12 @@ class GatewayHub(rocon_hub_client.Hub):
           @type string
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'flips')
-        serialized_data = utils.serialize([gateway, name, connection_type, node])
-        self._redis_server.sadd(key, serialized_data)
+        serialized_data = utils.serialize([gateway, name, connection_type, node], self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.sadd(key, serialized_data)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'flips')
+        pipe.execute()
+        self._note_change(change_notification)
 
     def remove_flip_details(self, gateway, name, connection_type, node):
         '''
@@ -543,8 +1441,12 @@ class GatewayHub(rocon_hub_client.Hub):
           @type string
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'flips')
-        serialized_data = utils.serialize([gateway, name, connection_type, node])
-        self._redis_server.srem(key, serialized_data)
+        serialized_data = utils.serialize([gateway, name, connection_type, node], self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.srem(key, serialized_data)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'flips')
+        pipe.execute()
+        self._note_change(change_notification)
 
     def post_pull_details(self, gateway, name, connection_type, node):
         '''
@@ -561,8 +1463,12 @@ class GatewayHub(rocon_hub_client.Hub):
           @type string
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'pulls')
-        serialized_data = utils.serialize([gateway, name, connection_type, node])
-        self._redis_server.sadd(key, serialized_data)
+        serialized_data = utils.serialize([gateway, name, connection_type, node], self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.sadd(key, serialized_data)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'pulls')
+        pipe.execute()
+        self._note_change(change_notification)
 
     def remove_pull_details(self, gateway, name, connection_type, node):
         '''
@@ -579,34 +1485,283 @@ class GatewayHub(rocon_hub_client.Hub):
           @type string
         '''
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'pulls')
-        serialized_data = utils.serialize([gateway, name, connection_type, node])
-        self._redis_server.srem(key, serialized_data)
+        serialized_data = utils.serialize([gateway, name, connection_type, node], self._compact)
+        pipe = self._redis_server.pipeline()
+        pipe.srem(key, serialized_data)
+        change_notification = self._notify_change(pipe, self._unique_gateway_name, 'pulls')
+        pipe.execute()
+        self._note_change(change_notification)
 
     ##########################################################################
     # Flip specific communication
     ##########################################################################
 
+    def _flip_in_field(self, source, rule):
+        '''
+          The (plaintext) field identifying a flip request in a gateway's
+          flip_ins hash (hubs with schema version SCHEMA_KEYED_FLIP_INS and up).
+
+          @param source : name of the gateway that sent the flip request
+          @type str
+          @param rule : the flipped rule
+          @type gateway_msgs.Rule
+          @return the hash field
+          @rtype str
+        '''
+        return utils.serialize([str(source), str(rule.type), str(rule.name), str(rule.node)], self._compact)
+
+    def _get_flip_ins(self, gateway):
+        '''
+          Retrieve all of the (serialized) flip requests sent to a gateway.
+
+          @param gateway : gateway name, not the redis key
+          @type str
+          @return serialized flip requests
+          @rtype list of str
+        '''
+        key = hub_api.create_rocon_gateway_key(gateway, 'flip_ins')
+        if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+            return self._redis_reader.hvals(key)
+        else:
+            return self._redis_reader.smembers(key)
+
     def get_unblocked_flipped_in_connections(self):
         '''
           Returns all unblocked flips (accepted or pending) that have been
           requested through this hub
         '''
         registrations = []
-        key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'flip_ins')
         encoded_flip_ins = []
         try:
-            encoded_flip_ins = self._redis_server.smembers(key)
+            encoded_flip_ins = self._get_cached(self._unique_gateway_name, 'flip_ins',
+                                                lambda: self._get_flip_ins(self._unique_gateway_name))
         except (redis.ConnectionError, AttributeError) as unused_e:
             # probably disconnected from the hub
             pass
+        ciphertexts = set()
+        wrapped_session_keys = set()
+        flip_ins_seen = {}
         for flip_in in encoded_flip_ins:
-            cmd, source, connection_list = utils.deserialize_request(flip_in)
+            try:
+                cmd, source, connection_list = utils.deserialize_request(flip_in, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             connection = utils.get_connection_from_list(connection_list)
-            connection = utils.decrypt_connection(connection, self.private_key)
+            ciphertexts.add((connection.type_info, connection.xmlrpc_uri))
+            for ciphertext in [connection.type_info, connection.xmlrpc_uri]:
+                if utils.is_hybrid_ciphertext(ciphertext):
+                    try:
+                        wrapped_session_keys.add(utils.get_wrapped_session_key(ciphertext))
+                    except ValueError:
+                        pass  # reported when decrypting
+            if self._flip_scripting:
+                flip_ins_seen[self._flip_in_field(source, connection.rule)] = flip_in
             if cmd != FlipStatus.BLOCKED:
+                try:
+                    connection = self._decrypt_flip_in_connection(connection)
+                except ValueError as e:
+                    rospy.logwarn("Gateway : ignoring flip request from [%s] that could not be decrypted [%s]" %
+                                  (source, str(e)))
+                    continue
                 registrations.append(utils.Registration(connection, source))
+        # forget the requests that have been withdrawn
+        self._flip_ins_lock.acquire()
+        for ciphertext in [c for c in self._decrypted_connections if c not in ciphertexts]:
+            del self._decrypted_connections[ciphertext]
+        for wrapped_session_key in [k for k in self._received_session_keys if k not in wrapped_session_keys]:
+            del self._received_session_keys[wrapped_session_key]
+        self._flip_ins_seen = flip_ins_seen
+        self._flip_ins_lock.release()
         return registrations
 
+    def _decrypt_flip_in_connection(self, connection):
+        '''
+          Decrypt a connection sent to us in a flip request. The ciphertext doesn't
+          change while the request stays on the hub, so the results are cached
+          (least recently used entries are dropped beyond DECRYPTION_CACHE_SIZE)
+          rather than paying for the RSA decryptions every watcher loop.
+
+          @param connection : connection with encrypted type_info and xmlrpc_uri
+          @type utils.Connection
+          @return the decrypted connection
+          @rtype utils.Connection
+
+          @raise ValueError if a hybrid encrypted field is malformed or fails authentication
+        '''
+        ciphertext = (connection.type_info, connection.xmlrpc_uri)
+        self._flip_ins_lock.acquire()
+        plaintext = self._decrypted_connections.pop(ciphertext, None)
+        self._flip_ins_lock.release()
+        if plaintext is None:
+            plaintext = (self._decrypt(connection.type_info), self._decrypt(connection.xmlrpc_uri))
+        self._flip_ins_lock.acquire()
+        self._decrypted_connections.pop(ciphertext, None)  # in case another thread has just decrypted it too
+        if len(self._decrypted_connections) >= DECRYPTION_CACHE_SIZE:
+            self._decrypted_connections.popitem(last=False)
+        self._decrypted_connections[ciphertext] = plaintext  # (re)insert as most recently used
+        self._flip_ins_lock.release()
+        return utils.Connection(connection.rule, plaintext[0], plaintext[1])
+
+    def _decrypt(self, ciphertext):
+        '''
+          Decrypt a field of a flip request, whichever way the sender encrypted it.
+          Session keys are only unwrapped (RSA) the first time they are seen, they
+          are cached like the decrypted connections.
+
+          @raise ValueError if a hybrid encrypted field is malformed or fails authentication
+        '''
+        if not utils.is_hybrid_ciphertext(ciphertext):
+            return utils.decrypt(ciphertext, self.private_key)
+        wrapped_session_key = utils.get_wrapped_session_key(ciphertext)
+        self._flip_ins_lock.acquire()
+        session_key = self._received_session_keys.pop(wrapped_session_key, None)
+        self._flip_ins_lock.release()
+        if session_key is None:
+            session_key = utils.unwrap_session_key(wrapped_session_key, self.private_key)
+        self._flip_ins_lock.acquire()
+        self._received_session_keys.pop(wrapped_session_key, None)  # in case another thread has just unwrapped it too
+        if len(self._received_session_keys) >= DECRYPTION_CACHE_SIZE:
+            self._received_session_keys.popitem(last=False)
+        self._received_session_keys[wrapped_session_key] = session_key  # (re)insert as most recently used
+        self._flip_ins_lock.release()
+        return utils.hybrid_decrypt(ciphertext, session_key)
+
+    def _get_public_key(self, remote_gateway, public_key_str):
+        '''
+          Deserialize a remote gateway's public key, reusing the result for as
+          long as the gateway posts the same key.
+
+          @param remote_gateway : gateway name, not the redis key
+          @type str
+          @param public_key_str : the remote gateway's serialized public key
+          @type str
+          @return the public key
+          @rtype RSA key object
+        '''
+        self._change_lock.acquire()
+        cached = self._public_keys.get(remote_gateway, None)
+        self._change_lock.release()
+        if cached is not None and cached[0] == public_key_str:
+            return cached[1]
+        public_key = utils.deserialize_key(public_key_str)
+        self._change_lock.acquire()
+        self._public_keys[remote_gateway] = (public_key_str, public_key)
+        self._change_lock.release()
+        return public_key
+
+    def _wait_for_public_key(self, remote_gateway, timeout):
+        '''
+          Retrieve a remote gateway's serialized public key and encryption
+          capability, waiting up to timeout seconds for it to register. Waits
+          for its registration notification, polling with an exponential
+          backoff in case notifications aren't available.
+
+          @param remote_gateway : gateway name, not the redis key
+          @type str
+          @param timeout : seconds to wait
+          @type float
+          @return serialized public key (None if it timed out), 'encryption' field
+          @rtype (str, str)
+        '''
+        def fetch():
+            pipe = self._redis_reader.pipeline()
+            pipe.get(hub_api.create_rocon_gateway_key(remote_gateway, 'public_key'))
+            self._get_gateway_field(pipe, remote_gateway, 'encryption')
+            return tuple(pipe.execute())
+        registered = hub_api.create_change_notification(remote_gateway, 'registered')
+        start_time = time.time()
+        period = PUBLIC_KEY_WAIT_MIN_PERIOD
+        while True:
+            registrations = self._count_changes(registered)
+            public_key_str, encryption = self._get_cached(remote_gateway, 'public_key', fetch)
+            remaining_time = timeout - (time.time() - start_time)
+            if public_key_str is not None or remaining_time <= 0.0:
+                return public_key_str, encryption
+            self._registration_condition.acquire()
+            if self._count_changes(registered) == registrations:
+                self._registration_condition.wait(min(period, remaining_time))
+            self._registration_condition.release()
+            period = min(2 * period, PUBLIC_KEY_WAIT_MAX_PERIOD)
+
+    def _encrypt_connection(self, remote_gateway, connection, public_key_str, encryption):
+        '''
+          Encrypt a connection for a flip request to a remote gateway, using
+          hybrid encryption if the remote gateway supports it. The session key
+          for a remote gateway is generated once and reused for as long as it
+          keeps the same public key.
+
+          @param remote_gateway : gateway name, not the redis key
+          @type str
+          @param connection : the connection to encrypt
+          @type utils.Connection
+          @param public_key_str : the remote gateway's serialized public key
+          @type str
+          @param encryption : the remote gateway's 'encryption' field
+          @type str or None
+          @return the encrypted connection
+          @rtype utils.Connection
+        '''
+        if encryption != HYBRID_ENCRYPTION:
+            return utils.encrypt_connection(connection, self._get_public_key(remote_gateway, public_key_str))
+        self._flip_ins_lock.acquire()
+        session = self._session_keys.get((remote_gateway, public_key_str), None)
+        self._flip_ins_lock.release()
+        if session is None:
+            session = utils.generate_session_key(self._get_public_key(remote_gateway, public_key_str))
+            self._flip_ins_lock.acquire()
+            # drop any session with an older key of the same gateway
+            for old_session in [s for s in self._session_keys if s[0] == remote_gateway]:
+                del self._session_keys[old_session]
+            self._session_keys[(remote_gateway, public_key_str)] = session
+            self._flip_ins_lock.release()
+        session_key, wrapped_session_key = session
+        return utils.hybrid_encrypt_connection(connection, session_key, wrapped_session_key)
+
+    def _run_flip_script(self, name, flip_ins_owner, recipient, *args):
+        '''
+          Run one of the flip_scripts on a gateway's flip_ins hash. The script is
+          loaded on first use (and reloaded if the hub has lost it, e.g. restarted).
+
+          @param name : name of the script in flip_scripts
+          @type str
+          @param flip_ins_owner : gateway name whose flip_ins hash is modified
+          @type str
+          @param recipient : gateway name to push the flip event to
+          @type str
+          @param args : script specific arguments
+
+          @return the script's result, or None if the hub can't run scripts (redis < 2.6)
+          @rtype int or None
+
+          @raise redis.exceptions.ConnectionError
+        '''
+        if not self._flip_scripting:
+            return None
+        change_notification = hub_api.create_change_notification(flip_ins_owner, 'flip_ins')
+        keys = [hub_api.create_rocon_gateway_key(flip_ins_owner, 'flip_ins'),
+                hub_api.create_rocon_gateway_key(recipient, 'flip_events')]
+        arguments = [self._redis_channels['changes'], change_notification, FLIP_EVENTS_MAX_LENGTH, FLIP_EVENTS_TTL]
+        arguments.extend(args)
+        for unused_attempt in range(2):
+            if name not in self._flip_script_digests:
+                try:
+                    self._flip_script_digests[name] = self._redis_server.script_load(flip_scripts[name])
+                except redis.exceptions.ResponseError:
+                    rospy.logwarn("Gateway : hub can't run scripts, falling back to multiple round trips [%s]" %
+                                  self.name)
+                    self._flip_scripting = False
+                    return None
+            try:
+                result = self._redis_server.evalsha(self._flip_script_digests[name], len(keys), *(keys + arguments))
+                break
+            except redis.exceptions.NoScriptError:
+                del self._flip_script_digests[name]
+        else:
+            raise redis.exceptions.ResponseError("flip script [%s] could not be loaded" % name)
+        if result:
+            self._note_change(change_notification)
+        return result
+
     def block_flip_request(self, registration):
         ''' Convenience wrapper for updating flip request status '''
         return self._update_flip_request_status(registration, FlipStatus.BLOCKED)
@@ -628,27 +1783,98 @@ class GatewayHub(rocon_hub_client.Hub):
           @return True if this hub was used to send the flip request, and the status was updated. False otherwise.
           @rtype Boolean
         '''
-        hub_found = False
         key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'flip_ins')
-        encoded_flip_ins = self._redis_server.smembers(key)
-        for flip_in in encoded_flip_ins:
-            cmd, source, connection_list = utils.deserialize_request(flip_in)
-            connection = utils.get_connection_from_list(connection_list)
-            connection = utils.decrypt_connection(connection, self.private_key)
-            if source == registration.remote_gateway and \
-               connection == registration.connection:
-                self._redis_server.srem(key, flip_in)
-                hub_found = True
-        if hub_found:
-            encrypted_connection = utils.encrypt_connection(registration.connection,
-                                                            self.private_key)
+        if self._flip_scripting:
+            updated = self._compare_and_update_flip_request_status(registration, status)
+            if updated is not None:
+                return updated
+        pipe = self._redis_server.pipeline()
+        # The already encrypted connection of the matching request is reused as is
+        encrypted_connection = None
+        if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+            field = self._flip_in_field(registration.remote_gateway, registration.connection.rule)
+            flip_in = self._redis_server.hget(key, field)
+            try:
+                if flip_in is not None:
+                    unused_cmd, unused_source, connection_list = utils.deserialize_request(flip_in, not self._compact)
+                    encrypted_connection = utils.get_connection_from_list(connection_list)
+            except ValueError:
+                pass  # malformed, or pickled on a hub that no longer allows them
+        else:
+            for flip_in in self._redis_server.smembers(key):
+                try:
+                    cmd, source, connection_list = utils.deserialize_request(flip_in, not self._compact)
+                except ValueError:
+                    continue  # malformed, or pickled on a hub that no longer allows them
+                connection = utils.get_connection_from_list(connection_list)
+                # Only decrypt the requests for this registration's rule
+                if source != registration.remote_gateway or connection.rule != registration.connection.rule:
+                    continue
+                try:
+                    if self._decrypt_flip_in_connection(connection) != registration.connection:
+                        continue
+                except ValueError:
+                    continue
+                pipe.srem(key, flip_in)
+                encrypted_connection = connection
+        if encrypted_connection is not None:
             serialized_data = utils.serialize_connection_request(status,
                                                                  registration.remote_gateway,
-                                                                 encrypted_connection)
-            self._redis_server.sadd(key, serialized_data)
+                                                                 encrypted_connection,
+                                                                 self._compact)
+            if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+                pipe.hset(key, field, serialized_data)
+            else:
+                pipe.sadd(key, serialized_data)
+            change_notification = self._notify_change(pipe, self._unique_gateway_name, 'flip_ins')
+            self._push_flip_event(pipe, registration.remote_gateway, self._unique_gateway_name)
+            pipe.execute()
+            self._note_change(change_notification)
             return True
         return False
 
+    def _compare_and_update_flip_request_status(self, registration, status):
+        '''
+          Update the flip request status with a hub side compare and set, starting
+          from the request as last retrieved, so that usually it takes a single round
+          trip. If the request has changed since (e.g. the sender unflipped or resent
+          it), it is retrieved again and the update retried.
+
+          @return True if the status was updated, False if there is no such request,
+                  None if the hub can't run scripts
+          @rtype Boolean or None
+        '''
+        key = hub_api.create_rocon_gateway_key(self._unique_gateway_name, 'flip_ins')
+        field = self._flip_in_field(registration.remote_gateway, registration.connection.rule)
+        self._flip_ins_lock.acquire()
+        flip_in = self._flip_ins_seen.get(field)
+        self._flip_ins_lock.release()
+        for unused_attempt in range(2):
+            if flip_in is None:
+                flip_in = self._redis_server.hget(key, field)
+                if flip_in is None:
+                    return False
+            try:
+                unused_cmd, unused_source, connection_list = utils.deserialize_request(flip_in, not self._compact)
+            except ValueError:
+                return False  # malformed, or pickled on a hub that no longer allows them
+            # The already encrypted connection of the request is reused as is
+            serialized_data = utils.serialize_connection_request(status,
+                                                                 registration.remote_gateway,
+                                                                 utils.get_connection_from_list(connection_list),
+                                                                 self._compact)
+            updated = self._run_flip_script('compare_and_set', self._unique_gateway_name,
+                                            registration.remote_gateway, field, flip_in, serialized_data)
+            if updated is None:
+                return None  # turns out the hub can't run scripts
+            if updated:
+                self._flip_ins_lock.acquire()
+                self._flip_ins_seen[field] = serialized_data
+                self._flip_ins_lock.release()
+                return True
+            flip_in = None  # changed since it was retrieved
+        return False
+
     def get_flip_request_status(self, remote_gateway, rule, source_gateway=None):
         '''
           Get the status of a flipped registration. If the flip request does not
@@ -660,10 +1886,23 @@ class GatewayHub(rocon_hub_client.Hub):
         '''
         if source_gateway is None:
             source_gateway = self._unique_gateway_name
-        key = hub_api.create_rocon_gateway_key(remote_gateway, 'flip_ins')
-        encoded_flips = self._redis_server.smembers(key)
+        if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+            key = hub_api.create_rocon_gateway_key(remote_gateway, 'flip_ins')
+            field = self._flip_in_field(source_gateway, rule)
+            flip = self._get_cached(remote_gateway, 'flip_ins', lambda: self._redis_reader.hget(key, field), field)
+            if flip is None:
+                return None
+            try:
+                cmd, unused_source, unused_connection_list = utils.deserialize_request(flip, not self._compact)
+            except ValueError:
+                return None  # malformed, or pickled on a hub that no longer allows them
+            return cmd
+        encoded_flips = self._get_cached(remote_gateway, 'flip_ins', lambda: self._get_flip_ins(remote_gateway))
         for flip in encoded_flips:
-            cmd, source, connection_list = utils.deserialize_request(flip)
+            try:
+                cmd, source, connection_list = utils.deserialize_request(flip, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             if source != source_gateway:
                 continue
             connection = utils.get_connection_from_list(connection_list)
@@ -704,57 +1943,68 @@ class GatewayHub(rocon_hub_client.Hub):
         source = hub_api.key_base_name(self._redis_keys['gateway'])
 
         # Encrypt the transmission
-        start_time = time.time()
-        while time.time() - start_time <= timeout:
-            remote_gateway_public_key_str = self._redis_server.get(
-                hub_api.create_rocon_gateway_key(remote_gateway, 'public_key'))
-            if remote_gateway_public_key_str is not None:
-                break
+        remote_gateway_public_key_str, remote_gateway_encryption = self._wait_for_public_key(remote_gateway, timeout)
         if remote_gateway_public_key_str is None:
             rospy.logerr("Gateway : flip to " + remote_gateway +
                          " failed as public key not found")
             return False
 
-        remote_gateway_public_key = utils.deserialize_key(remote_gateway_public_key_str)
-        encrypted_connection = utils.encrypt_connection(connection, remote_gateway_public_key)
+        encrypted_connection = self._encrypt_connection(remote_gateway, connection,
+                                                        remote_gateway_public_key_str,
+                                                        remote_gateway_encryption)
 
         # Send data
         serialized_data = utils.serialize_connection_request(
-            FlipStatus.PENDING, source, encrypted_connection)
-        self._redis_server.sadd(key, serialized_data)
+            FlipStatus.PENDING, source, encrypted_connection, self._compact)
+        self._change_lock.acquire()
+        self._flip_targets.add(remote_gateway)
+        self._change_lock.release()
+        if self._run_flip_script('set', remote_gateway, remote_gateway,
+                                 self._flip_in_field(source, connection.rule), serialized_data):
+            return True
+        pipe = self._redis_server.pipeline()
+        if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+            # replaces any previous request (and its status) for this rule
+            pipe.hset(key, self._flip_in_field(source, connection.rule), serialized_data)
+        else:
+            pipe.sadd(key, serialized_data)
+        change_notification = self._notify_change(pipe, remote_gateway, 'flip_ins')
+        self._push_flip_event(pipe, remote_gateway, remote_gateway)
+        pipe.execute()
+        self._note_change(change_notification)
         return True
 
     def send_unflip_request(self, remote_gateway, rule):
+        '''
+          Unflip a previously flipped registration. Actions are unflipped as the
+          topics they were flipped as.
+
+          @return True if the flip (any part of it for actions) existed and was removed
+          @rtype Boolean
+        '''
         if rule.type == gateway_msgs.ConnectionType.ACTION_CLIENT:
-            action_name = rule.name
-            rule.type = gateway_msgs.ConnectionType.PUBLISHER
-            rule.name = action_name + "/goal"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/cancel"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.type = gateway_msgs.ConnectionType.SUBSCRIBER
-            rule.name = action_name + "/feedback"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/status"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/result"
-            self._send_unflip_request(remote_gateway, rule)
+            rules = [gateway_msgs.Rule(gateway_msgs.ConnectionType.PUBLISHER, rule.name + "/goal", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.PUBLISHER, rule.name + "/cancel", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.SUBSCRIBER, rule.name + "/feedback", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.SUBSCRIBER, rule.name + "/status", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.SUBSCRIBER, rule.name + "/result", rule.node)]
         elif rule.type == gateway_msgs.ConnectionType.ACTION_SERVER:
-            action_name = rule.name
-            rule.type = gateway_msgs.ConnectionType.SUBSCRIBER
-            rule.name = action_name + "/goal"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/cancel"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.type = gateway_msgs.ConnectionType.PUBLISHER
-            rule.name = action_name + "/feedback"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/status"
-            self._send_unflip_request(remote_gateway, rule)
-            rule.name = action_name + "/result"
-            self._send_unflip_request(remote_gateway, rule)
+            rules = [gateway_msgs.Rule(gateway_msgs.ConnectionType.SUBSCRIBER, rule.name + "/goal", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.SUBSCRIBER, rule.name + "/cancel", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.PUBLISHER, rule.name + "/feedback", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.PUBLISHER, rule.name + "/status", rule.node),
+                     gateway_msgs.Rule(gateway_msgs.ConnectionType.PUBLISHER, rule.name + "/result", rule.node)]
         else:
-            self._send_unflip_request(remote_gateway, rule)
+            rules = [rule]
+        source = hub_api.key_base_name(self._redis_keys['gateway'])
+        deleted = self._run_flip_script('delete', remote_gateway, remote_gateway,
+                                        *[self._flip_in_field(source, r) for r in rules])
+        if deleted is not None:
+            return deleted > 0
+        unflipped = False
+        for r in rules:
+            unflipped = self._send_unflip_request(remote_gateway, r) or unflipped
+        return unflipped
 
     def _send_unflip_request(self, remote_gateway, rule):
         '''
@@ -766,12 +2016,30 @@ class GatewayHub(rocon_hub_client.Hub):
           @rtype Boolean
         '''
         key = hub_api.create_rocon_gateway_key(remote_gateway, 'flip_ins')
+        if self.schema_version >= hub_api.SCHEMA_KEYED_FLIP_INS:
+            field = self._flip_in_field(hub_api.key_base_name(self._redis_keys['gateway']), rule)
+            if not self._redis_server.hdel(key, field):
+                return False
+            pipe = self._redis_server.pipeline()
+            change_notification = self._notify_change(pipe, remote_gateway, 'flip_ins')
+            self._push_flip_event(pipe, remote_gateway, remote_gateway)
+            pipe.execute()
+            self._note_change(change_notification)
+            return True
         encoded_flip_ins = self._redis_server.smembers(key)
         for flip_in in encoded_flip_ins:
-            cmd, source, connection_list = utils.deserialize_request(flip_in)
+            try:
+                cmd, source, connection_list = utils.deserialize_request(flip_in, not self._compact)
+            except ValueError:
+                continue  # malformed, or pickled on a hub that no longer allows them
             connection = utils.get_connection_from_list(connection_list)
             if source == hub_api.key_base_name(self._redis_keys['gateway']) and \
                rule == connection.rule:
-                self._redis_server.srem(key, flip_in)
+                pipe = self._redis_server.pipeline()
+                pipe.srem(key, flip_in)
+                change_notification = self._notify_change(pipe, remote_gateway, 'flip_ins')
+                self._push_flip_event(pipe, remote_gateway, remote_gateway)
+                pipe.execute()
+                self._note_change(change_notification)
                 return True
         return False
@@ -7,9 +7,12 @@
 # Imports
 ##############################################################################
 
+import os
 import rospy
+import rospkg
 import rocon_gateway
 import uuid
+import yaml
 import gateway_msgs.msg as gateway_msgs
 import gateway_msgs.srv as gateway_srvs
 import std_msgs.msg as std_msgs
@@ -19,6 +22,7 @@ import rocon_hub_client
 
 from . import gateway
 from . import hub_manager
+from . import key_store
 
 ##############################################################################
 # Gateway Configuration and Main Loop Class
@@ -36,6 +40,11 @@ class GatewayNode():
 
     def __init__(self):
         self._param = rocon_gateway.setup_ros_parameters()
+        # get the (slow) rsa key generation going before we find any hubs
+        if self._param['persist_keys']:
+            key_store.start(os.path.join(rospkg.get_ros_home(), 'rocon', 'gateway', self._param['name'] + '.pem'))
+        else:
+            key_store.start()
         if self._param['disable_uuids']:
             self._unique_name = self._param['name']
             rospy.logwarn("Gateway : uuid's disabled, using possibly non-unique name [%s]" % self._unique_name)
@@ -47,7 +56,8 @@ class GatewayNode():
             rospy.loginfo("Gateway : generated unique hash name [%s]" % self._unique_name)
         self._hub_manager = hub_manager.HubManager(
             hub_whitelist=self._param['hub_whitelist'],
-            hub_blacklist=self._param['hub_blacklist']
+            hub_blacklist=self._param['hub_blacklist'],
+            hub_engine=self._param['hub_engine']
         )
         # Be careful of the construction sequence here, parts depend on others.
         self._gateway_publishers = self._setup_ros_publishers()
@@ -55,6 +65,9 @@ class GatewayNode():
         self._gateway = gateway.Gateway(self._hub_manager, self._param, self._unique_name, self._publish_gateway_info)
         self._gateway_services = self._setup_ros_services()  # Needs self._gateway
         self._gateway_subscribers = self._setup_ros_subscribers()  # Needs self._gateway
+        if self._param['hub_statistics_period'] > 0:
+            self._hub_statistics_timer = rospy.Timer(
+                rospy.Duration(self._param['hub_statistics_period']), self._publish_hub_statistics)
         # 'ip:port' : (error_code, error_code_str) dictionary of hubs that this gateway has tried to register,
         # but not been permitted (hub is not in whitelist, or is blacklisted)
         self._disallowed_hubs = {}
@@ -144,7 +157,8 @@ class GatewayNode():
                 self._unique_name,
                 self._disengage_hub,
                 self._gateway.ip,
-                existing_advertisements
+                existing_advertisements,
+                self._gateway.hub_change_notification
             )
         if hub:
             rospy.loginfo("Gateway : registering on the hub [%s]" % hub.name)
@@ -208,11 +222,14 @@ class GatewayNode():
             '~set_watcher_period',
             gateway_srvs.SetWatcherPeriod,
             self._gateway.ros_service_set_watcher_period)  # @IgnorePep8
+        gateway_services['reset_hub_statistics'] = rospy.Service(
+            '~reset_hub_statistics', std_srvs.Empty, self.ros_service_reset_hub_statistics)  # @IgnorePep8
         return gateway_services
 
     def _setup_ros_publishers(self):
         gateway_publishers = {}
         gateway_publishers['gateway_info'] = rospy.Publisher('~gateway_info', gateway_msgs.GatewayInfo, latch=True)
+        gateway_publishers['hub_statistics'] = rospy.Publisher('~hub_statistics', std_msgs.String, latch=True)
         return gateway_publishers
 
     def _setup_ros_subscribers(self):
@@ -229,6 +246,11 @@ class GatewayNode():
         self._shutdown()
         return std_srvs.EmptyResponse()
 
+    def ros_service_reset_hub_statistics(self, unused_request):
+        self._hub_manager.reset_hub_statistics()
+        self._publish_hub_statistics()
+        return std_srvs.EmptyResponse()
+
     def ros_service_connect_hub(self, request):
         '''
           Handle incoming requests to connect directly to a gateway hub.
@@ -269,11 +291,21 @@ class GatewayNode():
         except AttributeError:
             pass  # occurs if self._gateway is reset to None in the middle of all this.
 
+    def _publish_hub_statistics(self, unused_timer_event=None):
+        '''
+          Publish the per command hub statistics as yaml (std_msgs/String).
+        '''
+        statistics = self._hub_manager.get_hub_statistics()
+        self._gateway_publishers['hub_statistics'].publish(
+            std_msgs.String(yaml.safe_dump(statistics, default_flow_style=False)))
+
     def ros_service_remote_gateway_info(self, request):
         response = gateway_srvs.RemoteGatewayInfoResponse()
         requested_gateways = request.gateways if request.gateways else self._hub_manager.list_remote_gateway_names()
-        for gateway in list(set(requested_gateways)):
-            remote_gateway_info = self._hub_manager.remote_gateway_info(gateway)
+        requested_gateways = list(set(requested_gateways))
+        remote_gateways_info = self._hub_manager.remote_gateways_info(requested_gateways)
+        for gateway in requested_gateways:
+            remote_gateway_info = remote_gateways_info.get(gateway, None)
             if remote_gateway_info:
                 response.gateways.append(remote_gateway_info)
             else:
@@ -8,6 +8,7 @@
 ###############################################################################
 
 import threading
+import time
 
 import rospy
 import gateway_msgs.msg as gateway_msgs
@@ -15,7 +16,15 @@ import rocon_hub_client
 
 from .exceptions import GatewayUnavailableError
 from . import gateway_hub
-from . import utils
+from . import hub_workers
+
+##############################################################################
+# Constants
+##############################################################################
+
+# Maximum time (seconds) to wait for the hubs when running an operation on
+# all of them. Hubs that take longer are skipped (see HubManager._fan_out).
+HUB_OPERATION_TIMEOUT = 5.0
 
 ##############################################################################
 # Hub Manager
@@ -28,16 +37,92 @@ class HubManager(object):
     # Init & Shutdown
     ##########################################################################
 
-    def __init__(self, hub_whitelist, hub_blacklist):
+    def __init__(self, hub_whitelist, hub_blacklist, hub_engine=False):
+        '''
+          @param hub_engine : multiplex the hubs' read only traffic on a single
+                 rocon_hub_client.HubEngine rather than a connection pool per hub
+          @type bool
+        '''
         self._param = {}
         self._param['hub_whitelist'] = hub_whitelist
         self._param['hub_blacklist'] = hub_blacklist
         self.hubs = []
         self._hub_lock = threading.Lock()
+        self._workers = {}  # hub uri : hub_workers.HubWorker running the operations on that hub
+        self._engine = None
+        if hub_engine:
+            self._engine = rocon_hub_client.HubEngine()
+            self._engine.start()
 
     def shutdown(self):
-        for hub in self.hubs:
-            hub.unregister_gateway()
+        '''
+          Unregister from every hub. The unregistration is queued on the hub's
+          worker, behind the operations already queued there, so nothing
+          writes to the hub after the gateway's keys are removed.
+        '''
+        self._hub_lock.acquire()
+        try:
+            workers = [self._workers[hub.uri] for hub in self.hubs]
+        finally:
+            self._hub_lock.release()
+        unregistrations = []
+        for worker in workers:
+            unregistrations.append((worker.hub, worker.submit(lambda hub: hub.unregister_gateway())))
+            worker.shutdown()
+        deadline = time.time() + HUB_OPERATION_TIMEOUT
+        for hub, unregistration in unregistrations:
+            try:
+                unregistration.result(max(0.0, deadline - time.time()))
+            except hub_workers.HubOperationTimeoutError:
+                rospy.logwarn("Gateway : timed out unregistering from a hub [%s][%s]" % (hub.name, hub.uri))
+        if self._engine is not None:
+            self._engine.shutdown()
+
+    def _fan_out(self, operation, skip_degraded=True, raise_failures=False):
+        '''
+          Run an operation on all the hubs concurrently, each on its own worker
+          thread, and collect the results in the same (hub) order as iterating over
+          the hubs would. Hubs that don't finish within HUB_OPERATION_TIMEOUT, or
+          where the operation fails, are left out of the results, so one degraded
+          hub can't stall the gateway nor hide the other hubs' results.
+
+          @param operation : called as operation(hub)
+          @type function
+          @param skip_degraded : don't even queue the operation on hubs whose worker is
+                 stuck (see HubWorker.is_degraded). Modifications should still be queued
+                 so they are applied in order if the hub recovers.
+          @type bool
+          @param raise_failures : raise the first failure rather than logging it
+          @type bool
+          @return the hubs that finished in time with the results of the operation
+          @rtype list of (gateway_hub.GatewayHub, result)
+
+          @raise whatever the operation raised on the first hub to fail, if raise_failures
+        '''
+        self._hub_lock.acquire()
+        try:
+            workers = [self._workers[hub.uri] for hub in self.hubs]
+        finally:
+            self._hub_lock.release()
+        hub_operations = []
+        for worker in workers:
+            if skip_degraded and worker.is_degraded(HUB_OPERATION_TIMEOUT):
+                rospy.logwarn("Gateway : skipping a hub that is not responding [%s][%s]" %
+                              (worker.hub.name, worker.hub.uri))
+                continue
+            hub_operations.append((worker.hub, worker.submit(operation)))
+        deadline = time.time() + HUB_OPERATION_TIMEOUT
+        results = []
+        for hub, hub_operation in hub_operations:
+            try:
+                results.append((hub, hub_operation.result(max(0.0, deadline - time.time()))))
+            except hub_workers.HubOperationTimeoutError:
+                rospy.logwarn("Gateway : timed out waiting for a hub [%s][%s]" % (hub.name, hub.uri))
+            except Exception as e:
+                if raise_failures:
+                    raise
+                rospy.logwarn("Gateway : hub operation failed [%s][%s][%s]" % (hub.name, hub.uri, str(e)))
+        return results
 
     def is_connected(self):
         return True if self.hubs else False
@@ -56,10 +141,8 @@ class HubManager(object):
           @rtype list of str
         '''
         remote_gateway_names = []
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            remote_gateway_names.extend(hub.list_remote_gateway_names())
-        self._hub_lock.release()
+        for unused_hub, hub_remote_gateway_names in self._fan_out(lambda hub: hub.list_remote_gateway_names()):
+            remote_gateway_names.extend(hub_remote_gateway_names)
         # return the list without duplicates
         return list(set(remote_gateway_names))
 
@@ -73,14 +156,12 @@ class HubManager(object):
           where the hub list is a list of actual hub object references.
         '''
         dic = {}
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            for remote_gateway in hub.list_remote_gateway_names():
+        for hub, remote_gateway_names in self._fan_out(lambda hub: hub.list_remote_gateway_names()):
+            for remote_gateway in remote_gateway_names:
                 if remote_gateway in dic:
                     dic[remote_gateway].append(hub)
                 else:
                     dic[remote_gateway] = [hub]
-        self._hub_lock.release()
         return dic
 
     def get_flip_requests(self):
@@ -91,32 +172,32 @@ class HubManager(object):
           @rtype list of utils.Registration
         '''
         registrations = []
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            registrations.extend(hub.get_unblocked_flipped_in_connections())
-        self._hub_lock.release()
+        for unused_hub, hub_registrations in self._fan_out(lambda hub: hub.get_unblocked_flipped_in_connections()):
+            registrations.extend(hub_registrations)
         return registrations
 
-    def remote_gateway_info(self, remote_gateway_name):
+    def remote_gateways_info(self, remote_gateway_names):
         '''
-          Return information that a remote gateway has posted on the hub(s).
+          Return information that a list of remote gateways have posted on the hub(s).
+          Each hub is queried once (pipelined) for all of the gateways it knows about,
+          the first hub (in hub order) with information on a gateway wins.
 
-          @param remote_gateway_name : the hash name for the remote gateway
-          @type str
+          @param remote_gateway_names : the hash names for the remote gateways
+          @type list of str
 
-          @return remote gateway information
-          @rtype gateway_msgs.RemotGateway or None
+          @return remote gateway information for the gateways that could be found
+          @rtype dict of str : gateway_msgs.RemoteGateway
         '''
-        remote_gateway_info = None
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            if remote_gateway_name in hub.list_remote_gateway_names():
-                # I don't think we need more than one hub's info....
-                remote_gateway_info = hub.remote_gateway_info(remote_gateway_name)
-                if remote_gateway_info is not None:
-                    break
-        self._hub_lock.release()
-        return remote_gateway_info
+        def hub_remote_gateways_info(hub):
+            hub_remote_gateway_names = hub.list_remote_gateway_names()
+            names = [name for name in remote_gateway_names if name in hub_remote_gateway_names]
+            return zip(names, hub.remote_gateways_info(names)) if names else []
+        remote_gateways_info = {}
+        for unused_hub, hub_remote_gateways_info in self._fan_out(hub_remote_gateways_info):
+            for name, remote_gateway_info in hub_remote_gateways_info:
+                if remote_gateway_info is not None and name not in remote_gateways_info:
+                    remote_gateways_info[name] = remote_gateway_info
+        return remote_gateways_info
 
     def get_remote_gateway_firewall_flag(self, remote_gateway_name):
         '''
@@ -129,18 +210,18 @@ class HubManager(object):
                   gateway information cannot found
           @rtype Bool
         '''
-        firewall_flag = None
-        self._hub_lock.acquire()
-        for hub in self.hubs:
+        def hub_firewall_flag(hub):
             if remote_gateway_name in hub.list_remote_gateway_names():
-                # I don't think we need more than one hub's info....
                 try:
-                    firewall_flag = hub.get_remote_gateway_firewall_flag(remote_gateway_name)
-                    break
+                    return hub.get_remote_gateway_firewall_flag(remote_gateway_name)
                 except GatewayUnavailableError:
-                    pass  # cycle through the other hubs looking as well.
-        self._hub_lock.release()
-        return firewall_flag
+                    pass  # look on the other hubs as well.
+            return None
+        # I don't think we need more than one hub's info....
+        for unused_hub, firewall_flag in self._fan_out(hub_firewall_flag):
+            if firewall_flag is not None:
+                return firewall_flag
+        return None
 
     def send_unflip_request(self, remote_gateway_name, remote_rule):
         '''
@@ -156,16 +237,13 @@ class HubManager(object):
           @param remote_rule : the remote rule to unflip
           @type gateway_msgs.RemoteRule
         '''
-        self._hub_lock.acquire()
-        for hub in self.hubs:
+        def hub_send_unflip_request(hub):
             if remote_gateway_name in hub.list_remote_gateway_names():
                 try:
-                    if hub.send_unflip_request(remote_gateway_name, remote_rule):
-                        self._hub_lock.release()
-                        return
+                    hub.send_unflip_request(remote_gateway_name, remote_rule)
                 except GatewayUnavailableError:
-                    pass  # cycle through the other hubs looking as well.
-        self._hub_lock.release()
+                    pass  # it has gone from this hub meanwhile, the other hubs are tried as well.
+        self._fan_out(hub_send_unflip_request, skip_degraded=False)
 
     ##########################################################################
     # Hub Connections
@@ -178,7 +256,8 @@ class HubManager(object):
                        gateway_unique_name,
                        gateway_disengage_hub,  # hub connection lost hook
                        gateway_ip,
-                       existing_advertisements
+                       existing_advertisements,
+                       gateway_hub_change_hook=None
                        ):
         '''
           Attempts to make a connection and register the gateway with a hub.
@@ -195,6 +274,8 @@ class HubManager(object):
           @param gateway_ip
           @param existing advertisements
           @type { utils.ConnectionTypes : utils.Connection[] }
+          @param gateway_hub_change_hook : called when the hub notifies changes the gateway should act on
+          @type method : Gateway.hub_change_notification()
 
           @return an integer indicating error (important for the service call)
           @rtype gateway_msgs.ErrorCodes
@@ -202,28 +283,35 @@ class HubManager(object):
           @raise
         '''
         try:
-            new_hub = gateway_hub.GatewayHub(ip, port, self._param['hub_whitelist'], self._param['hub_blacklist'])
+            new_hub = gateway_hub.GatewayHub(ip, port, self._param['hub_whitelist'], self._param['hub_blacklist'],
+                                             engine=self._engine)
         except rocon_hub_client.HubError as e:
             return None, e.id, str(e)
         already_exists_error = False
         self._hub_lock.acquire()
-        for hub in self.hubs:
-            if hub == new_hub:
-                already_exists_error = True
-                break
-        self._hub_lock.release()
+        try:
+            for hub in self.hubs:
+                if hub == new_hub:
+                    already_exists_error = True
+                    break
+        finally:
+            self._hub_lock.release()
         if not already_exists_error:
-            self._hub_lock.acquire()
             new_hub.register_gateway(firewall_flag,
                                      gateway_unique_name,
                                      gateway_disengage_hub,  # hub connection lost hook
                                      gateway_ip,
+                                     gateway_hub_change_hook
                                      )
-            for connection_type in utils.connection_types:
-                for advertisement in existing_advertisements[connection_type]:
-                    new_hub.advertise(advertisement)
-            self.hubs.append(new_hub)
-            self._hub_lock.release()
+            # under the lock, so advertisement updates either precede the sync or include the new hub
+            self._hub_lock.acquire()
+            try:
+                new_hub.sync_advertisements(existing_advertisements)
+                self.hubs.append(new_hub)
+                self._workers[new_hub.uri] = hub_workers.HubWorker(new_hub)
+                self._workers[new_hub.uri].start()
+            finally:
+                self._hub_lock.release()
             return new_hub, gateway_msgs.ErrorCodes.SUCCESS, "success"
         else:
             return None, gateway_msgs.ErrorCodes.HUB_CONNECTION_ALREADY_EXISTS, "already connected to this hub"
@@ -239,23 +327,32 @@ class HubManager(object):
         # Could dig in and find the name here, but not worth the bother.
         hub_to_be_disengaged.disconnect()  # necessary to kill failing socket receives
         self._hub_lock.acquire()
-        if hub_to_be_disengaged in self.hubs:
-            rospy.loginfo("Gateway : lost connection to the hub [%s][%s]" % (
-                hub_to_be_disengaged.name, hub_to_be_disengaged.uri))
-            self.hubs[:] = [hub for hub in self.hubs if hub != hub_to_be_disengaged]
-        self._hub_lock.release()
-
-    def advertise(self, connection):
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            hub.advertise(connection)
-        self._hub_lock.release()
+        try:
+            if hub_to_be_disengaged in self.hubs:
+                rospy.loginfo("Gateway : lost connection to the hub [%s][%s]" % (
+                    hub_to_be_disengaged.name, hub_to_be_disengaged.uri))
+                self.hubs[:] = [hub for hub in self.hubs if hub != hub_to_be_disengaged]
+                self._workers.pop(hub_to_be_disengaged.uri).shutdown()
+        finally:
+            self._hub_lock.release()
 
-    def unadvertise(self, connection):
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            hub.unadvertise(connection)
-        self._hub_lock.release()
+    def update_advertisements(self, added, removed):
+        '''
+          Add and remove several connections to/from the public interface on
+          every hub, a single round trip per hub.
+
+          @param added : connections to advertise
+          @type list of utils.Connection
+          @param removed : connections to unadvertise
+          @type list of utils.Connection
+          @return the connections that failed on each hub, with the reason
+          @rtype list of (gateway_hub.GatewayHub, utils.Connection, Exception)
+        '''
+        failures = []
+        for hub, hub_failures in self._fan_out(lambda hub: hub.update_advertisements(added, removed),
+                                               skip_degraded=False, raise_failures=True):
+            failures.extend((hub, connection, error) for connection, error in hub_failures)
+        return failures
 
     def match_remote_gateway_name(self, remote_gateway_name):
         '''
@@ -264,11 +361,11 @@ class HubManager(object):
         '''
         matches = []
         weak_matches = []  # doesn't match any hash names, but matches a base name
-        self._hub_lock.acquire()
-        for hub in self.hubs:
-            matches.extend(hub.matches_remote_gateway_name(remote_gateway_name))
-            weak_matches.extend(hub.matches_remote_gateway_basename(remote_gateway_name))
-        self._hub_lock.release()
+        for unused_hub, (hub_matches, hub_weak_matches) in self._fan_out(
+                lambda hub: (hub.matches_remote_gateway_name(remote_gateway_name),
+                             hub.matches_remote_gateway_basename(remote_gateway_name))):
+            matches.extend(hub_matches)
+            weak_matches.extend(hub_weak_matches)
         # these are hash name lists, make sure they didn't pick up matches for a single hash name from multiple hubs
         matches = list(set(matches))
         weak_matches = list(set(weak_matches))
@@ -281,7 +378,25 @@ class HubManager(object):
           @param statistics
           @type gateway_msgs.ConnectionStatistics
         '''
+        self._fan_out(lambda hub: hub.publish_network_statistics(statistics))
+
+    def get_hub_statistics(self):
+        '''
+          Statistics for the commands sent to each hub (see rocon_hub_client.HubStatistics).
+
+          @return statistics keyed by hub name and uri
+          @rtype dict
+        '''
         self._hub_lock.acquire()
-        for hub in self.hubs:
-            hub.publish_network_statistics(statistics)
-        self._hub_lock.release()
+        try:
+            return dict(('%s [%s]' % (hub.name, hub.uri), hub.statistics.snapshot()) for hub in self.hubs)
+        finally:
+            self._hub_lock.release()
+
+    def reset_hub_statistics(self):
+        self._hub_lock.acquire()
+        try:
+            for hub in self.hubs:
+                hub.statistics.reset()
+        finally:
+            self._hub_lock.release()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+
+'''
+  Worker threads running operations on hubs, one per hub, so that operations
+  on several hubs run concurrently and a slow (or half dead) hub only delays
+  its own operations.
+'''
+
+###############################################################################
+# Imports
+###############################################################################
+
+import Queue
+import sys
+import threading
+import time
+
+###############################################################################
+# Operations
+###############################################################################
+
+
+class HubOperationTimeoutError(Exception):
+    pass
+
+
+class HubOperation(object):
+    '''
+      An operation queued on a hub worker, i.e. a function called with the hub
+      as its first argument. Wait on it with result().
+    '''
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self, hub):
+        try:
+            self._result = self.function(hub, *self.args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def result(self, timeout=None):
+        '''
+          Wait for the operation to finish.
+
+          @param timeout : maximum time to wait (seconds), None to wait forever
+          @type float
+          @return whatever the operation returned
+
+          @raise HubOperationTimeoutError if it didn't finish in time
+          @raise whatever the operation raised
+        '''
+        if not self._done.wait(timeout):
+            raise HubOperationTimeoutError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+###############################################################################
+# Worker
+###############################################################################
+
+
+class HubWorker(threading.Thread):
+    '''
+      Runs the operations queued for a single hub, in order.
+    '''
+
+    def __init__(self, hub):
+        threading.Thread.__init__(self, name='hub_worker_' + hub.uri)
+        self.daemon = True
+        self.hub = hub
+        self._queue = Queue.Queue()
+        self._busy_since = None  # start time of the operation being run
+
+    def submit(self, function, *args):
+        '''
+          Queue an operation on the hub.
+
+          @param function : called as function(hub, *args)
+          @type function
+          @return the queued operation
+          @rtype HubOperation
+        '''
+        operation = HubOperation(function, args)
+        self._queue.put(operation)
+        return operation
+
+    def is_degraded(self, timeout):
+        '''
+          A hub is degraded if its worker has been stuck on an operation for longer
+          than the timeout - anything queued behind it would only time out as well.
+
+          @param timeout : seconds
+          @type float
+          @rtype bool
+        '''
+        busy_since = self._busy_since
+        return busy_since is not None and time.time() - busy_since > timeout
+
+    def shutdown(self):
+        '''
+          Stop once the operations already queued have run.
+        '''
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                break
+            self._busy_since = time.time()
+            operation.run(self.hub)
+            self._busy_since = None
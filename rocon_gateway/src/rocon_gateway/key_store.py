@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+
+'''
+  The gateway's rsa key pair. RSA key generation takes seconds on embedded
+  cpus, so the key pair is generated (or loaded) only once per process, in
+  the background, and shared by every hub connection.
+'''
+
+###############################################################################
+# Imports
+###############################################################################
+
+import os
+import stat
+import threading
+
+import rospy
+
+from . import utils
+
+###############################################################################
+# Key Store
+###############################################################################
+
+_lock = threading.Lock()
+_thread = None
+_keys = None  # (private key, public key)
+
+
+def start(filename=None):
+    '''
+      Start loading/generating the key pair in the background. Does nothing
+      if it has already been started.
+
+      @param filename : file to load the private key from. If it doesn't exist,
+             the generated key is saved there (readable only by the owner). If None,
+             the key pair lives only as long as the process.
+      @type str
+    '''
+    global _thread
+    _lock.acquire()
+    if _thread is None:
+        _thread = threading.Thread(target=_load_or_generate, args=(filename,))
+        _thread.daemon = True
+        _thread.start()
+    _lock.release()
+
+
+def get_private_public_key():
+    '''
+      Retrieve the key pair, waiting for it to be loaded/generated if need be
+      (starting the generation if nobody has yet).
+
+      @return private key, public key
+      @rtype (RSA key object, RSA key object)
+    '''
+    start()
+    _thread.join()
+    return _keys
+
+
+def _load_or_generate(filename):
+    global _keys
+    if filename is not None and os.path.exists(filename):
+        try:
+            _keys = _load(filename)
+            rospy.loginfo("Gateway : loaded the rsa key pair [%s]" % filename)
+            return
+        except (IOError, OSError, ValueError, IndexError, TypeError) as e:
+            rospy.logwarn("Gateway : ignoring unusable rsa key file [%s][%s]" % (filename, str(e)))
+            filename = None  # don't overwrite it
+    private_key, public_key = utils.generate_private_public_key()
+    _keys = (private_key, public_key)
+    if filename is not None:
+        try:
+            _save(filename, private_key)
+            rospy.loginfo("Gateway : saved a new rsa key pair [%s]" % filename)
+        except (IOError, OSError) as e:
+            rospy.logwarn("Gateway : failed to save the rsa key pair [%s][%s]" % (filename, str(e)))
+
+
+def _load(filename):
+    '''
+      @raise IOError, OSError if the file can't be read
+      @raise ValueError if it can be read by anyone other than its owner, or isn't a private key
+    '''
+    mode = os.stat(filename).st_mode
+    if mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise ValueError("permissions are too open, should be readable by the owner only (0600)")
+    with open(filename, 'r') as f:
+        private_key = utils.deserialize_key(f.read())
+    if not private_key.has_private():
+        raise ValueError("not a private key")
+    return private_key, private_key.publickey()
+
+
+def _save(filename, private_key):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    # create it with owner only permissions from the start, not chmod afterwards
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(utils.serialize_key(private_key))
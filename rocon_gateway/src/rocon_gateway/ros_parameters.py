@@ -42,6 +42,9 @@ def setup_ros_parameters():
     # Used to block/permit remote gateway's from flipping to this gateway.
     param['firewall'] = rospy.get_param('~firewall', True)
 
+    # Keep the rsa key pair in the ros home directory so it needn't be regenerated on every start
+    param['persist_keys'] = rospy.get_param('~persist_keys', False)
+
     # The gateway can automagically detect zeroconf, but sometimes you want to force it off
     param['disable_zeroconf'] = rospy.get_param('~disable_zeroconf', False)
 
@@ -67,6 +70,12 @@ def setup_ros_parameters():
     param['external_shutdown'] = rospy.get_param('~external_shutdown', False)
     param['external_shutdown_timeout'] = rospy.get_param('~external_shutdown_timeout', 15)  # seconds
 
+    # Period for publishing the per command hub statistics (latencies, payload sizes), 0 to disable
+    param['hub_statistics_period'] = rospy.get_param('~hub_statistics_period', 10.0)  # seconds
+
+    # Multiplex the read only traffic to all the hubs on a single thread (rocon_hub_client.HubEngine)
+    param['hub_engine'] = rospy.get_param('~hub_engine', False)
+
     return param
 
 
@@ -12,8 +12,12 @@ import copy
 import cPickle as pickle
 #import simplejson as json
 import os
+import struct
 
 from Crypto.PublicKey import RSA
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import HMAC, SHA256
+from Crypto.Util import Counter
 import Crypto.Util.number as CUN
 
 from gateway_msgs.msg import Rule, ConnectionType
@@ -172,27 +176,183 @@ class Registration():
 #         return data
 #
 
-def serialize(data):
+##########################################################################
+# Wire Format
+##########################################################################
+#
+# Compact, versioned encoding of the (flat) lists we store on the hub:
+#
+#   magic (2) | version (1) | layout (1) | number of fields (4) | layout specific
+#
+# Layouts
+#
+#   STRINGS : every field is a str (e.g. connections, the fast path)
+#             field lengths (4 each) | concatenated fields
+#   TAGGED  : str, unicode, int, long, float, bool or None fields
+#             for each field - type tag (1) | length (4) | value
+#
+# All integers are unsigned, network byte order. Pickles never start with a
+# zero byte, so both formats can be read while migrating.
+
+WIRE_FORMAT_MAGIC = '\x00W'
+WIRE_FORMAT_VERSION = 1
+WIRE_FORMAT_STRINGS = 's'
+WIRE_FORMAT_TAGGED = 't'
+_wire_format_header = WIRE_FORMAT_MAGIC + chr(WIRE_FORMAT_VERSION)
+_wire_format_layout_offset = len(_wire_format_header)
+_wire_format_count_offset = _wire_format_layout_offset + 1
+_wire_format_count = struct.Struct('!I')
+_wire_format_tagged_field = struct.Struct('!cI')
+_wire_format_lengths = {}  # number of fields : struct.Struct
+
+
+def _wire_format_lengths_struct(number_of_fields):
+    try:
+        return _wire_format_lengths[number_of_fields]
+    except KeyError:
+        lengths_struct = struct.Struct('!%dI' % number_of_fields)
+        if number_of_fields <= 16:  # only bother keeping the usual suspects
+            _wire_format_lengths[number_of_fields] = lengths_struct
+        return lengths_struct
+
+
+def _encode_tagged_field(value):
+    # bool before int, it's a subclass
+    if isinstance(value, str):
+        return 's', value
+    elif isinstance(value, unicode):
+        return 'u', value.encode('utf-8')
+    elif value is None:
+        return 'n', ''
+    elif isinstance(value, bool):
+        return 'b', '1' if value else '0'
+    elif isinstance(value, (int, long)):
+        return 'i', str(value)
+    elif isinstance(value, float):
+        return 'f', repr(value)
+    raise ValueError("wire format can't encode values of type %s" % type(value))
+
+
+_tagged_field_decoders = {'s': lambda value: value,
+                          'u': lambda value: value.decode('utf-8'),
+                          'n': lambda value: None,
+                          'b': lambda value: value == '1',
+                          'i': int,
+                          'f': float
+                          }
+
+
+def encode(fields):
+    '''
+      Encode a flat list in the compact wire format.
+
+      @param fields : values to encode
+      @type list of str, unicode, int, long, float, bool or None
+      @return the encoded list
+      @rtype str
+
+      @raise ValueError if a value can't be encoded
+    '''
+    if all(type(field) is str for field in fields):
+        return (_wire_format_header + WIRE_FORMAT_STRINGS + _wire_format_count.pack(len(fields)) +
+                _wire_format_lengths_struct(len(fields)).pack(*[len(field) for field in fields]) +
+                ''.join(fields))
+    parts = [_wire_format_header, WIRE_FORMAT_TAGGED, _wire_format_count.pack(len(fields))]
+    for field in fields:
+        tag, value = _encode_tagged_field(field)
+        parts.append(_wire_format_tagged_field.pack(tag, len(value)))
+        parts.append(value)
+    return ''.join(parts)
+
+
+def decode(data):
+    '''
+      Decode a list encoded in the compact wire format.
+
+      @param data : as returned by encode
+      @type str
+      @return the decoded list
+      @rtype list
+
+      @raise ValueError if the data is malformed or of an unknown version
+    '''
+    if not data.startswith(_wire_format_header):
+        raise ValueError("not wire format data, or an unsupported version")
+    layout = data[_wire_format_layout_offset:_wire_format_count_offset]
+    fields = []
+    try:
+        number_of_fields, = _wire_format_count.unpack_from(data, _wire_format_count_offset)
+        offset = _wire_format_count_offset + _wire_format_count.size
+        if number_of_fields * 4 > len(data) - offset:  # every field needs at least a 4 byte length
+            raise ValueError("malformed wire format data [too many fields]")
+        if layout == WIRE_FORMAT_STRINGS:
+            lengths_struct = _wire_format_lengths_struct(number_of_fields)
+            lengths = lengths_struct.unpack_from(data, offset)
+            offset += lengths_struct.size
+            for length in lengths:
+                end = offset + length
+                fields.append(data[offset:end])
+                offset = end
+        elif layout == WIRE_FORMAT_TAGGED:
+            for unused_i in xrange(number_of_fields):
+                tag, length = _wire_format_tagged_field.unpack_from(data, offset)
+                offset += _wire_format_tagged_field.size
+                end = offset + length
+                fields.append(_tagged_field_decoders[tag](data[offset:end]))
+                offset = end
+        else:
+            raise ValueError("unknown wire format layout [%r]" % layout)
+    except (struct.error, KeyError, UnicodeDecodeError) as e:
+        raise ValueError("malformed wire format data [%s]" % str(e))
+    if offset != len(data):
+        raise ValueError("malformed wire format data [length mismatch]")
+    return fields
+
+
+def serialize(data, compact=False):
+    '''
+      @param data : flat list to serialize
+      @param compact : use the compact wire format rather than pickle
+      @type bool
+    '''
+    if compact:
+        return encode(data)
     # return json.dumps(data)
     return pickle.dumps(data)
 
 
-def deserialize(str_msg):
+def deserialize(str_msg, allow_pickle=True):
+    '''
+      Deserialize data in either the compact wire format or pickled.
+
+      @param allow_pickle : accept pickled data (unsafe, pickles can execute code)
+      @type bool
+
+      @raise ValueError if the data is malformed (or pickled when not allowed)
+    '''
+    if str_msg.startswith(WIRE_FORMAT_MAGIC):
+        return decode(str_msg)
+    if not allow_pickle:
+        raise ValueError("refusing to unpickle data")
     # return convert(json.loads(str_msg))
-    return pickle.loads(str_msg)
+    try:
+        return pickle.loads(str_msg)
+    except Exception as e:  # cPickle raises all sorts for garbage, e.g. BadPickleGet, EOFError, IndexError
+        raise ValueError("malformed pickle [%s]" % str(e))
 
 
-def serialize_connection(connection):
+def serialize_connection(connection, compact=False):
     return serialize([connection.rule.type,
                       connection.rule.name,
                       connection.rule.node,
                       connection.type_info,
-                      connection.xmlrpc_uri]
+                      connection.xmlrpc_uri],
+                     compact
                      )
 
 
-def deserialize_connection(connection_str):
-    deserialized_list = deserialize(connection_str)
+def deserialize_connection(connection_str, allow_pickle=True):
+    deserialized_list = deserialize(connection_str, allow_pickle)
     rule = Rule(deserialized_list[0],
                 deserialized_list[1],
                 deserialized_list[2]
@@ -200,22 +360,23 @@ def deserialize_connection(connection_str):
     return Connection(rule, deserialized_list[3], deserialized_list[4])
 
 
-def serialize_connection_request(command, source, connection):
+def serialize_connection_request(command, source, connection, compact=False):
     return serialize([command, source,
                       connection.rule.type,
                       connection.rule.name,
                       connection.rule.node,
                       connection.type_info,
-                      connection.xmlrpc_uri]
+                      connection.xmlrpc_uri],
+                     compact
                      )
 
 
-def serialize_rule_request(command, source, rule):
-    return serialize([command, source, rule.type, rule.name, rule.node])
+def serialize_rule_request(command, source, rule, compact=False):
+    return serialize([command, source, rule.type, rule.name, rule.node], compact)
 
 
-def deserialize_request(request_str):
-    deserialized_list = deserialize(request_str)
+def deserialize_request(request_str, allow_pickle=True):
+    deserialized_list = deserialize(request_str, allow_pickle)
     return deserialized_list[0], deserialized_list[1], deserialized_list[2:]
 
 
@@ -233,6 +394,15 @@ def get_rule_from_list(rule_argument_list):
 
 MAX_PLAINTEXT_LENGTH = 256
 
+# Hybrid encryption - an RSA (OAEP) wrapped session key, shared per pair of
+# gateways, keys AES-128-CTR encryption and a HMAC-SHA256 tag (encrypt-then-mac)
+# for each field. Hybrid ciphertexts start with this marker, raw RSA (legacy)
+# ciphertexts never start with a zero byte.
+HYBRID_ENCRYPTION_MAGIC = '\x00rh1'
+SESSION_KEY_LENGTH = 32  # 16 bytes for AES-128, 16 bytes for HMAC-SHA256
+HYBRID_NONCE_LENGTH = 8
+HYBRID_MAC_LENGTH = 32
+
 
 def generate_private_public_key():
     key = RSA.generate(8 * MAX_PLAINTEXT_LENGTH)
@@ -251,7 +421,7 @@ def serialize_key(key):
 def encrypt(plaintext, public_key):
     if len(plaintext) > MAX_PLAINTEXT_LENGTH:
         # TODO need to have arbitrary lengths
-        raise ValueError('Trying to encrypt text longer than ' + MAX_PLAINTEXT_LENGTH + ' bytes!')
+        raise ValueError('Trying to encrypt text longer than ' + str(MAX_PLAINTEXT_LENGTH) + ' bytes!')
     K = CUN.getRandomNumber(128, os.urandom)  # Not used, legacy compatibility
     ciphertext = public_key.encrypt(plaintext, K)
     return ciphertext[0]
@@ -276,6 +446,108 @@ def encrypt_connection(connection, key):
     encrypted_connection.xmlrpc_uri = encrypt(connection.xmlrpc_uri, key)
     return encrypted_connection
 
+
+def generate_session_key(public_key):
+    '''
+      Generate a symmetric session key for hybrid encryption along with
+      its RSA wrapped form that only the owner of the public key can open.
+
+      @param public_key : public key of the receiving gateway
+      @type RSA key object
+      @return session key, wrapped session key
+      @rtype (str, str)
+    '''
+    session_key = os.urandom(SESSION_KEY_LENGTH)
+    return session_key, PKCS1_OAEP.new(public_key).encrypt(session_key)
+
+
+def unwrap_session_key(wrapped_session_key, private_key):
+    '''
+      @raise ValueError if the session key wasn't wrapped with our public key
+    '''
+    return PKCS1_OAEP.new(private_key).decrypt(wrapped_session_key)
+
+
+def is_hybrid_ciphertext(ciphertext):
+    return ciphertext.startswith(HYBRID_ENCRYPTION_MAGIC)
+
+
+def get_wrapped_session_key(ciphertext):
+    '''
+      Extract the wrapped session key embedded in a hybrid ciphertext.
+
+      @raise ValueError if the ciphertext is malformed
+    '''
+    offset = len(HYBRID_ENCRYPTION_MAGIC)
+    try:
+        length, = struct.unpack('!H', ciphertext[offset:offset + 2])
+    except struct.error:
+        raise ValueError('truncated hybrid ciphertext')
+    wrapped_session_key = ciphertext[offset + 2:offset + 2 + length]
+    if len(wrapped_session_key) != length:
+        raise ValueError('truncated hybrid ciphertext')
+    return wrapped_session_key
+
+
+def _hybrid_cipher(session_key, nonce):
+    counter = Counter.new(64, prefix=nonce, initial_value=0)
+    return AES.new(session_key[:16], AES.MODE_CTR, counter=counter)
+
+
+def _hybrid_mac(session_key, data):
+    return HMAC.new(session_key[16:], data, SHA256).digest()
+
+
+def hybrid_encrypt(plaintext, session_key, wrapped_session_key):
+    '''
+      Encrypt (and authenticate) a string of any length with a session key.
+      The wrapped session key is embedded so the receiver can recover the
+      session key (once, it can cache it thereafter).
+
+      @param plaintext : string to encrypt
+      @type str
+      @param session_key, wrapped_session_key : as returned by generate_session_key
+      @type str
+      @return the hybrid ciphertext
+      @rtype str
+    '''
+    nonce = os.urandom(HYBRID_NONCE_LENGTH)
+    data = (HYBRID_ENCRYPTION_MAGIC + struct.pack('!H', len(wrapped_session_key)) + wrapped_session_key +
+            nonce + _hybrid_cipher(session_key, nonce).encrypt(plaintext))
+    return data + _hybrid_mac(session_key, data)
+
+
+def hybrid_decrypt(ciphertext, session_key):
+    '''
+      Decrypt a hybrid ciphertext, verifying it hasn't been tampered with.
+
+      @param ciphertext : as returned by hybrid_encrypt
+      @type str
+      @param session_key : the unwrapped session key embedded in the ciphertext
+      @type str
+      @return the plaintext
+      @rtype str
+
+      @raise ValueError if the ciphertext is malformed or fails authentication
+    '''
+    offset = len(HYBRID_ENCRYPTION_MAGIC) + 2 + len(get_wrapped_session_key(ciphertext))
+    if len(ciphertext) < offset + HYBRID_NONCE_LENGTH + HYBRID_MAC_LENGTH:
+        raise ValueError('truncated hybrid ciphertext')
+    data, mac = ciphertext[:-HYBRID_MAC_LENGTH], ciphertext[-HYBRID_MAC_LENGTH:]
+    expected_mac = _hybrid_mac(session_key, data)
+    # constant time comparison
+    if len(mac) != len(expected_mac) or reduce(lambda x, y: x | y, [ord(a) ^ ord(b) for a, b in zip(mac, expected_mac)]):
+        raise ValueError('hybrid ciphertext failed authentication')
+    nonce = data[offset:offset + HYBRID_NONCE_LENGTH]
+    return _hybrid_cipher(session_key, nonce).decrypt(data[offset + HYBRID_NONCE_LENGTH:])
+
+
+def hybrid_encrypt_connection(connection, session_key, wrapped_session_key):
+    encrypted_connection = copy.deepcopy(connection)
+    encrypted_connection.type_info = hybrid_encrypt(connection.type_info, session_key, wrapped_session_key)
+    encrypted_connection.xmlrpc_uri = hybrid_encrypt(connection.xmlrpc_uri, session_key, wrapped_session_key)
+    return encrypted_connection
+
 ##########################################################################
 # Regex
 ##########################################################################
@@ -9,6 +9,7 @@
 
 import httplib
 import rospy
+import threading
 import time
 
 ##############################################################################
@@ -24,7 +25,7 @@ class WatcherThread(object):
     '''
 
     def __init__(self, gateway, watch_loop_period):
-        self.trigger_update = False
+        self._trigger_update = threading.Event()
         self._trigger_shutdown = False
         self._gateway = gateway
         self._master = gateway.master
@@ -37,6 +38,21 @@ class WatcherThread(object):
         self._last_loop_timestamp = time.time()
         self._internal_sleep_period = 0.2  # 200ms
 
+    def _get_trigger_update(self):
+        return self._trigger_update.is_set()
+
+    def _set_trigger_update(self, value):
+        '''
+          Setting this wakes the watcher immediately (it may be set from any
+          thread, e.g. by hub change notifications).
+        '''
+        if value:
+            self._trigger_update.set()
+        else:
+            self._trigger_update.clear()
+
+    trigger_update = property(_get_trigger_update, _set_trigger_update)
+
     def set_watch_loop_period(self, period):
         '''
           This is used via the gateway node service to configure the rate of the
@@ -84,8 +100,10 @@ class WatcherThread(object):
           Internal non-interruptible sleep loop to check for shutdown and update triggers.
           This lets us set a really long watch_loop update if we wish.
         '''
-        while (not rospy.is_shutdown() and not self.trigger_update and
-               (time.time() - self._last_loop_timestamp < self._watch_loop_period)):
-            rospy.rostime.wallsleep(self._internal_sleep_period)
+        while not rospy.is_shutdown() and not self.trigger_update:
+            remaining_time = self._watch_loop_period - (time.time() - self._last_loop_timestamp)
+            if remaining_time <= 0.0:
+                break
+            self._trigger_update.wait(min(self._internal_sleep_period, remaining_time))
         self.trigger_update = False
         self._last_loop_timestamp = time.time()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/hydro-devel/rocon_gateway_tests/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import rocon_console.console as console
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.key_store as key_store
+
+##############################################################################
+# Main
+##############################################################################
+#
+# Latency of connecting and registering with a hub, starting from a cold key
+# store (each iteration runs in a fresh process, the key pair is per process),
+# for a gateway that:
+#
+#  - generates its key pair when it first connects (no key file)
+#  - loads a key pair persisted on disk (the gateway node's ~/.ros key file)
+#
+# and, for both, of reconnecting afterwards in the same process (the key pair
+# is reused across hubs and reconnects).
+#
+# Needs a hub running, e.g. roslaunch rocon_hub hub.launch
+
+MODES = ['generated', 'persisted']
+
+
+def time_registration(ip, port):
+    start_time = time.time()
+    hub = gateway_hub.GatewayHub(ip, port, [], [])
+    hub.register_gateway(False, 'bench_gateway_keys', lambda unused_hub: None, '127.0.0.1')
+    elapsed = time.time() - start_time
+    hub.unregister_gateway()
+    return elapsed
+
+
+def run_cold(ip, port, key_file):
+    '''
+      Time the first and second registration of a fresh process.
+    '''
+    output = subprocess.check_output([sys.executable, __file__, '--ip', ip, '--port', str(port),
+                                      '--cold'] + (['--key-file', key_file] if key_file else []))
+    first, second = output.split()[-2:]
+    return float(first), float(second)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark hub registration latency with a cold key store.')
+    parser.add_argument('-i', '--ip', default='localhost', help='hub ip')
+    parser.add_argument('-p', '--port', type=int, default=6380, help='hub port')
+    parser.add_argument('-n', '--iterations', type=int, default=5, help='number of processes to time for each mode')
+    parser.add_argument('--cold', action='store_true', help='(internal) time registrations in this process')
+    parser.add_argument('--key-file', default=None, help='(internal) key file for the cold process')
+    args = parser.parse_args()
+
+    if args.cold:
+        if args.key_file is not None:
+            key_store.start(args.key_file)
+        first = time_registration(args.ip, args.port)
+        second = time_registration(args.ip, args.port)
+        print("%f %f" % (first, second))
+        sys.exit(0)
+
+    key_directory = tempfile.mkdtemp()
+    key_file = os.path.join(key_directory, 'gateway.pem')
+    results = {}
+    for mode in MODES:
+        results[mode] = ([], [])
+    try:
+        run_cold(args.ip, args.port, key_file)  # generates and saves the persisted key pair
+        for unused_i in range(args.iterations):
+            for mode in MODES:
+                first, second = run_cold(args.ip, args.port, key_file if mode == 'persisted' else None)
+                results[mode][0].append(first)
+                results[mode][1].append(second)
+    finally:
+        shutil.rmtree(key_directory)
+
+    print(console.bold + "Hub registration from a cold key store [%s iterations]" % args.iterations + console.reset)
+    for mode in MODES:
+        for name, times in zip(['first connection', 'reconnection'], results[mode]):
+            times = sorted(times)
+            print(console.cyan + "  %s, %s: " % (mode, name) + console.yellow + "mean %.4fs, min %.4fs, max %.4fs" %
+                  (sum(times) / len(times), times[0], times[-1]) + console.reset)
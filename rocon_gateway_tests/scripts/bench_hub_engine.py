@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/hydro-devel/rocon_gateway_tests/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import time
+
+import rocon_console.console as console
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.hub_workers as hub_workers
+import rocon_gateway.utils as utils
+import rocon_hub_client.hub_engine as hub_engine
+import rocon_python_redis as redis
+from gateway_msgs.msg import Rule
+
+##############################################################################
+# Main
+##############################################################################
+#
+# Compare the synchronous redis client with the hub engine on one or more hubs
+# (e.g. a local redis-server standing in for each):
+#
+#  - gateway reads: the gateway's read only hub operations (remote gateway
+#    information and ping ttls for a fleet of registered gateways), run from
+#    a hub worker per hub and caller, as the hub manager does - by plain
+#    GatewayHubs vs GatewayHubs whose reads go through the engine
+#  - raw reads: a batch of GETs from every hub, one redis pipeline per hub
+#    (sent one hub after another) vs all of them in flight at once on the engine
+
+BENCHMARK_KEY_PREFIX = 'rocon:bench_hub_engine:'
+
+
+def report(name, times, operations, unit):
+    times = sorted(times)
+    print(console.cyan + "  %s: " % name + console.yellow +
+          "mean %.2fms, min %.2fms, max %.2fms [%.0f %s/s]" %
+          (sum(times) / len(times) * 1e3, times[0] * 1e3, times[-1] * 1e3,
+           operations * len(times) / sum(times), unit) +
+          console.reset)
+
+
+def read_gateways(hub, names):
+    hub.remote_gateways_info(names)
+    hub.get_named_gateway_ping_ttls(names)
+
+
+def time_gateway_reads(workers, names):
+    start_time = time.time()
+    for operation in [worker.submit(read_gateways, names) for worker in workers]:
+        operation.result()
+    return time.time() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hub engine against the synchronous redis client.')
+    parser.add_argument('-i', '--ip', default='localhost', help='hub ip')
+    parser.add_argument('-p', '--ports', type=int, nargs='+', default=[6380], help='hub ports, one per hub')
+    parser.add_argument('-g', '--gateways', type=int, default=20, help='number of gateways registered on each hub')
+    parser.add_argument('-m', '--advertisements', type=int, default=10, help='advertisements per gateway')
+    parser.add_argument('-c', '--callers', type=int, default=2, help='concurrent callers per hub for the gateway reads')
+    parser.add_argument('-k', '--keys', type=int, default=50, help='number of keys read from each hub per raw batch')
+    parser.add_argument('-n', '--iterations', type=int, default=100, help='number of batches to time')
+    args = parser.parse_args()
+
+    engine = hub_engine.HubEngine()
+    engine.start()
+    fleet = []
+    names = ['bench_gateway_%d' % i for i in range(args.gateways)]
+    for port in args.ports:
+        for name in names:
+            hub = gateway_hub.GatewayHub(args.ip, port, [], [])
+            hub.register_gateway(False, name, lambda unused_hub: None, '127.0.0.1')
+            hub.sync_advertisements({'publisher': [
+                utils.Connection(Rule('publisher', '/bench/%s/topic_%d' % (name, i), '/bench_node'),
+                                 'std_msgs/String', 'http://127.0.0.1:11311/') for i in range(args.advertisements)]})
+            fleet.append(hub)
+    workers = {}
+    for mode, engine_arg in [('redis', None), ('hub_engine', engine)]:
+        hubs = [gateway_hub.GatewayHub(args.ip, port, [], [], engine=engine_arg) for port in args.ports]
+        workers[mode] = [hub_workers.HubWorker(hub) for hub in hubs for unused_caller in range(args.callers)]
+        for worker in workers[mode]:
+            worker.start()
+    keys = [BENCHMARK_KEY_PREFIX + str(i) for i in range(args.keys)]
+    servers = [redis.Redis(host=args.ip, port=port) for port in args.ports]
+    for server in servers:
+        server.mset(dict((key, 'x' * 64) for key in keys))
+
+    gateway_results = {'redis': [], 'hub_engine': []}
+    raw_results = {'redis': [], 'hub_engine': []}
+    try:
+        for unused_i in range(args.iterations):
+            for mode in ['redis', 'hub_engine']:
+                gateway_results[mode].append(time_gateway_reads(workers[mode], names))
+            start_time = time.time()
+            for server in servers:
+                pipe = server.pipeline(transaction=False)
+                for key in keys:
+                    pipe.get(key)
+                pipe.execute()
+            raw_results['redis'].append(time.time() - start_time)
+            start_time = time.time()
+            futures = engine.submit_many([(args.ip, port, ('GET', key)) for port in args.ports for key in keys])
+            for future in futures:
+                future.result()
+            raw_results['hub_engine'].append(time.time() - start_time)
+    finally:
+        for mode_workers in workers.values():
+            for worker in mode_workers:
+                worker.shutdown()
+        for hub in fleet:
+            hub.unregister_gateway()
+        engine.shutdown()
+        for server in servers:
+            server.delete(*keys)
+
+    callers = args.callers * len(args.ports)
+    print(console.bold + "Gateway reads of %s gateways by %s caller(s) on %s hub(s) [%s iterations]" %
+          (args.gateways, callers, len(args.ports), args.iterations) + console.reset)
+    for mode in ['redis', 'hub_engine']:
+        report(mode, gateway_results[mode], callers, "caller reads")
+    reads = args.keys * len(args.ports)
+    print(console.bold + "Raw batches of %s reads from %s hub(s) [%s iterations]" %
+          (reads, len(args.ports), args.iterations) + console.reset)
+    for mode in ['redis', 'hub_engine']:
+        report(mode, raw_results[mode], reads, "reads")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/hydro-devel/rocon_gateway_tests/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import timeit
+
+import rocon_console.console as console
+import rocon_gateway.utils as utils
+from gateway_msgs.msg import Rule
+
+##############################################################################
+# Main
+##############################################################################
+#
+# Encode/decode times and sizes of what the gateways store on the hub,
+# pickled (the old format) vs the compact wire format.
+
+
+def benchmark(name, encode, decode, iterations):
+    data = encode()
+    encode_time = min(timeit.repeat(encode, number=iterations, repeat=3)) / iterations
+    decode_time = min(timeit.repeat(lambda: decode(data), number=iterations, repeat=3)) / iterations
+    print(console.cyan + "  %s: " % name + console.yellow +
+          "encode %.2fus, decode %.2fus, %d bytes" % (encode_time * 1e6, decode_time * 1e6, len(data)) +
+          console.reset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the compact wire format against cPickle.')
+    parser.add_argument('-n', '--iterations', type=int, default=10000, help='number of encodes/decodes to time')
+    args = parser.parse_args()
+
+    connection = utils.Connection(Rule('publisher', '/chatter', '/talker'), 'std_msgs/String', 'http://localhost:42195/')
+    encrypted_connection = utils.Connection(connection.rule, '\x9a' * 256, '\x7f' * 256)  # sized like rsa ciphertext
+    flip = ['gateway5a4bc3', '/chatter', 'publisher', None]
+
+    for compact, title in [(False, "cPickle"), (True, "Compact wire format")]:
+        allow_pickle = not compact
+        print(console.bold + title + console.reset)
+        benchmark('connection',
+                  lambda: utils.serialize_connection(connection, compact),
+                  lambda data: utils.deserialize_connection(data, allow_pickle),
+                  args.iterations)
+        benchmark('flip request',
+                  lambda: utils.serialize_connection_request('pending', 'gateway5a4bc3', encrypted_connection, compact),
+                  lambda data: utils.deserialize_request(data, allow_pickle),
+                  args.iterations)
+        benchmark('flip/pull details',
+                  lambda: utils.serialize(flip, compact),
+                  lambda data: utils.deserialize(data, allow_pickle),
+                  args.iterations)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/hydro-devel/rocon_gateway_tests/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import random
+import threading
+import time
+
+import rocon_console.console as console
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.utils as utils
+import rocon_python_redis as redis
+from gateway_msgs.msg import Rule, ConnectionStatistics
+from rocon_hub_client import FakeHub, FakeHubConnection
+
+##############################################################################
+# Main
+##############################################################################
+#
+# Load a hub with a fleet of virtual gateways to see how far it scales. Each
+# virtual gateway is a real GatewayHub, registered on the hub with M
+# advertisements and K flips to other gateways, which ticks like the
+# gateway's watcher loop:
+#
+#  - lists the remote gateways and publishes its network statistics
+#  - checks the status of its flips
+#  - replaces a probe advertisement (named with the time) every churn period
+#  - pulls all, i.e. reads the advertisements of every remote gateway, noting
+#    when it first sees another gateway's new probe (propagation delay)
+#  - accepts the flip requests it has been sent
+#
+# For each fleet size it reports the redis ops/s, the hub's cpu and memory
+# (not available for the in process fake hub, --fake) and the 50th/95th/99th
+# percentiles of the tick latency and propagation delay. All the virtual
+# gateways run in this process, so with large fleets the client side (the
+# gil) can become the bottleneck before the hub does - keep an eye on the
+# hub's cpu.
+#
+# Needs a hub running, e.g. roslaunch rocon_hub hub.launch, or use --fake.
+
+PROBE_PREFIX = '/load_probe/'
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return [float('nan')] * 3
+    return [values[int(round(p / 100.0 * (len(values) - 1)))] for p in [50, 95, 99]]
+
+
+class VirtualGateway(threading.Thread):
+
+    def __init__(self, name, ip, port, connection_class, args):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.name = name
+        self.period = args.period
+        self.churn_period = args.churn_period
+        self.hub = gateway_hub.GatewayHub(ip, port, [], [], connection_class)
+        self.hub.register_gateway(False, name, self._hub_connection_lost, '127.0.0.1')
+        self.hub.sync_advertisements(
+            {'publisher': [self._connection('/load/%s/topic_%d' % (name, i)) for i in range(args.advertisements)]})
+        self.flips = []
+        self.tick_latencies = []
+        self.propagation_delays = []
+        self.measuring = False
+        self._probe = None
+        self._last_probe_time = 0.0
+        self._probes_seen = {}  # remote gateway : last probe seen
+        self._accepted = set()  # (remote gateway, rule name) of the flip requests accepted
+        self._stop_event = threading.Event()
+
+    def _connection(self, name):
+        return utils.Connection(Rule('publisher', name, '/load_node'), 'std_msgs/String', 'http://127.0.0.1:11311/')
+
+    def _hub_connection_lost(self, unused_hub):
+        print(console.red + "  %s lost its connection to the hub" % self.name + console.reset)
+
+    def send_flips(self, remote_gateways):
+        for remote_gateway in remote_gateways:
+            connection = self._connection('/load/%s/flip_to_%s' % (self.name, remote_gateway))
+            self.hub.send_flip_request(remote_gateway, connection)
+            self.flips.append((remote_gateway, connection.rule))
+
+    def run(self):
+        statistics = ConnectionStatistics()
+        statistics.network_info_available = False
+        while not self._stop_event.is_set():
+            start_time = time.time()
+            try:
+                self.tick(statistics)
+            except redis.exceptions.ConnectionError:
+                pass  # counted in the tick latency, as it would be in the watcher loop
+            if self.measuring:
+                self.tick_latencies.append(time.time() - start_time)
+            self._stop_event.wait(max(0.0, self.period - (time.time() - start_time)))
+
+    def tick(self, statistics):
+        remote_gateways = self.hub.list_remote_gateway_names()
+        self.hub.publish_network_statistics(statistics)
+        for remote_gateway, rule in self.flips:
+            self.hub.get_flip_request_status(remote_gateway, rule)
+        now = time.time()
+        if now - self._last_probe_time > self.churn_period:
+            probe = self._connection(PROBE_PREFIX + repr(now))
+            self.hub.update_advertisements([probe], [self._probe] if self._probe is not None else [])
+            self._probe = probe
+            self._last_probe_time = now
+        for remote_gateway, state in self.hub.get_remote_connection_states(remote_gateways).items():
+            for connection in state.get('publisher', []):
+                name = connection.rule.name
+                if name.startswith(PROBE_PREFIX) and self._probes_seen.get(remote_gateway) != name:
+                    self._probes_seen[remote_gateway] = name
+                    if self.measuring:
+                        self.propagation_delays.append(time.time() - float(name[len(PROBE_PREFIX):]))
+        for registration in self.hub.get_unblocked_flipped_in_connections():
+            key = (registration.remote_gateway, registration.connection.rule.name)
+            if key not in self._accepted:
+                self.hub.accept_flip_request(registration)
+                self._accepted.add(key)
+
+    def shutdown(self):
+        self._stop_event.set()
+        self.join()
+        self.hub.unregister_gateway()
+
+
+def hub_info(server):
+    '''
+      @return commands processed, cpu seconds used (None for the fake hub) and memory used (None for the fake hub)
+    '''
+    commands = sum(stats['calls'] for stats in server.info('commandstats').values())
+    info = server.info()
+    cpu = info['used_cpu_sys'] + info['used_cpu_user'] if 'used_cpu_sys' in info else None
+    return commands, cpu, info.get('used_memory_human')
+
+
+def run_fleet(size, ip, port, connection_class, server, args):
+    gateways = [VirtualGateway('load_gateway_%d' % i, ip, port, connection_class, args) for i in range(size)]
+    names = [gateway.name for gateway in gateways]
+    for gateway in gateways:
+        others = [name for name in names if name != gateway.name]
+        gateway.send_flips(random.sample(others, min(args.flips, len(others))))
+    for gateway in gateways:
+        gateway.start()
+    time.sleep(max(args.period, args.churn_period))  # warm up, the first ticks see everything as new
+    start_commands, start_cpu, unused_memory = hub_info(server)
+    start_time = time.time()
+    for gateway in gateways:
+        gateway.measuring = True
+    time.sleep(args.duration)
+    for gateway in gateways:
+        gateway.measuring = False
+    end_commands, end_cpu, memory = hub_info(server)
+    duration = time.time() - start_time
+    for gateway in gateways:
+        gateway.shutdown()
+
+    ops = (end_commands - start_commands) / duration
+    cpu = "%5.1f%%" % (100.0 * (end_cpu - start_cpu) / duration) if start_cpu is not None else "  n/a"
+    ticks = percentiles([latency for gateway in gateways for latency in gateway.tick_latencies])
+    delays = percentiles([delay for gateway in gateways for delay in gateway.propagation_delays])
+    print(console.cyan + "  %5d gateways: " % size + console.yellow +
+          "%8.0f ops/s, cpu %s, memory %s, tick %s, propagation %s" %
+          (ops, cpu, memory or "n/a",
+           "/".join("%.1f" % (t * 1000) for t in ticks) + "ms",
+           "/".join("%.1f" % (d * 1000) for d in delays) + "ms") +
+          console.reset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a hub with a fleet of virtual gateways.')
+    parser.add_argument('-i', '--ip', default='localhost', help='hub ip')
+    parser.add_argument('-p', '--port', type=int, default=6380, help='hub port')
+    parser.add_argument('-n', '--gateways', type=int, nargs='+', default=[10, 20, 50], help='fleet sizes to run')
+    parser.add_argument('-m', '--advertisements', type=int, default=20, help='advertisements per gateway')
+    parser.add_argument('-k', '--flips', type=int, default=2, help='flips per gateway')
+    parser.add_argument('--period', type=float, default=1.0, help='tick period (seconds)')
+    parser.add_argument('--churn-period', type=float, default=5.0, help='probe advertisement period (seconds)')
+    parser.add_argument('-d', '--duration', type=float, default=20.0, help='measuring time per fleet size (seconds)')
+    parser.add_argument('--fake', action='store_true', help='run against an in process fake hub')
+    parser.add_argument('--latency', type=float, default=0.0, help='round trip latency for the fake hub (seconds)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (flip targets)')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    connection_class = redis.Connection
+    fake_hub = None
+    if args.fake:
+        fake_hub = FakeHub(args.ip, args.port, name='Load Hub', latency=args.latency)
+        fake_hub.start()
+        connection_class = FakeHubConnection
+    server = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=connection_class, host=args.ip, port=args.port))
+
+    print(console.bold + "Hub load [%s advertisements, %s flips per gateway, %ss ticks, percentiles 50/95/99]" %
+          (args.advertisements, args.flips, args.period) + console.reset)
+    try:
+        for size in args.gateways:
+            run_fleet(size, args.ip, args.port, connection_class, server, args)
+    finally:
+        if fake_hub is not None:
+            fake_hub.shutdown()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import time
+
+from nose.tools import assert_equal, assert_raises, assert_true
+from gateway_msgs.msg import Rule, ConnectionType
+import rocon_python_redis as redis
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.utils as utils
+import rocon_hub_client.hub_client as hub_client
+from rocon_hub_client import FakeHub, FakeHubConnection
+
+##############################################################################
+# Test
+##############################################################################
+
+FAKE_HUB_PORT = 16380
+
+
+def test_redis_commands():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    try:
+        server = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=FakeHubConnection, host='localhost', port=FAKE_HUB_PORT))
+        assert_equal('Fake Hub', server.get('rocon:hub:name'))
+        pipe = server.pipeline()
+        pipe.sadd('set', 'a', 'b')
+        pipe.srem('set', 'a')
+        pipe.smembers('set')
+        assert_equal([2, 1, set(['b'])], pipe.execute())
+        assert_raises(redis.exceptions.ResponseError, server.hget, 'set', 'a')
+        server.set('expiring', 'x')
+        server.pexpire('expiring', 50)
+        time.sleep(0.1)
+        assert_equal(None, server.get('expiring'))
+    finally:
+        fake_hub.shutdown()
+    assert_raises(redis.exceptions.ConnectionError, server.get, 'rocon:hub:name')
+
+
+def test_flip_request_round_trip():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = [gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+            for unused_i in range(2)]
+    try:
+        hubs[0].register_gateway(False, 'alpha', lambda unused_hub: None, '127.0.0.1')
+        hubs[1].register_gateway(False, 'bravo', lambda unused_hub: None, '127.0.0.1')
+        assert_equal(['bravo'], hubs[0].list_remote_gateway_names())
+        connection = utils.Connection(Rule(ConnectionType.PUBLISHER, '/chatter', '/talker'),
+                                      'std_msgs/String', 'http://localhost:11311/')
+        assert hubs[0].send_flip_request('bravo', connection)
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_equal([('alpha', connection.rule)],
+                     [(registration.remote_gateway, registration.connection.rule) for registration in registrations])
+        hubs[1].accept_flip_request(registrations[0])
+        assert_equal('accepted', hubs[0].get_flip_request_status('bravo', connection.rule))
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_key_maintenance():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    try:
+        server = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=FakeHubConnection, host='localhost', port=FAKE_HUB_PORT))
+        number_of_keys = 2 * hub_client.DELETE_BATCH_SIZE + 1
+        server.mset(dict(('rocon:key:%d' % i, i) for i in range(number_of_keys)))
+        server.set('other', 1)
+        keys = set(hub_client.scan_keys(server, 'rocon:key:*'))
+        assert_equal(number_of_keys, len(keys))
+        assert_equal(number_of_keys, hub_client.delete_keys(server, keys))
+        assert_equal(['other', 'rocon:hub:name', 'rocon:hub:schema_version'], sorted(server.keys('*')))
+        # incrementally, a batch at a time
+        stats = server.info('commandstats')
+        assert_true(stats['cmdstat_scan']['calls'] >= number_of_keys / hub_client.SCAN_BATCH_SIZE)
+        assert_equal(3, stats['cmdstat_del']['calls'])
+        assert_equal(1, stats['cmdstat_keys']['calls'])  # only the check above
+    finally:
+        fake_hub.shutdown()
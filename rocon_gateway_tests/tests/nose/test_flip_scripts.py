@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import hashlib
+
+from nose.tools import assert_equal, assert_true
+from gateway_msgs.msg import Rule, ConnectionType
+import rocon_python_redis as redis
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.utils as utils
+from rocon_hub_client import FakeHub, FakeHubConnection
+
+##############################################################################
+# Hub Scripting
+##############################################################################
+
+FAKE_HUB_PORT = 16380
+
+
+class HubScripts(object):
+    '''
+      Stands in for the hub's lua scripting (the fake hub has none), running
+      the logic of the flip scripts in python. Install it on a gateway hub's
+      redis server in place of script_load and evalsha.
+    '''
+
+    def __init__(self, redis_server):
+        self._redis_server = redis_server
+        self.scripts = {}  # sha1 digest : flip script name, as loaded on the hub
+        self.loads = []  # names of the scripts loaded
+        self.runs = []  # (name of the script run, result)
+
+    def install(self, hub):
+        hub._redis_server.script_load = self.script_load
+        hub._redis_server.evalsha = self.evalsha
+
+    def script_load(self, script):
+        name = [name for name, flip_script in gateway_hub.flip_scripts.iteritems() if flip_script == script][0]
+        digest = hashlib.sha1(script).hexdigest()
+        self.scripts[digest] = name
+        self.loads.append(name)
+        return digest
+
+    def evalsha(self, digest, number_of_keys, *args):
+        if digest not in self.scripts:
+            raise redis.exceptions.NoScriptError("NOSCRIPT No matching script.")
+        name = self.scripts[digest]
+        keys, argv = args[:number_of_keys], args[number_of_keys:]
+        channel, change_notification, unused_max_length, unused_ttl = argv[:4]
+        argv = argv[4:]
+        if name == 'set':
+            self._redis_server.hset(keys[0], argv[0], argv[1])
+            result = 1
+        elif name == 'compare_and_set':
+            result = 0
+            if self._redis_server.hget(keys[0], argv[0]) == argv[1]:
+                self._redis_server.hset(keys[0], argv[0], argv[2])
+                result = 1
+        else:
+            result = self._redis_server.hdel(keys[0], *argv)
+        if result:
+            self._redis_server.publish(channel, change_notification)
+            self._redis_server.rpush(keys[1], change_notification)
+        self.runs.append((name, result))
+        return result
+
+##############################################################################
+# Test
+##############################################################################
+
+
+def _connect():
+    hubs = [gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+            for unused_i in range(2)]
+    scripts = HubScripts(redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=FakeHubConnection, host='localhost', port=FAKE_HUB_PORT)))
+    for hub in hubs:
+        scripts.install(hub)
+    hubs[0].register_gateway(False, 'alpha', lambda unused_hub: None, '127.0.0.1')
+    hubs[1].register_gateway(False, 'bravo', lambda unused_hub: None, '127.0.0.1')
+    connection = utils.Connection(Rule(ConnectionType.PUBLISHER, '/chatter', '/talker'),
+                                  'std_msgs/String', 'http://localhost:11311/')
+    return hubs, scripts, connection
+
+
+def test_flip_script_reloaded():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs, scripts, connection = _connect()
+    try:
+        assert_true(hubs[0].send_flip_request('bravo', connection))
+        assert_equal([('set', 1)], scripts.runs)
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_equal(1, len(registrations))
+        # the hub restarted and lost its scripts
+        scripts.scripts.clear()
+        assert_true(hubs[1].accept_flip_request(registrations[0]))
+        assert_equal(['set', 'compare_and_set'], scripts.loads)
+        assert_equal([('set', 1), ('compare_and_set', 1)], scripts.runs)
+        assert_equal('accepted', hubs[0].get_flip_request_status('bravo', connection.rule))
+        assert_true(hubs[0]._flip_scripting)
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_compare_and_set_retried():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs, scripts, connection = _connect()
+    try:
+        assert_true(hubs[0].send_flip_request('bravo', connection))
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        # the sender resends the request after it was retrieved
+        assert_true(hubs[0].send_flip_request('bravo', connection))
+        assert_true(hubs[1].block_flip_request(registrations[0]))
+        assert_equal([('set', 1), ('set', 1), ('compare_and_set', 0), ('compare_and_set', 1)], scripts.runs)
+        assert_equal('blocked', hubs[0].get_flip_request_status('bravo', connection.rule))
+        # the sender unflips after it was retrieved
+        assert_true(hubs[0].send_unflip_request('bravo', connection.rule))
+        assert_equal(False, hubs[1].accept_flip_request(registrations[0]))
+        assert_equal(('compare_and_set', 0), scripts.runs[-1])
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_no_hub_scripting():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = [gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+            for unused_i in range(2)]
+    try:
+        hubs[0].register_gateway(False, 'alpha', lambda unused_hub: None, '127.0.0.1')
+        hubs[1].register_gateway(False, 'bravo', lambda unused_hub: None, '127.0.0.1')
+        connection = utils.Connection(Rule(ConnectionType.PUBLISHER, '/chatter', '/talker'),
+                                      'std_msgs/String', 'http://localhost:11311/')
+        # the fake hub has no scripting, as for redis < 2.6
+        assert_true(hubs[0].send_flip_request('bravo', connection))
+        assert_equal(False, hubs[0]._flip_scripting)
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_true(hubs[1].accept_flip_request(registrations[0]))
+        assert_equal(False, hubs[1]._flip_scripting)
+        assert_equal('accepted', hubs[0].get_flip_request_status('bravo', connection.rule))
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
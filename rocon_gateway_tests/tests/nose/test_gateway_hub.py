@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import threading
+import time
+
+from nose.tools import assert_equal, assert_true
+from gateway_msgs.msg import Rule, ConnectionType
+import rocon_python_redis as redis
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_gateway.utils as utils
+from rocon_hub_client import FakeHub, FakeHubConnection
+
+##############################################################################
+# Test
+##############################################################################
+
+FAKE_HUB_PORT = 16380
+
+
+def _register(names):
+    hubs = []
+    for name in names:
+        hub = gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+        hub.register_gateway(False, name, lambda unused_hub: None, '127.0.0.1')
+        hubs.append(hub)
+    return hubs
+
+
+def _connection(name):
+    return utils.Connection(Rule(ConnectionType.PUBLISHER, name, '/talker'),
+                            'std_msgs/String', 'http://localhost:11311/')
+
+
+def _advertised(hub, remote_gateway):
+    return sorted(c.rule.name for c in hub.get_remote_connection_state(remote_gateway)[ConnectionType.PUBLISHER])
+
+
+def _calls(server, command):
+    return server.info('commandstats').get('cmdstat_' + command, {}).get('calls', 0)
+
+
+def _wait_until(condition, timeout=2.0):
+    start_time = time.time()
+    while not condition() and time.time() - start_time < timeout:
+        time.sleep(0.05)  # e.g. until a change notification arrives
+
+
+def test_remote_gateways_info_pipelined():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    names = ['gateway_%d' % i for i in range(5)]
+    hubs = _register(['reader'] + names)
+    try:
+        fake_hub.latency = 0.1
+        start_time = time.time()
+        remote_gateways = hubs[0].remote_gateways_info(['nope'] + names)
+        # a single round trip, whatever the number of gateways
+        assert_true(time.time() - start_time < 0.2)
+        assert_equal(None, remote_gateways[0])
+        assert_equal(names, [remote_gateway.name for remote_gateway in remote_gateways[1:]])
+        assert_equal(['127.0.0.1'] * len(names), [remote_gateway.ip for remote_gateway in remote_gateways[1:]])
+    finally:
+        fake_hub.latency = 0.0
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_keyed_flip_ins():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = _register(['alpha', 'bravo'])
+    chatter, babble = _connection('/chatter'), _connection('/babble')
+    try:
+        assert_true(hubs[0].send_flip_request('bravo', chatter))
+        # resending replaces the request rather than adding another
+        assert_true(hubs[0].send_flip_request('bravo', chatter))
+        assert_true(hubs[0].send_flip_request('bravo', babble))
+        assert_equal(sorted([hubs[0]._flip_in_field('alpha', chatter.rule),
+                             hubs[0]._flip_in_field('alpha', babble.rule)]),
+                     sorted(fake_hub.execute('HKEYS', 'rocon:bravo:flip_ins')))
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_equal(['/babble', '/chatter'], sorted(r.connection.rule.name for r in registrations))
+        assert_true(hubs[0].send_unflip_request('bravo', chatter.rule))
+        assert_equal([hubs[0]._flip_in_field('alpha', babble.rule)],
+                     fake_hub.execute('HKEYS', 'rocon:bravo:flip_ins'))
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_decryption_cache():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = _register(['alpha', 'bravo'])
+    connection = _connection('/chatter')
+    private_key = hubs[1].private_key
+    try:
+        assert_true(hubs[0].send_flip_request('bravo', connection))
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_equal(connection.xmlrpc_uri, registrations[0].connection.xmlrpc_uri)
+        assert_equal(1, len(hubs[1]._decrypted_connections))
+        assert_equal(1, len(hubs[1]._received_session_keys))
+        # decrypted once, not every time the flip requests are retrieved
+        hubs[1].private_key = None
+        registrations = hubs[1].get_unblocked_flipped_in_connections()
+        assert_equal(connection.type_info, registrations[0].connection.type_info)
+        # forgotten once the request is withdrawn
+        assert_true(hubs[0].send_unflip_request('bravo', connection.rule))
+        _wait_until(lambda: not hubs[1].get_unblocked_flipped_in_connections())
+        assert_equal(0, len(hubs[1]._decrypted_connections))
+        assert_equal(0, len(hubs[1]._received_session_keys))
+    finally:
+        hubs[1].private_key = private_key
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_wait_for_public_key():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = _register(['alpha'])
+    connection = _connection('/chatter')
+    # bravo registers while alpha waits to flip to it
+    registration = threading.Timer(0.4, lambda: hubs.extend(_register(['bravo'])))
+    try:
+        start_time = time.time()
+        assert_equal(False, hubs[0].send_flip_request('bravo', connection, timeout=0.2))
+        assert_true(0.2 <= time.time() - start_time < 0.4)
+        start_time = time.time()
+        registration.start()
+        assert_true(hubs[0].send_flip_request('bravo', connection, timeout=5.0))
+        # woken by the registration, not by the next poll (0.63s in)
+        assert_true(0.4 <= time.time() - start_time < 0.55)
+        registration.join()
+        assert_equal(['/chatter'], [r.connection.rule.name for r in hubs[1].get_unblocked_flipped_in_connections()])
+    finally:
+        registration.join()
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_versioned_advertisements():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    hubs = _register(['alpha', 'bravo'])
+    # not registered, so no change notifications to rely on, only the versions
+    reader = gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+    server = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=FakeHubConnection, host='localhost', port=FAKE_HUB_PORT))
+    chatter, babble = _connection('/chatter'), _connection('/babble')
+    try:
+        hubs[0].advertise(chatter)
+        assert_equal(['/chatter'], _advertised(reader, 'alpha'))
+        smembers = _calls(server, 'smembers')
+        assert_equal(['/chatter'], _advertised(reader, 'alpha'))
+        assert_equal(smembers, _calls(server, 'smembers'))
+        hubs[0].advertise(babble)
+        assert_equal(['/babble', '/chatter'], _advertised(reader, 'alpha'))
+        assert_equal(smembers + 1, _calls(server, 'smembers'))
+        # with change notifications, the versions aren't checked either until something changes
+        _wait_until(lambda: _advertised(hubs[1], 'alpha') == ['/babble', '/chatter'])
+        mget = _calls(server, 'mget')
+        assert_equal(['/babble', '/chatter'], _advertised(hubs[1], 'alpha'))
+        assert_equal(mget, _calls(server, 'mget'))
+        hubs[0].unadvertise(chatter)
+        _wait_until(lambda: _advertised(hubs[1], 'alpha') == ['/babble'])
+        assert_equal(['/babble'], _advertised(hubs[1], 'alpha'))
+        # gone with the gateway
+        hubs[0].unregister_gateway()
+        assert_equal([], _advertised(reader, 'alpha'))
+    finally:
+        for hub in hubs:
+            hub.unregister_gateway()
+        fake_hub.shutdown()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import socket
+import time
+
+from nose.tools import assert_equal, assert_raises, assert_true
+import rocon_python_redis as redis
+import rocon_hub_client.hub_engine as hub_engine
+from rocon_hub_client import FakeHub
+
+##############################################################################
+# Test
+##############################################################################
+
+
+def _start():
+    # the engine opens its own sockets, so the fake hub serves tcp on a free port
+    fake_hub = FakeHub('127.0.0.1', 0, tcp=True)
+    fake_hub.start()
+    engine = hub_engine.HubEngine()
+    engine.start()
+    return fake_hub, engine
+
+
+def test_parse_reply():
+    data = '+OK\r\n:42\r\n$5\r\nhello\r\n$-1\r\n*2\r\n$1\r\na\r\n*1\r\n:1\r\n-ERR wrong type\r\n'
+    replies = []
+    offset = 0
+    while offset < len(data):
+        reply, offset = hub_engine.parse_reply(data, offset)
+        replies.append(reply)
+    assert_equal(['OK', 42, 'hello', None, ['a', [1]]], replies[:-1])
+    assert_true(isinstance(replies[-1], redis.exceptions.ResponseError))
+    assert_equal('ERR wrong type', str(replies[-1]))
+    # replies split across reads
+    for partial in ['$5\r\nhel', '*2\r\n$1\r\na\r\n', ':4']:
+        assert_raises(hub_engine.IncompleteReplyError, hub_engine.parse_reply, partial)
+    assert_equal('*2\r\n$3\r\nGET\r\n$3\r\nkey\r\n', hub_engine.encode_command(['GET', 'key']))
+
+
+def test_command_timeout():
+    # a hub that accepts connections but never replies
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    engine = hub_engine.HubEngine()
+    engine.start()
+    try:
+        start_time = time.time()
+        future = engine.submit('127.0.0.1', port, 'GET', 'key', timeout=0.2)
+        assert_raises(hub_engine.HubCommandTimeoutError, future.result)
+        assert_true(0.2 <= time.time() - start_time < 2.0)
+        # waiting less than the command's timeout
+        future = engine.submit('127.0.0.1', port, 'GET', 'key', timeout=5.0)
+        assert_raises(hub_engine.HubCommandTimeoutError, future.result, 0.1)
+    finally:
+        engine.shutdown()
+        listener.close()
+    assert_raises(redis.exceptions.ConnectionError, future.result)
+
+
+def test_reconnect():
+    fake_hub, engine = _start()
+    try:
+        assert_equal('Fake Hub', engine.execute('127.0.0.1', fake_hub.port, 'GET', 'rocon:hub:name'))
+        # the hub drops the connection instead of replying
+        fake_hub.loss = 1.0
+        futures = engine.submit_many([('127.0.0.1', fake_hub.port, ('SET', 'key', str(i))) for i in range(3)])
+        for future in futures:
+            assert_raises(redis.exceptions.ConnectionError, future.result)
+        # the next command reconnects
+        fake_hub.loss = 0.0
+        assert_equal('OK', engine.execute('127.0.0.1', fake_hub.port, 'SET', 'key', 'value'))
+        assert_equal('value', engine.execute('127.0.0.1', fake_hub.port, 'GET', 'key'))
+        # the hub goes away and comes back on the same port
+        port = fake_hub.port
+        fake_hub.shutdown()
+        assert_raises(redis.exceptions.ConnectionError, engine.execute, '127.0.0.1', port, 'GET', 'key')
+        fake_hub = FakeHub('127.0.0.1', port, tcp=True)
+        fake_hub.start()
+        assert_equal(None, engine.execute('127.0.0.1', port, 'GET', 'key'))
+    finally:
+        engine.shutdown()
+        fake_hub.shutdown()
+
+
+def test_pipeline():
+    fake_hub, engine = _start()
+    client = hub_engine.EngineRedis(engine, '127.0.0.1', fake_hub.port)
+    try:
+        for transaction in [True, False]:
+            pipe = client.pipeline(transaction)
+            pipe.set('key', 'value')
+            pipe.sadd('set', 'a', 'b')
+            pipe.smembers('set')
+            pipe.delete('set')
+            # replies go through the response callbacks
+            assert_equal([True, 2, set(['a', 'b']), 1], pipe.execute())
+        assert_equal(set(), client.smembers('set'))
+        for transaction in [True, False]:
+            pipe = client.pipeline(transaction)
+            pipe.set('key', 'value')
+            pipe.hget('key', 'field')  # wrong type
+            pipe.get('key')
+            assert_raises(redis.exceptions.ResponseError, pipe.execute)
+            pipe.set('key', 'other')
+            pipe.hget('key', 'field')
+            pipe.get('key')
+            replies = pipe.execute(raise_on_error=False)
+            assert_equal([True, 'other'], [replies[0], replies[2]])
+            assert_true(isinstance(replies[1], redis.exceptions.ResponseError))
+        # the connection drops with a pipeline in flight
+        fake_hub.loss = 1.0
+        pipe = client.pipeline()
+        pipe.get('key')
+        assert_raises(redis.exceptions.ConnectionError, pipe.execute)
+    finally:
+        engine.shutdown()
+        fake_hub.shutdown()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import threading
+import time
+
+from nose.tools import assert_equal, assert_true
+from gateway_msgs.msg import ConnectionStatistics
+import rocon_python_redis as redis
+import rocon_gateway.gateway_hub as gateway_hub
+import rocon_hub.watcher as watcher
+from rocon_hub_client import FakeHub, FakeHubConnection
+
+##############################################################################
+# Watcher
+##############################################################################
+
+FAKE_HUB_PORT = 16380
+
+
+class Watcher(watcher.WatcherThread):
+    '''
+      The hub's watcher on the fake hub, with its parameters set here rather
+      than read from the parameter server.
+    '''
+
+    def __init__(self, gateway_unavailable_timeout, gateway_liveness_notifications=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.gateway_unavailable_timeout = gateway_unavailable_timeout
+        self.gateway_dead_timeout = 7200.0
+        self.gateway_ping_frequency = 0.2
+        self.watcher_thread_rate = 5.0
+        self.gateway_liveness_notifications = gateway_liveness_notifications
+        self.gateway_dead_check_period = 60.0
+        self.hub = gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+        self.unavailable_gateways = set()
+        self._published_availability = {}
+        self._lock = threading.Lock()
+
+##############################################################################
+# Test
+##############################################################################
+
+
+def _start():
+    fake_hub = FakeHub('localhost', FAKE_HUB_PORT)
+    fake_hub.start()
+    server = redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=FakeHubConnection, host='localhost', port=FAKE_HUB_PORT))
+    hub = gateway_hub.GatewayHub('localhost', FAKE_HUB_PORT, [], [], connection_class=FakeHubConnection)
+    hub.register_gateway(False, 'alpha', lambda unused_hub: None, '127.0.0.1')
+    return fake_hub, server, hub
+
+
+def _last_seen(server, seconds):
+    # as if the gateway last pinged that long ago
+    server.expire('rocon:alpha::ping', ConnectionStatistics.MAX_TTL - seconds)
+
+
+def _availability(server):
+    return server.hmget('rocon:alpha:info', 'available', 'time_since_last_seen')
+
+
+def _writes(server, command='hmset'):
+    return server.info('commandstats').get('cmdstat_' + command, {}).get('calls', 0)
+
+
+def _wait_until(condition, timeout):
+    start_time = time.time()
+    while not condition() and time.time() - start_time < timeout:
+        time.sleep(0.05)
+
+
+def test_availability_transitions():
+    fake_hub, server, hub = _start()
+    hub_watcher = Watcher(5.0)
+    try:
+        hub_watcher._check_gateways(False)
+        assert_equal(['True', '0'], _availability(server))
+        writes = _writes(server)
+        # nothing written while it stays available
+        _last_seen(server, 2)
+        hub_watcher._check_gateways(False)
+        assert_equal(writes, _writes(server))
+        _last_seen(server, 10)
+        hub_watcher._check_gateways(False)
+        assert_equal(['False', '10'], _availability(server))
+        assert_equal(set(['alpha']), hub_watcher.unavailable_gateways)
+        assert_equal(writes + 1, _writes(server))
+        _last_seen(server, 12)
+        hub_watcher._check_gateways(False)
+        assert_equal(writes + 1, _writes(server))
+        # but the time since last seen is refreshed every unavailable timeout
+        hub_watcher._published_availability['alpha'] = (False, time.time() - 5.0)
+        hub_watcher._check_gateways(False)
+        assert_equal(['False', '12'], _availability(server))
+        _last_seen(server, 0)
+        hub_watcher._check_gateways(False)
+        assert_equal(['True', '0'], _availability(server))
+        assert_equal(set(), hub_watcher.unavailable_gateways)
+        hub.unregister_gateway()
+        hub_watcher._check_gateways(False)
+        assert_equal({}, hub_watcher._published_availability)
+    finally:
+        hub.unregister_gateway()
+        fake_hub.shutdown()
+
+
+def test_liveness_notifications():
+    fake_hub, server, hub = _start()
+    hub_watcher = Watcher(2.0, gateway_liveness_notifications=True)
+    hub_watcher.start()
+    try:
+        _wait_until(lambda: server.ttl('rocon:alpha::alive') > 0, 1.0)
+        assert_true(server.ttl('rocon:alpha::alive') > 0)
+        assert_equal(['True', '0'], _availability(server))
+        # pinging for longer than the unavailable timeout
+        liveness_writes = _writes(server, 'set')
+        for unused_i in range(15):
+            _last_seen(server, 0)
+            time.sleep(0.2)
+        assert_equal(['True', '0'], _availability(server))
+        # the liveness key is restarted once per timeout, not on every ping
+        assert_true(_writes(server, 'set') - liveness_writes <= 3)
+        # stops pinging
+        _wait_until(lambda: _availability(server)[0] == 'False', 4.0)
+        assert_equal('False', _availability(server)[0])
+        assert_equal(set(['alpha']), hub_watcher.unavailable_gateways)
+        # and is back with its next ping
+        _last_seen(server, 0)
+        _wait_until(lambda: _availability(server)[0] == 'True', 1.0)
+        assert_equal(['True', '0'], _availability(server))
+        assert_equal(set(), hub_watcher.unavailable_gateways)
+    finally:
+        hub.unregister_gateway()
+        fake_hub.shutdown()
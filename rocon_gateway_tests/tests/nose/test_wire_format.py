@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+##############################################################################
+# Imports
+##############################################################################
+
+import cPickle as pickle
+
+from nose.tools import assert_equal, assert_raises
+from gateway_msgs.msg import Rule, ConnectionType
+import rocon_gateway.utils as utils
+
+##############################################################################
+# Test
+##############################################################################
+
+
+def test_strings_round_trip():
+    connection = utils.Connection(Rule(ConnectionType.PUBLISHER, '/chatter', '/talker'),
+                                  'std_msgs/String', 'http://localhost:11311/')
+    data = utils.serialize_connection(connection, compact=True)
+    assert data.startswith(utils.WIRE_FORMAT_MAGIC)
+    assert_equal(connection, utils.deserialize_connection(data, allow_pickle=False))
+    assert_equal([], utils.decode(utils.encode([])))
+    assert_equal(['', 'a' * 1000], utils.decode(utils.encode(['', 'a' * 1000])))
+
+
+def test_tagged_round_trip():
+    fields = ['dude', u'd\xfcde', None, True, False, 42, 2 ** 40, 0.5]
+    decoded = utils.decode(utils.encode(fields))
+    assert_equal(fields, decoded)
+    assert_equal([type(field) for field in fields], [type(field) for field in decoded])
+    assert_raises(ValueError, utils.encode, [{}])
+
+
+def test_pickle_fallback():
+    data = pickle.dumps(['request', 'dude', 'publisher', '/chatter', '/talker'])
+    assert_equal(('request', 'dude', ['publisher', '/chatter', '/talker']), utils.deserialize_request(data))
+    assert_raises(ValueError, utils.deserialize_request, data, False)
+    for garbage in ['garbage', data[:-3], '']:
+        assert_raises(ValueError, utils.deserialize, garbage)
+
+
+def test_malformed():
+    data = utils.encode(['dude', 'dudette'])
+    assert_raises(ValueError, utils.decode, data[:-1])
+    assert_raises(ValueError, utils.decode, data + 'x')
+    assert_raises(ValueError, utils.decode, data[:10])
+    assert_raises(ValueError, utils.decode, data[:3] + 'x' + data[4:])
+    assert_raises(ValueError, utils.decode, data[:2] + chr(utils.WIRE_FORMAT_VERSION + 1) + data[3:])
+    assert_raises(ValueError, utils.decode, utils.WIRE_FORMAT_MAGIC + '\x01s\xff\xff\xff\xff')
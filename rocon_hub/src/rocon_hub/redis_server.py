@@ -27,6 +27,8 @@ except ImportError:
     # actually unused right now while we use redis as a ros package
     sys.exit("\n[ERROR] No python-redis found - 'rosdep install rocon_hub'\n")
 import rocon_semantic_version as semantic_version
+import rocon_hub_client
+from rocon_hub_client import hub_api
 
 from . import utils
 
@@ -123,18 +125,15 @@ class RedisServer:
         while count < no_attempts:
             try:
                 self._server = redis.Redis(connection_pool=pool)
-                rocon_keys = self._server.keys("rocon:*")
-                pattern = re.compile("rocon:*")
-                keys_to_delete = []
-                for key in rocon_keys:
-                    if pattern.match(key):
-                        keys_to_delete.append(key)
+                rocon_hub_client.delete_keys(self._server, rocon_hub_client.scan_keys(self._server, "rocon:*"))
                 pipe = self._server.pipeline()
-                if len(keys_to_delete) != 0:
-                    pipe.delete(*keys_to_delete)  # * unpacks the list args - http://stackoverflow.com/questions/2921847/python-once-and-for-all-what-does-the-star-operator-mean-in-python
                 pipe.set("rocon:hub:name", self._parameters['name'])
+                pipe.set("rocon:hub:schema_version", self._parameters['schema_version'])
                 pipe.execute()
                 rospy.loginfo("Hub : reset hub variables on the redis server.")
+                if int(self._parameters['schema_version']) > hub_api.SCHEMA_LEGACY:
+                    rospy.logwarn("Hub : using schema version %s, gateways that predate schema versioning "
+                                  "won't work with this hub." % self._parameters['schema_version'])
                 break
             except redis.ConnectionError:
                 count += 1
@@ -149,16 +148,7 @@ class RedisServer:
           Clears rocon: keys on the server.
         '''
         try:
-            rocon_keys = self._server.keys("rocon:*")
-            pattern = re.compile("rocon:*")
-            keys_to_delete = []
-            for key in rocon_keys:
-                if pattern.match(key):
-                    keys_to_delete.append(key)
-            pipe = self._server.pipeline()
-            if len(keys_to_delete) != 0:
-                pipe.delete(*keys_to_delete)  # * unpacks the list args - http://stackoverflow.com/questions/2921847/python-once-and-for-all-what-does-the-star-operator-mean-in-python
-            pipe.execute()
+            rocon_hub_client.delete_keys(self._server, rocon_hub_client.scan_keys(self._server, "rocon:*"))
             #rospy.loginfo("Hub : clearing hub variables on the redis server.")
         except redis.ConnectionError:
             pass
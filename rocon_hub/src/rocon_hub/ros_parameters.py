@@ -5,6 +5,7 @@
 #
 
 import rospy
+from rocon_hub_client import hub_api
 
 ###############################################################################
 # Functions
@@ -19,6 +20,8 @@ def load():
      - port       : port number to run the server (default: 6380)
      - zeroconf   : whether or not to zeroconf publish this hub
      - max_memory : max amount of ram allocated for this redis server
+     - schema_version : layout of the gateway information on the hub (default 1, i.e. legacy, raise it once every
+                        gateway understands it - versions are cumulative, see param/default.yaml for what each enables)
     '''
     param = {}
 
@@ -26,6 +29,7 @@ def load():
     param['port'] = rospy.get_param('~port', '6380')
     param['zeroconf'] = rospy.get_param("~zeroconf", True)
     param['max_memory'] = rospy.get_param('~max_memory', '10mb')
+    param['schema_version'] = rospy.get_param('~schema_version', hub_api.SCHEMA_LEGACY)
     param['external_shutdown'] = rospy.get_param('~external_shutdown', False)
     param['external_shutdown_timeout'] = rospy.get_param('~external_shutdown_timeout', 15.0)
 
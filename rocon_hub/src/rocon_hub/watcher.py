@@ -14,10 +14,40 @@ from rocon_hub_client import hub_api
 from rocon_python_comms import WallRate
 
 
+import math
 import rocon_hub_client
+import rocon_python_redis as redis
 import rospy
 import sys
 import threading
+import time
+
+##############################################################################
+# Keyspace notifications
+##############################################################################
+
+
+class KeyspaceEventListenerThread(threading.Thread):
+
+    '''
+      Relays the hub's keyspace event notifications (channel and key) to the
+      watcher. The pubsub connection must already be subscribed before the
+      thread is started. The thread ends if the connection to the hub goes down.
+    '''
+
+    def __init__(self, pubsub, keyspace_event_hook):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._pubsub = pubsub
+        self._keyspace_event_hook = keyspace_event_hook
+
+    def run(self):
+        try:
+            for message in self._pubsub.listen():
+                if message['type'] == 'message':
+                    self._keyspace_event_hook(message['channel'], message['data'])
+        except (redis.exceptions.ConnectionError, AttributeError, ValueError):
+            pass
 
 ##############################################################################
 # Main watcher thread
@@ -36,12 +66,21 @@ class WatcherThread(threading.Thread):
         self.gateway_ping_frequency = \
                 rospy.get_param('~gateway_ping_frequency', 0.2)
         self.watcher_thread_rate = rospy.get_param('~watcher_thread_rate', 0.2)
+        # track liveness with the hub's expiry events rather than polling the pings
+        self.gateway_liveness_notifications = \
+                rospy.get_param('~gateway_liveness_notifications', False)
+        # how often the pings are still polled (for the dead timeout) when tracking with events
+        self.gateway_dead_check_period = \
+                rospy.get_param('~gateway_dead_check_period', 60.0)
         try:
             self.hub = gateway_hub.GatewayHub(ip, port, [], [])
         except rocon_hub_client.HubError as e:
             rospy.logfatal("HubWatcher: Unable to connect to hub: %s" % str(e))
             sys.exit(-1)
-        self.unavailable_gateways = []
+        self.unavailable_gateways = set()
+        # what we last wrote to the hub for each gateway: (available, when written)
+        self._published_availability = {}
+        self._lock = threading.Lock()  # the above are shared with the keyspace event listener
 
     def run(self):
         '''
@@ -50,46 +89,207 @@ class WatcherThread(threading.Thread):
               1. For all gateways available, see if we have a pinger available.
               2. Add and remove pingers as necessary
               3. Depending on pinger stats, update hub appropriately
+
+          The ping ttls are read in a single round trip and availability is only
+          written when it changes, along with the time since last seen, which
+          is otherwise refreshed once every unavailable timeout - readers of the
+          hub see it up to that long out of date.
+
+          With the gateway_liveness_notifications parameter set, gateways are
+          instead marked unavailable by the hub's expiry events (see
+          _start_liveness_listener) and the pings are only polled every
+          gateway_dead_check_period, for the dead timeout. If the hub can't
+          send the events, or stops sending them, it falls back to polling.
         '''
+        listener = self._start_liveness_listener() if self.gateway_liveness_notifications else None
+        last_check_time = 0.0
         rate = WallRate(self.watcher_thread_rate)
         while True:
-            remote_gateway_names = self.hub.list_remote_gateway_names()
-
-            # Check all pingers
-            for name in remote_gateway_names:
-
-                gateway_key = hub_api.create_rocon_key(name)
-                # Get time for this gateway when hub was last seen
-                ping_key = hub_api.create_rocon_gateway_key(name, ':ping')
-                expiration_time = self.hub._redis_server.ttl(ping_key)
-
-                if expiration_time is None:
-                    # Probably in the process of starting up, ignore for now
-                    continue
-
-                seconds_since_last_seen = \
-                        int(ConnectionStatistics.MAX_TTL - expiration_time)
-                # Check if gateway gone for low timeout (unavailable)
-                if seconds_since_last_seen > self.gateway_unavailable_timeout:
-                    if name not in self.unavailable_gateways:
-                        rospy.logwarn("HubWatcherThread: Gateway " + name +
-                                      " has been unavailable for " +
-                                      str(self.gateway_unavailable_timeout) +
-                                      " seconds! Marking as unavailable.")
-                        self.unavailable_gateways.append(name)
-                    self.hub.mark_named_gateway_available(gateway_key, False,
-                             seconds_since_last_seen)
-                else:
-                    if name in self.unavailable_gateways:
-                        self.unavailable_gateways.remove(name)
-                    self.hub.mark_named_gateway_available(gateway_key, True,
-                             seconds_since_last_seen)
-
-                # Check if gateway gone for high timeout (dead)
-                if seconds_since_last_seen > self.gateway_dead_timeout:
-                    rospy.logwarn("HubWatcherThread: Gateway " + name +
-                                  " has been unavailable for " +
-                                  str(self.gateway_dead_timeout) +
-                                  " seconds! Removing from hub.")
-                    self.hub.unregister_named_gateway(gateway_key)
+            if listener is not None and not listener.is_alive():
+                rospy.logwarn("HubWatcherThread: lost the hub's keyspace notifications, falling back to polling.")
+                listener = None
+            if listener is None or time.time() - last_check_time >= self.gateway_dead_check_period:
+                last_check_time = time.time()
+                self._check_gateways(listener is not None)
             rate.sleep()
+
+    def _check_gateways(self, track_liveness):
+        '''
+          Poll the pings of all the gateways, updating their availability and
+          removing the dead.
+
+          @param track_liveness : whether to (re)start the liveness keys of the available gateways
+          @type bool
+        '''
+        remote_gateway_names = self.hub.list_remote_gateway_names()
+        # Get time for these gateways when hub was last seen
+        expiration_times = self.hub.get_named_gateway_ping_ttls(remote_gateway_names)
+        availabilities = {}
+        published_availability = {}
+        liveness_ttls = {}
+        dead_gateways = []
+        now = time.time()
+
+        self._lock.acquire()
+        # Check all pingers
+        for name in remote_gateway_names:
+            expiration_time = expiration_times.get(name)
+            if expiration_time is None:
+                # Probably in the process of starting up, ignore for now
+                continue
+
+            gateway_key = hub_api.create_rocon_key(name)
+            seconds_since_last_seen = \
+                    int(ConnectionStatistics.MAX_TTL - expiration_time)
+            # Check if gateway gone for low timeout (unavailable)
+            available = seconds_since_last_seen <= self.gateway_unavailable_timeout
+            if not available and name not in self.unavailable_gateways:
+                rospy.logwarn("HubWatcherThread: Gateway " + name +
+                              " has been unavailable for " +
+                              str(self.gateway_unavailable_timeout) +
+                              " seconds! Marking as unavailable.")
+                self.unavailable_gateways.add(name)
+            elif available:
+                self.unavailable_gateways.discard(name)
+            published = self._published_availability.get(name)
+            if published is None or published[0] != available or \
+                    now - published[1] >= self.gateway_unavailable_timeout:
+                availabilities[gateway_key] = (available, seconds_since_last_seen)
+                published_availability[name] = (available, now)
+            if available and track_liveness:
+                # also restores liveness keys lost meanwhile, e.g. removed when the gateway restarted
+                liveness_ttls[name] = self.gateway_unavailable_timeout - seconds_since_last_seen
+
+            # Check if gateway gone for high timeout (dead)
+            if seconds_since_last_seen > self.gateway_dead_timeout:
+                rospy.logwarn("HubWatcherThread: Gateway " + name +
+                              " has been unavailable for " +
+                              str(self.gateway_dead_timeout) +
+                              " seconds! Removing from hub.")
+                dead_gateways.append(name)
+        # only recorded once written, so failed writes are retried on the next check
+        if self.hub.mark_named_gateways_available(availabilities):
+            self._published_availability.update(published_availability)
+        for name in dead_gateways:
+            self.hub.unregister_named_gateway(hub_api.create_rocon_key(name))
+        # Forget the gateways that have left (or been removed from) the hub
+        for name in set(self._published_availability.keys()) - set(remote_gateway_names) | set(dead_gateways):
+            self._published_availability.pop(name, None)
+            self.unavailable_gateways.discard(name)
+        self._lock.release()
+        self._start_liveness(liveness_ttls)
+
+    ##########################################################################
+    # Liveness with keyspace notifications
+    ##########################################################################
+    #
+    # A gateway's liveness key (rocon:<gateway>::alive) is set to expire when
+    # the gateway would become unavailable if it stopped pinging. Its expired
+    # event either marks the gateway unavailable or, if it has pinged since,
+    # restarts the key for the time remaining. Pings themselves (the expire
+    # event on rocon:<gateway>::ping) only matter when the gateway is not
+    # known to be available, i.e. on a transition - so the hub sees one
+    # liveness write per gateway per unavailable timeout, not one per ping.
+
+    def _start_liveness_listener(self):
+        '''
+          Enable the hub's keyspace notifications for expire and expired events
+          (keeping any already enabled) and listen for them.
+
+          @return the listener, or None if the hub can't send them (e.g. older than redis 2.8)
+          @rtype KeyspaceEventListenerThread
+        '''
+        db = self.hub._redis_server.connection_pool.connection_kwargs.get('db', 0)
+        try:
+            events = self.hub._redis_server.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            missing_events = [flag for flag in 'Egx' if flag not in events and (flag == 'E' or 'A' not in events)]
+            if missing_events:
+                self.hub._redis_server.config_set('notify-keyspace-events', events + ''.join(missing_events))
+            pubsub = self.hub._redis_server.pubsub()
+            pubsub.subscribe(['__keyevent@%s__:expire' % db, '__keyevent@%s__:expired' % db])
+        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError) as e:
+            rospy.logwarn("HubWatcherThread: unable to enable keyspace notifications on the hub, " +
+                          "falling back to polling [%s]" % str(e))
+            return None
+        listener = KeyspaceEventListenerThread(pubsub, self._process_keyspace_event)
+        listener.start()
+        return listener
+
+    def _process_keyspace_event(self, channel, key):
+        if not key.startswith('rocon:'):
+            return
+        if channel.endswith(':expire') and key.endswith('::ping'):
+            self._gateway_pinged(key[len('rocon:'):-len('::ping')])
+        elif channel.endswith(':expired') and key.endswith('::alive'):
+            self._gateway_lapsed(key[len('rocon:'):-len('::alive')])
+
+    def _gateway_pinged(self, name):
+        '''
+          Start tracking a gateway's liveness if it has just become available
+          (or appeared). Nothing to do for the pings of available gateways.
+        '''
+        self._lock.acquire()
+        published = self._published_availability.get(name)
+        available = name not in self.unavailable_gateways and published is not None and published[0]
+        self._lock.release()
+        if not available:
+            self._start_liveness({name: self.gateway_unavailable_timeout})
+
+    def _start_liveness(self, liveness_ttls):
+        '''
+          @param liveness_ttls : seconds until each gateway is unavailable, keyed by gateway name
+          @type dict
+        '''
+        if not liveness_ttls:
+            return
+        try:
+            pipe = self.hub._redis_server.pipeline()
+            for name, ttl in liveness_ttls.iteritems():
+                liveness_key = hub_api.create_rocon_gateway_key(name, ':alive')
+                pipe.set(liveness_key, True)
+                pipe.expire(liveness_key, max(1, int(math.ceil(ttl))))
+            pipe.execute()
+        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
+            pass  # the next dead check catches anything missed
+        self._lock.acquire()
+        availabilities = {}
+        for name in liveness_ttls:
+            published = self._published_availability.get(name)
+            if name in self.unavailable_gateways or (published is not None and not published[0]):
+                self.unavailable_gateways.discard(name)
+                availabilities[hub_api.create_rocon_key(name)] = (True, 0)
+        if self.hub.mark_named_gateways_available(availabilities):
+            now = time.time()
+            for gateway_key in availabilities:
+                self._published_availability[hub_api.key_base_name(gateway_key)] = (True, now)
+        self._lock.release()
+
+    def _gateway_lapsed(self, name):
+        '''
+          A gateway's liveness key expired - it is unavailable, unless it has
+          pinged since the key was (re)started.
+        '''
+        try:
+            if not self.hub._redis_server.sismember(self.hub._redis_keys['gatewaylist'],
+                                                    hub_api.create_rocon_key(name)):
+                return  # left the hub in the meantime
+        except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
+            return  # the next dead check catches anything missed
+        expiration_time = self.hub.get_named_gateway_ping_ttls([name]).get(name)
+        if expiration_time is None:
+            return  # the next dead check catches anything missed
+        seconds_since_last_seen = int(ConnectionStatistics.MAX_TTL - expiration_time)
+        if seconds_since_last_seen < self.gateway_unavailable_timeout:
+            self._start_liveness({name: self.gateway_unavailable_timeout - seconds_since_last_seen})
+            return
+        self._lock.acquire()
+        if name not in self.unavailable_gateways:
+            rospy.logwarn("HubWatcherThread: Gateway " + name +
+                          " has been unavailable for " +
+                          str(self.gateway_unavailable_timeout) +
+                          " seconds! Marking as unavailable.")
+            self.unavailable_gateways.add(name)
+        if self.hub.mark_named_gateways_available({hub_api.create_rocon_key(name):
+                                                   (False, seconds_since_last_seen)}):
+            self._published_availability[name] = (False, time.time())
+        self._lock.release()
@@ -5,8 +5,11 @@
 #
 
 import hub_api
-from .hub_client import Hub, ping_hub
+from .hub_client import Hub, HubHealthCheck, ping_hub, scan_keys, delete_keys
 from .hub_discovery import HubDiscovery
+from .hub_statistics import HubStatistics, InstrumentedRedis
+from .fake_hub import FakeHub, FakeHubConnection
+from .hub_engine import HubEngine, HubCommandFuture, HubCommandTimeoutError, EngineRedis
 from .exceptions import HubError, \
                         HubNotFoundError, HubNameNotFoundError, \
                         HubConnectionBlacklistedError, HubConnectionNotWhitelistedError, \
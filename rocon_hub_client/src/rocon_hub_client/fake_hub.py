@@ -0,0 +1,891 @@
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+
+'''
+  An in process stand in for a hub's redis server, for tests and benchmarks
+  of the gateway/hub logic on one machine without redis-server (or several
+  ros masters). It speaks the redis protocol over socket pairs and implements
+  the subset of commands the gateways and hub use (strings, sets, hashes,
+  lists, expiry, transactions and pubsub, but not lua scripting - the
+  gateways fall back as they would for an old redis). Latency and loss can
+  be injected. It can also serve real tcp connections, for clients that
+  open their own sockets (e.g. the hub engine).
+
+  Usage:
+
+    fake_hub = FakeHub('localhost', 6380, latency=0.005)
+    fake_hub.start()
+    hub = GatewayHub('localhost', 6380, [], [], connection_class=FakeHubConnection)
+    ...
+    fake_hub.shutdown()
+'''
+
+###############################################################################
+# Imports
+###############################################################################
+
+import errno
+import fnmatch
+import heapq
+import random
+import socket
+import threading
+import time
+
+import rocon_python_redis as redis
+
+from . import hub_api
+from .hub_engine import parse_reply, IncompleteReplyError
+
+###############################################################################
+# Registry
+###############################################################################
+
+_fake_hubs = {}  # (ip, port) : FakeHub
+_fake_hubs_lock = threading.Lock()
+
+
+class FakeHubConnection(redis.Connection):
+    '''
+      Connects to the fake hub registered for its host and port instead of a
+      redis server. Pass it to a Hub (or a redis connection pool) as the
+      connection_class.
+    '''
+
+    def _connect(self):
+        _fake_hubs_lock.acquire()
+        fake_hub = _fake_hubs.get((self.host, self.port))
+        _fake_hubs_lock.release()
+        if fake_hub is None:
+            raise socket.error(errno.ECONNREFUSED, "no fake hub at %s:%s" % (self.host, self.port))
+        sock = fake_hub.connect()
+        sock.settimeout(self.socket_timeout)
+        return sock
+
+###############################################################################
+# Replies
+###############################################################################
+
+
+class _Status(str):
+    pass
+
+OK = _Status('OK')
+NIL_ARRAY = object()  # e.g. the reply to an aborted transaction
+
+
+class _MultipleReplies(list):
+    pass  # e.g. one reply for each channel subscribed to
+
+
+def _error(message):
+    return redis.exceptions.ResponseError(message)
+
+
+class _WrongType(Exception):
+    pass
+
+
+def encode_reply(reply):
+    '''
+      Encode a reply in the redis protocol (RESP).
+
+      @param reply : status, error (exception), None, integer, string or list of those
+      @rtype str
+    '''
+    if isinstance(reply, _MultipleReplies):
+        return ''.join(encode_reply(r) for r in reply)
+    if isinstance(reply, _Status):
+        return '+%s\r\n' % reply
+    if isinstance(reply, Exception):
+        return '-%s\r\n' % str(reply)
+    if reply is None:
+        return '$-1\r\n'
+    if reply is NIL_ARRAY:
+        return '*-1\r\n'
+    if isinstance(reply, (bool, int, long)):
+        return ':%d\r\n' % reply
+    if isinstance(reply, str):
+        return '$%d\r\n%s\r\n' % (len(reply), reply)
+    return '*%d\r\n%s' % (len(reply), ''.join(encode_reply(r) for r in reply))
+
+
+def _list_range(length, start, stop):
+    '''
+      Python slice bounds for redis' (inclusive, possibly negative) list indices.
+    '''
+    start, stop = int(start), int(stop)
+    if start < 0:
+        start = max(0, length + start)
+    if stop < 0:
+        stop = length + stop
+    return start, max(start, min(stop, length - 1) + 1)
+
+###############################################################################
+# Clients
+###############################################################################
+
+
+class _FakeHubClient(threading.Thread):
+    '''
+      Serves one connection, executing the commands from it in order.
+    '''
+
+    def __init__(self, fake_hub, sock):
+        threading.Thread.__init__(self, name='fake_hub_client')
+        self.daemon = True
+        self.fake_hub = fake_hub
+        self.sock = sock
+        self.multi = None  # commands queued in a transaction
+        self.watched = {}  # key : version when watched
+        self.channels = set()
+        self.patterns = set()
+        self._send_lock = threading.Lock()
+
+    def send(self, data):
+        self._send_lock.acquire()
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            pass  # closed, the reading end notices
+        finally:
+            self._send_lock.release()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def run(self):
+        buffered = ''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            buffered += data
+            replies = []
+            offset = 0
+            while True:
+                try:
+                    args, offset = parse_reply(buffered, offset)
+                except IncompleteReplyError:
+                    break
+                replies.append(self.fake_hub.execute_for_client(self, args))
+            buffered = buffered[offset:]
+            if replies and not self.fake_hub.reply(self, ''.join(encode_reply(r) for r in replies)):
+                break
+        self.fake_hub.disconnect(self)
+        self.sock.close()
+
+###############################################################################
+# Fake Hub
+###############################################################################
+
+
+class FakeHub(object):
+    '''
+      Keys, expiry and pubsub behave as for redis (keyspace notifications for
+      expire and expired events included). Keys expire both when touched and on a 100ms
+      sweep.
+
+      Faults are injected per round trip - the replies to whatever a client
+      sent in one go (i.e. a whole pipeline) are delayed by the latency, and
+      with the loss probability the connection is dropped instead, as if the
+      hub had dropped off the network. Both can be changed while running.
+    '''
+
+    def __init__(self, ip='localhost', port=6380, name='Fake Hub', schema_version=hub_api.SCHEMA_VERSION,
+                 latency=0.0, loss=0.0, seed=None, tcp=False):
+        '''
+          @param ip, port : address FakeHubConnection's will connect to this hub on
+          @param name : hub name
+          @type str
+          @param schema_version : layout of the gateway information on the hub
+          @type int
+          @param latency : delay (seconds) for every round trip
+          @type float
+          @param loss : probability of dropping the connection instead of replying
+          @type float
+          @param seed : for the loss, to make it repeatable
+          @param tcp : also listen for tcp connections on the address (port 0 picks a free port,
+                 which is then the hub's port)
+          @type bool
+        '''
+        self.ip = ip
+        self.port = port
+        self.name = name
+        self.schema_version = schema_version
+        self.latency = latency
+        self.loss = loss
+        self._random = random.Random(seed)
+        self._condition = threading.Condition()  # guards everything below, like redis' single thread
+        self._data = {}  # key : str, set, dict or list
+        self._expiries = {}  # key : expiry time
+        self._expiry_heap = []  # (expiry time, key), possibly stale
+        self._versions = {}  # key : modification count, for WATCH
+        self._config = {'notify-keyspace-events': ''}
+        self._subscriptions = {}  # channel : set of clients
+        self._pattern_subscriptions = {}  # pattern : set of clients
+        self._deliveries = []  # (client, data), pubsub messages to send once the lock is released
+        self._command_calls = {}  # command name : calls, for INFO commandstats
+        self._clients = set()
+        self._running = False
+        self._direct_client = _FakeHubClient(self, None)  # for execute()
+        self._tcp = tcp
+        self._listener = None
+
+    ##########################################################################
+    # Lifecycle
+    ##########################################################################
+
+    def start(self):
+        '''
+          Start serving connections on the hub's address, with the hub name and
+          schema version set (as by rocon_hub.RedisServer).
+
+          @raise socket.error if serving tcp connections and the address is in use
+        '''
+        if self._tcp:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind((self.ip, self.port))
+            self._listener.listen(16)
+            self.port = self._listener.getsockname()[1]
+            accept_thread = threading.Thread(target=self._accept, name='fake_hub_accept')
+            accept_thread.daemon = True
+            accept_thread.start()
+        _fake_hubs_lock.acquire()
+        _fake_hubs[(self.ip, self.port)] = self
+        _fake_hubs_lock.release()
+        self._running = True
+        self.execute('SET', 'rocon:hub:name', self.name)
+        self.execute('SET', 'rocon:hub:schema_version', self.schema_version)
+        expiry_thread = threading.Thread(target=self._expire_periodically, name='fake_hub_expiry')
+        expiry_thread.daemon = True
+        expiry_thread.start()
+
+    def shutdown(self):
+        '''
+          Stop serving, dropping every connection (as if the hub had died).
+        '''
+        _fake_hubs_lock.acquire()
+        if _fake_hubs.get((self.ip, self.port)) is self:
+            del _fake_hubs[(self.ip, self.port)]
+        _fake_hubs_lock.release()
+        self._condition.acquire()
+        self._running = False
+        clients = list(self._clients)
+        self._condition.notify_all()  # wakes up blocked BLPOPs
+        self._condition.release()
+        if self._listener is not None:
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)  # wakes up the accepting thread
+            except socket.error:
+                pass
+            self._listener.close()
+            self._listener = None
+        for client in clients:
+            client.close()
+
+    def connect(self):
+        '''
+          A new connection to the hub.
+
+          @return the client's end
+          @rtype socket.socket
+        '''
+        client_sock, hub_sock = socket.socketpair()
+        # wrapped, so the client's socket timeout also applies to its file object (see redis.Connection)
+        client_sock = socket.socket(_sock=client_sock)
+        self._serve(hub_sock)
+        return client_sock
+
+    def _serve(self, sock):
+        client = _FakeHubClient(self, sock)
+        self._condition.acquire()
+        self._clients.add(client)
+        self._condition.release()
+        client.start()
+
+    def _accept(self):
+        listener = self._listener
+        while True:
+            try:
+                sock, unused_address = listener.accept()
+            except socket.error:
+                break  # shut down
+            if not self._running:
+                sock.close()
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._serve(sock)
+
+    def disconnect(self, client):
+        self._condition.acquire()
+        self._clients.discard(client)
+        self._unsubscribe(client, list(client.channels), self._subscriptions, client.channels, 'unsubscribe')
+        self._unsubscribe(client, list(client.patterns), self._pattern_subscriptions, client.patterns, 'punsubscribe')
+        self._condition.release()
+
+    def reply(self, client, data):
+        '''
+          Send replies, after the injected latency (or not at all, with the
+          injected loss).
+
+          @return False if the connection was dropped
+          @rtype bool
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        if self.loss and self._random.random() < self.loss:
+            client.close()
+            return False
+        client.send(data)
+        return True
+
+    ##########################################################################
+    # Execution
+    ##########################################################################
+
+    def execute(self, *args):
+        '''
+          Run a command directly, e.g. to set up or inspect the hub from a test.
+
+          @param args : command name and arguments, e.g. 'GET', 'rocon:hub:name'
+          @return the reply (sets, hashes as lists, statuses as str)
+
+          @raise redis.exceptions.ResponseError for error replies
+        '''
+        reply = self.execute_for_client(self._direct_client, [str(arg) for arg in args])
+        if isinstance(reply, Exception):
+            raise reply
+        return None if reply is NIL_ARRAY else reply
+
+    def execute_for_client(self, client, args):
+        self._condition.acquire()
+        try:
+            self._expire()
+            reply = self._execute(client, args)
+            deliveries = self._deliveries
+            self._deliveries = []
+        finally:
+            self._condition.release()
+        for subscriber, data in deliveries:
+            subscriber.send(data)
+        return reply
+
+    def _execute(self, client, args):
+        name = args[0].upper()
+        if client.multi is not None and name not in ('EXEC', 'DISCARD', 'MULTI', 'WATCH'):
+            client.multi.append(args)
+            return _Status('QUEUED')
+        if (client.channels or client.patterns) and \
+                name not in ('SUBSCRIBE', 'UNSUBSCRIBE', 'PSUBSCRIBE', 'PUNSUBSCRIBE', 'PING'):
+            return _error("ERR only (P)SUBSCRIBE / (P)UNSUBSCRIBE / PING / QUIT allowed in this context")
+        command = getattr(self, '_command_' + name.lower(), None)
+        if command is None:
+            return _error("ERR unknown command '%s'" % args[0])
+        try:
+            return command(client, *args[1:])
+        except TypeError:
+            return _error("ERR wrong number of arguments for '%s' command" % args[0].lower())
+        except ValueError:
+            return _error("ERR value is not an integer or out of range")
+        except _WrongType:
+            return _error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        finally:
+            self._command_calls[name] = self._command_calls.get(name, 0) + 1
+
+    ##########################################################################
+    # Keys
+    ##########################################################################
+
+    def _get(self, key, kind):
+        value = self._data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise _WrongType()
+        return value
+
+    def _get_or_create(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self._data[key] = kind()
+        return value
+
+    def _touch(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._condition.notify_all()
+
+    def _delete(self, key):
+        existed = self._data.pop(key, None) is not None
+        self._expiries.pop(key, None)
+        if existed:
+            self._touch(key)
+        return existed
+
+    def _drop_if_empty(self, key):
+        if not self._data.get(key):
+            self._delete(key)
+
+    def _expire(self):
+        now = time.time()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry, key = heapq.heappop(self._expiry_heap)
+            if self._expiries.get(key) != expiry:
+                continue  # stale entry, the expiry has since changed
+            self._delete(key)
+            self._notify_keyspace_event('x', 'expired', key)
+
+    def _notify_keyspace_event(self, event_class, event, key):
+        '''
+          Publish a keyspace notification, if notify-keyspace-events enables
+          it. Only generic (g) expire and expired (x) events are supported.
+        '''
+        events = self._config['notify-keyspace-events']
+        if event_class in events or 'A' in events:
+            if 'E' in events:
+                self._publish('__keyevent@0__:' + event, key)
+            if 'K' in events:
+                self._publish('__keyspace@0__:' + key, event)
+
+    def _expire_periodically(self):
+        while self._running:
+            time.sleep(0.1)
+            self.execute_for_client(self._direct_client, ['PING'])  # expires as a side effect
+
+    def _set_expiry(self, key, expiry):
+        self._expiries[key] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, key))
+
+    def _command_ping(self, unused_client):
+        return _Status('PONG')
+
+    def _command_echo(self, unused_client, message):
+        return message
+
+    def _command_select(self, unused_client, db):
+        return OK if db == '0' else _error("ERR invalid DB index")
+
+    def _command_config(self, unused_client, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == 'GET':
+            reply = []
+            for parameter, value in sorted(self._config.items()):
+                if fnmatch.fnmatchcase(parameter, args[0]):
+                    reply.extend([parameter, value])
+            return reply
+        if subcommand == 'SET':
+            parameter, value = args
+            self._config[parameter.lower()] = value
+            return OK
+        if subcommand == 'RESETSTAT':
+            self._command_calls = {}
+            return OK
+        return _error("ERR CONFIG subcommand must be one of GET, SET, RESETSTAT")
+
+    def _command_info(self, unused_client, section='default'):
+        lines = []
+        if section.lower() in ('default', 'all', 'server'):
+            lines.extend(['# Server', 'redis_version:2.8.0', 'redis_mode:fake'])
+        if section.lower() in ('all', 'commandstats'):
+            lines.append('# Commandstats')
+            lines.extend('cmdstat_%s:calls=%d,usec=0,usec_per_call=0.00' % (name.lower(), calls)
+                         for name, calls in sorted(self._command_calls.items()))
+        return '\r\n'.join(lines) + '\r\n'
+
+    def _command_dbsize(self, unused_client):
+        return len(self._data)
+
+    def _command_flushdb(self, unused_client):
+        for key in self._data.keys():
+            self._delete(key)
+        return OK
+
+    _command_flushall = _command_flushdb
+
+    def _command_del(self, unused_client, *keys):
+        if not keys:
+            raise TypeError()
+        return sum(1 for key in keys if self._delete(key))
+
+    def _command_exists(self, unused_client, key):
+        return int(key in self._data)
+
+    def _command_type(self, unused_client, key):
+        value = self._data.get(key)
+        for kind, name in [(str, 'string'), (set, 'set'), (dict, 'hash'), (list, 'list')]:
+            if isinstance(value, kind):
+                return _Status(name)
+        return _Status('none')
+
+    def _command_keys(self, unused_client, pattern):
+        return [key for key in self._data if fnmatch.fnmatchcase(key, pattern)]
+
+    def _command_scan(self, unused_client, cursor, *options):
+        pattern = '*'
+        count = 10
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == 'MATCH':
+                pattern = value
+            elif option.upper() == 'COUNT':
+                count = int(value)
+        keys = sorted(self._data)
+        start = int(cursor)
+        end = start + count
+        return [str(end) if end < len(keys) else '0',
+                [key for key in keys[start:end] if fnmatch.fnmatchcase(key, pattern)]]
+
+    def _command_expire(self, unused_client, key, seconds):
+        return self._command_pexpire(unused_client, key, int(seconds) * 1000)
+
+    def _command_pexpire(self, unused_client, key, milliseconds):
+        if key not in self._data:
+            return 0
+        self._set_expiry(key, time.time() + int(milliseconds) / 1000.0)
+        self._notify_keyspace_event('g', 'expire', key)
+        return 1
+
+    def _command_persist(self, unused_client, key):
+        return int(self._expiries.pop(key, None) is not None)
+
+    def _command_pttl(self, unused_client, key):
+        if key not in self._data:
+            return -2
+        if key not in self._expiries:
+            return -1
+        return max(0, int((self._expiries[key] - time.time()) * 1000))
+
+    def _command_ttl(self, unused_client, key):
+        ttl = self._command_pttl(unused_client, key)
+        return ttl if ttl < 0 else (ttl + 500) / 1000
+
+    ##########################################################################
+    # Strings
+    ##########################################################################
+
+    def _command_get(self, unused_client, key):
+        return self._get(key, str)
+
+    def _command_mget(self, unused_client, *keys):
+        if not keys:
+            raise TypeError()
+        return [value if isinstance(value, str) else None for value in [self._data.get(key) for key in keys]]
+
+    def _command_set(self, unused_client, key, value, *options):
+        expiry = None
+        for i in range(0, len(options), 2):
+            option = options[i].upper()
+            if option == 'EX':
+                expiry = time.time() + int(options[i + 1])
+            elif option == 'PX':
+                expiry = time.time() + int(options[i + 1]) / 1000.0
+            elif option == 'NX' or option == 'XX':
+                if (key in self._data) == (option == 'NX'):
+                    return None
+        self._data[key] = value
+        self._expiries.pop(key, None)
+        if expiry is not None:
+            self._set_expiry(key, expiry)
+        self._touch(key)
+        return OK
+
+    def _command_setex(self, client, key, seconds, value):
+        return self._command_set(client, key, value, 'EX', seconds)
+
+    def _command_setnx(self, client, key, value):
+        return int(self._command_set(client, key, value, 'NX') is not None)
+
+    def _command_mset(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError()
+        for key, value in zip(pairs[::2], pairs[1::2]):
+            self._command_set(client, key, value)
+        return OK
+
+    def _command_getset(self, client, key, value):
+        old_value = self._get(key, str)
+        self._command_set(client, key, value)
+        return old_value
+
+    def _command_incrby(self, unused_client, key, increment):
+        value = int(self._get(key, str) or 0) + int(increment)
+        self._data[key] = str(value)
+        self._touch(key)
+        return value
+
+    def _command_incr(self, client, key):
+        return self._command_incrby(client, key, 1)
+
+    def _command_decrby(self, client, key, decrement):
+        return self._command_incrby(client, key, -int(decrement))
+
+    def _command_decr(self, client, key):
+        return self._command_incrby(client, key, -1)
+
+    ##########################################################################
+    # Sets
+    ##########################################################################
+
+    def _command_sadd(self, unused_client, key, *members):
+        if not members:
+            raise TypeError()
+        values = self._get_or_create(key, set)
+        added = len(set(members) - values)
+        values.update(members)
+        self._touch(key)
+        return added
+
+    def _command_srem(self, unused_client, key, *members):
+        if not members:
+            raise TypeError()
+        values = self._get(key, set) or set()
+        removed = len(values & set(members))
+        values.difference_update(members)
+        if removed:
+            self._touch(key)
+            self._drop_if_empty(key)
+        return removed
+
+    def _command_smembers(self, unused_client, key):
+        return list(self._get(key, set) or [])
+
+    def _command_sismember(self, unused_client, key, member):
+        return int(member in (self._get(key, set) or set()))
+
+    def _command_scard(self, unused_client, key):
+        return len(self._get(key, set) or [])
+
+    ##########################################################################
+    # Hashes
+    ##########################################################################
+
+    def _command_hset(self, unused_client, key, field, value):
+        values = self._get_or_create(key, dict)
+        added = int(field not in values)
+        values[field] = value
+        self._touch(key)
+        return added
+
+    def _command_hsetnx(self, client, key, field, value):
+        if field in (self._get(key, dict) or {}):
+            return 0
+        return self._command_hset(client, key, field, value)
+
+    def _command_hmset(self, unused_client, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError()
+        self._get_or_create(key, dict).update(zip(pairs[::2], pairs[1::2]))
+        self._touch(key)
+        return OK
+
+    def _command_hget(self, unused_client, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def _command_hmget(self, unused_client, key, *fields):
+        if not fields:
+            raise TypeError()
+        values = self._get(key, dict) or {}
+        return [values.get(field) for field in fields]
+
+    def _command_hgetall(self, unused_client, key):
+        reply = []
+        for field, value in (self._get(key, dict) or {}).iteritems():
+            reply.extend([field, value])
+        return reply
+
+    def _command_hkeys(self, unused_client, key):
+        return list(self._get(key, dict) or [])
+
+    def _command_hvals(self, unused_client, key):
+        return list((self._get(key, dict) or {}).values())
+
+    def _command_hlen(self, unused_client, key):
+        return len(self._get(key, dict) or [])
+
+    def _command_hexists(self, unused_client, key, field):
+        return int(field in (self._get(key, dict) or {}))
+
+    def _command_hdel(self, unused_client, key, *fields):
+        if not fields:
+            raise TypeError()
+        values = self._get(key, dict) or {}
+        removed = sum(1 for field in fields if values.pop(field, None) is not None)
+        if removed:
+            self._touch(key)
+            self._drop_if_empty(key)
+        return removed
+
+    def _command_hincrby(self, unused_client, key, field, increment):
+        values = self._get_or_create(key, dict)
+        value = int(values.get(field, 0)) + int(increment)
+        values[field] = str(value)
+        self._touch(key)
+        return value
+
+    ##########################################################################
+    # Lists
+    ##########################################################################
+
+    def _command_rpush(self, unused_client, key, *values):
+        if not values:
+            raise TypeError()
+        items = self._get_or_create(key, list)
+        items.extend(values)
+        self._touch(key)
+        return len(items)
+
+    def _command_lpush(self, unused_client, key, *values):
+        if not values:
+            raise TypeError()
+        items = self._get_or_create(key, list)
+        items[0:0] = reversed(values)
+        self._touch(key)
+        return len(items)
+
+    def _command_lrange(self, unused_client, key, start, stop):
+        items = self._get(key, list) or []
+        start, stop = _list_range(len(items), start, stop)
+        return items[start:stop]
+
+    def _command_ltrim(self, unused_client, key, start, stop):
+        items = self._get(key, list)
+        if items is not None:
+            start, stop = _list_range(len(items), start, stop)
+            items[:] = items[start:stop]
+            self._touch(key)
+            self._drop_if_empty(key)
+        return OK
+
+    def _command_llen(self, unused_client, key):
+        return len(self._get(key, list) or [])
+
+    def _pop(self, key, index):
+        items = self._get(key, list)
+        if not items:
+            return None
+        value = items.pop(index)
+        self._touch(key)
+        self._drop_if_empty(key)
+        return value
+
+    def _command_lpop(self, unused_client, key):
+        return self._pop(key, 0)
+
+    def _command_rpop(self, unused_client, key):
+        return self._pop(key, -1)
+
+    def _command_blpop(self, unused_client, *args):
+        if len(args) < 2:
+            raise TypeError()
+        keys, timeout = args[:-1], int(args[-1])
+        deadline = time.time() + timeout if timeout else None
+        while self._running:
+            for key in keys:
+                value = self._pop(key, 0)
+                if value is not None:
+                    return [key, value]
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            self._condition.wait(min(0.1, remaining) if remaining is not None else 0.1)
+            self._expire()
+        return NIL_ARRAY
+
+    ##########################################################################
+    # Transactions
+    ##########################################################################
+
+    def _command_multi(self, client):
+        if client.multi is not None:
+            return _error("ERR MULTI calls can not be nested")
+        client.multi = []
+        return OK
+
+    def _command_exec(self, client):
+        if client.multi is None:
+            return _error("ERR EXEC without MULTI")
+        commands = client.multi
+        client.multi = None
+        watched = client.watched
+        client.watched = {}
+        if any(self._versions.get(key, 0) != version for key, version in watched.iteritems()):
+            return NIL_ARRAY
+        return [self._execute(client, args) for args in commands]
+
+    def _command_discard(self, client):
+        if client.multi is None:
+            return _error("ERR DISCARD without MULTI")
+        client.multi = None
+        client.watched = {}
+        return OK
+
+    def _command_watch(self, client, *keys):
+        if client.multi is not None:
+            return _error("ERR WATCH inside MULTI is not allowed")
+        for key in keys:
+            client.watched[key] = self._versions.get(key, 0)
+        return OK
+
+    def _command_unwatch(self, client):
+        client.watched = {}
+        return OK
+
+    ##########################################################################
+    # Pubsub
+    ##########################################################################
+
+    def _publish(self, channel, message):
+        receivers = 0
+        for client in self._subscriptions.get(channel, []):
+            self._deliveries.append((client, encode_reply(['message', channel, message])))
+            receivers += 1
+        for pattern, clients in self._pattern_subscriptions.iteritems():
+            if fnmatch.fnmatchcase(channel, pattern):
+                for client in clients:
+                    self._deliveries.append((client, encode_reply(['pmessage', pattern, channel, message])))
+                    receivers += 1
+        return receivers
+
+    def _command_publish(self, unused_client, channel, message):
+        return self._publish(channel, message)
+
+    def _subscribe(self, client, names, subscriptions, subscribed, kind):
+        replies = _MultipleReplies()
+        for name in names:
+            subscriptions.setdefault(name, set()).add(client)
+            subscribed.add(name)
+            replies.append([kind, name, len(client.channels) + len(client.patterns)])
+        return replies
+
+    def _unsubscribe(self, client, names, subscriptions, subscribed, kind):
+        replies = _MultipleReplies()
+        for name in (names or list(subscribed)):
+            clients = subscriptions.get(name, set())
+            clients.discard(client)
+            if not clients:
+                subscriptions.pop(name, None)
+            subscribed.discard(name)
+            replies.append([kind, name, len(client.channels) + len(client.patterns)])
+        return replies
+
+    def _command_subscribe(self, client, *channels):
+        if not channels:
+            raise TypeError()
+        return self._subscribe(client, channels, self._subscriptions, client.channels, 'subscribe')
+
+    def _command_unsubscribe(self, client, *channels):
+        return self._unsubscribe(client, channels, self._subscriptions, client.channels, 'unsubscribe')
+
+    def _command_psubscribe(self, client, *patterns):
+        if not patterns:
+            raise TypeError()
+        return self._subscribe(client, patterns, self._pattern_subscriptions, client.patterns, 'psubscribe')
+
+    def _command_punsubscribe(self, client, *patterns):
+        return self._unsubscribe(client, patterns, self._pattern_subscriptions, client.patterns, 'punsubscribe')
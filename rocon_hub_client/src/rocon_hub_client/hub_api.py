@@ -61,3 +61,64 @@ def key_base_name(key):
       e.g. rocon:key:pirate24 -> pirate24
     '''
     return key.split(':')[-1]
+
+###############################################################################
+# Schema
+###############################################################################
+
+# Layout of the gateway information stored on the hub. Hubs advertise the
+# version they use under rocon:hub:schema_version - hubs that don't are
+# running the legacy layout. Versions are cumulative, each includes all of
+# the changes of those before it.
+SCHEMA_LEGACY = 1  # one string key per gateway field, i.e. rocon:<gateway>:<field>
+SCHEMA_GATEWAY_INFO_HASH = 2  # gateway fields stored in a single hash, i.e. rocon:<gateway>:info
+SCHEMA_CHANGE_NOTIFICATIONS = 3  # every gateway publishes its changes on rocon:hub:changes
+SCHEMA_KEYED_FLIP_INS = 4  # flip requests stored in a hash keyed by (source, rule), i.e. rocon:<gateway>:flip_ins
+SCHEMA_COMPACT_WIRE_FORMAT = 5  # everything serialized in the compact wire format, no pickles
+SCHEMA_ADVERTISEMENT_VERSIONS = 6  # advertisement changes bump rocon:<gateway>:advertisements:version
+SCHEMA_VERSION = SCHEMA_ADVERTISEMENT_VERSIONS  # latest version understood by this client
+
+
+def create_change_notification(gateway, kind):
+    '''
+      Create the message published on the hub's change channel when one of a
+      gateway's data sets is modified, e.g. pirate24:advertisements.
+
+      @param gateway : gateway name (not the redis key)
+      @type str
+      @param kind : the modified data set (e.g. advertisements, flip_ins, registered)
+      @type str
+      @return the notification message
+      @rtype str
+    '''
+    return gateway + ':' + kind
+
+
+def parse_change_notification(message):
+    '''
+      Split a change notification into the gateway name and the kind of change.
+
+      @param message : the notification message
+      @type str
+      @return gateway name, kind of change
+      @rtype (str, str)
+    '''
+    gateway, unused_separator, kind = message.rpartition(':')
+    return gateway, kind
+
+
+def parse_schema_version(value):
+    '''
+      Convert the value stored under rocon:hub:schema_version into a
+      schema version this client can work with.
+
+      @param value : value retrieved from the hub, None if it was not set
+      @type str or None
+      @return the schema version to use with the hub
+      @rtype int
+    '''
+    try:
+        version = int(value)
+    except (TypeError, ValueError):
+        return SCHEMA_LEGACY
+    return max(SCHEMA_LEGACY, min(version, SCHEMA_VERSION))
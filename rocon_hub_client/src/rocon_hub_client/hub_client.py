@@ -7,6 +7,8 @@
 # Imports
 ###############################################################################
 
+import threading
+import time
 from urlparse import urlparse
 
 import rospy
@@ -14,6 +16,8 @@ import rocon_python_redis as redis
 import rocon_gateway_utils
 
 from . import hub_api
+from . import hub_engine
+from . import hub_statistics
 from .exceptions import HubNameNotFoundError, HubNotFoundError, \
                         HubConnectionBlacklistedError, HubConnectionNotWhitelistedError
 
@@ -42,24 +46,136 @@ class HubConnection(redis.Connection):
 ##############################################################################
 
 
+class HubHealthCheck(object):
+    '''
+      A dedicated, persistent connection for checking that a hub is alive,
+      rather than a new connection (and its handshake) for every check. The
+      connection has a socket timeout, so a hub that has dropped off the
+      network is noticed rather than waited on forever. It is re-established
+      whenever a check fails.
+    '''
+    def __init__(self, ip, port, connection_class=HubConnection):
+        '''
+          @param connection_class : redis connection class, e.g. to connect to a fake hub
+          @type redis.Connection subclass
+        '''
+        self.ip = ip
+        self.port = port
+        self._connection = connection_class(host=ip, port=port, socket_timeout=1.0)
+        self._connected = False  # whether the connection has been established (by a successful check)
+        self._lock = threading.Lock()  # checks may come from more than one thread
+
+    def check(self):
+        '''
+          Check the hub is there and identifies itself as a hub. A check that
+          fails on an established connection is retried once on a new connection,
+          so a stale connection (e.g. to a restarted hub) isn't mistaken for a dead hub.
+
+          @return round trip time of the check (seconds), or None if the hub isn't alive
+          @rtype float or None
+        '''
+        self._lock.acquire()
+        try:
+            for unused_attempt in range(2):
+                was_connected = self._connected
+                try:
+                    start_time = time.time()
+                    self._connection.send_command('GET', 'rocon:hub:name')
+                    name = self._connection.read_response()
+                    round_trip_time = time.time() - start_time
+                except (redis.exceptions.ConnectionError, redis.exceptions.ResponseError):
+                    self._connection.disconnect()  # reconnects on the next command
+                    self._connected = False
+                    if was_connected:
+                        continue
+                    return None
+                self._connected = True
+                # None if the server was there, but the key was not found.
+                return round_trip_time if name is not None else None
+            return None
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        self._connection.disconnect()
+        self._connected = False
+        self._lock.release()
+
+
 def ping_hub(ip, port):
     '''
-      Pings the hub for identification. This is currently used
-      by the hub discovery module.
+      Pings the hub for identification. For repeated checks, keep
+      a HubHealthCheck instead. Nothing in rocon_multimaster uses it any
+      more, it is kept (and exported) for packages outside it that may.
 
-      @return Bool, Latency
+      @return Bool
     '''
-    try:
-        connection_pool = redis.ConnectionPool(host=ip, port=port,
-                                               connection_class=HubConnection)
-        r = redis.Redis(connection_pool=connection_pool)
-        name = r.get("rocon:hub:name")
-
-    except redis.exceptions.ConnectionError:
-        return False
-    if name is None:  # returns None if the server was there, but the key was not found.
-        return False
-    return True
+    health_check = HubHealthCheck(ip, port)
+    alive = health_check.check() is not None
+    health_check.close()
+    return alive
+
+##############################################################################
+# Key Maintenance
+##############################################################################
+
+# Keys examined per SCAN call / deleted per DEL when clearing keys, small
+# enough that the hub keeps serving other clients in between.
+SCAN_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 100
+
+
+def scan_keys(redis_server, pattern):
+    '''
+      Iterate over the keys matching a pattern incrementally with SCAN, so
+      the server isn't blocked for the whole key space as it is with KEYS.
+      Falls back to KEYS on servers that predate SCAN (< 2.8).
+
+      @param redis_server : the redis server
+      @type redis.Redis
+      @param pattern : glob style pattern, e.g. rocon:*
+      @type str
+      @return generator of matching keys (a key may be returned more than once)
+    '''
+    cursor = '0'
+    while True:
+        try:
+            cursor, keys = redis_server.execute_command('SCAN', cursor, 'MATCH', pattern, 'COUNT', SCAN_BATCH_SIZE)
+        except redis.exceptions.ResponseError:
+            if cursor != '0':
+                raise
+            for key in redis_server.keys(pattern):  # unknown command
+                yield key
+            return
+        for key in keys:
+            yield key
+        if cursor == '0':
+            return
+
+
+def delete_keys(redis_server, keys):
+    '''
+      Delete keys in batches, each in its own round trip, so other clients are
+      served in between batches.
+
+      @param redis_server : the redis server
+      @type redis.Redis
+      @param keys : keys to delete
+      @type iterable of str
+      @return the number of keys deleted
+      @rtype int
+    '''
+    deleted = 0
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == DELETE_BATCH_SIZE:
+            deleted += redis_server.delete(*batch)
+            batch = []
+    if batch:
+        deleted += redis_server.delete(*batch)
+    return deleted
 
 ##############################################################################
 # Hub
@@ -68,7 +184,7 @@ def ping_hub(ip, port):
 
 class Hub(object):
 
-    def __init__(self, ip, port, whitelist=[], blacklist=[]):
+    def __init__(self, ip, port, whitelist=[], blacklist=[], connection_class=redis.Connection, engine=None):
         '''
           @param remote_gateway_request_callbacks : to handle redis responses
           @type list of function pointers (back to GatewaySync class
@@ -76,11 +192,18 @@ class Hub(object):
           @param ip : redis server ip
           @param port : redis server port
 
+          @param connection_class : redis connection class, e.g. fake_hub.FakeHubConnection
+          @type redis.Connection subclass
+          @param engine : if given, read only commands go through it (see _redis_reader), it
+                 connects with its own sockets so it can't be used with a fake hub
+          @type hub_engine.HubEngine
+
           @raise HubNameNotFoundError, HubNotFoundError
         '''
         # variables
         self.ip = ip
         self.port = port
+        self.connection_class = connection_class
         self.uri = str(ip) + ":" + str(port)
         self._redis_keys = {}
         self._redis_channels = {}
@@ -90,16 +213,26 @@ class Hub(object):
         # but that will need modification of the way we handle the RedisListenerThread in
         # gateway_hub.py
         try:
-            unused_ping = redis.Redis(host=ip, socket_timeout=0.5, port=port).ping()
+            unused_ping = redis.Redis(connection_pool=redis.ConnectionPool(
+                connection_class=connection_class, host=ip, port=port, socket_timeout=0.5)).ping()
             # should check ping result? Typically it just throws the timeout error
         except redis.exceptions.ConnectionError:
             self._redis_server = None
             raise HubNotFoundError("couldn't connect to the redis server")
         try:
-            self.pool = redis.ConnectionPool(host=ip, port=port, db=0)
-            self._redis_server = redis.Redis(connection_pool=self.pool)
+            self.pool = redis.ConnectionPool(connection_class=connection_class, host=ip, port=port, db=0)
+            self.statistics = hub_statistics.HubStatistics()
+            self._redis_server = hub_statistics.InstrumentedRedis(connection_pool=self.pool, statistics=self.statistics)
             self._redis_pubsub_server = self._redis_server.pubsub()
-            hub_key_name = self._redis_server.get("rocon:hub:name")
+            # for the read only commands, multiplexed with those for other hubs if there is an engine
+            if engine is None:
+                self._redis_reader = self._redis_server
+            else:
+                self._redis_reader = hub_engine.EngineRedis(engine, ip, port, statistics=self.statistics)
+            pipe = self._redis_server.pipeline()
+            pipe.get("rocon:hub:name")
+            pipe.get("rocon:hub:schema_version")
+            hub_key_name, schema_version = pipe.execute()
             # Be careful, hub_name is None, it means the redis server is
             # found but hub_name not yet set or not set at all.
             if not hub_key_name:
@@ -108,6 +241,7 @@ class Hub(object):
             else:
                 self.name = hub_api.key_base_name(hub_key_name)  # perhaps should store all key names somewhere central
                 rospy.logdebug("Gateway : resolved hub name [%s].", self.name)
+            self.schema_version = hub_api.parse_schema_version(schema_version)
         except redis.exceptions.ConnectionError:
             self._redis_server = None
             raise HubNotFoundError("couldn't connect to the redis server")
@@ -44,6 +44,7 @@ class HubDiscovery(threading.Thread):
         self.trigger_update = False
         self._direct_hub_uri_list = direct_hub_uri_list
         self._direct_discovered_hubs = []
+        self._direct_hub_health_checks = {}  # (hostname, port) : hub_client.HubHealthCheck
         self._zeroconf_services_available = False if disable_zeroconf else _zeroconf_services_available()
         self._blacklisted_hubs = blacklisted_hubs
         if self._zeroconf_services_available:
@@ -115,6 +116,8 @@ class HubDiscovery(threading.Thread):
             self._sleep()
         if self._zeroconf_services_available:
             self._list_discovered_services.close()
+        for health_check in self._direct_hub_health_checks.values():
+            health_check.close()
 
     def disengage_hub(self, hub):
         '''
@@ -161,7 +164,12 @@ class HubDiscovery(threading.Thread):
                 rospy.logerr("Gateway : Unable to parse direct hub uri [%s]" % uri)
                 remove_uris.append(uri)
                 continue
-            if hub_client.ping_hub(hostname, port):
+            try:
+                health_check = self._direct_hub_health_checks[(hostname, port)]
+            except KeyError:
+                health_check = hub_client.HubHealthCheck(hostname, port)
+                self._direct_hub_health_checks[(hostname, port)] = health_check
+            if health_check.check() is not None:
                 discovered_hubs.append(uri)
         difference = lambda l1, l2: [x for x in l1 if x not in l2]
         self._direct_hub_uri_list[:] = difference(self._direct_hub_uri_list,
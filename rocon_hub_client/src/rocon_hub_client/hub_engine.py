@@ -0,0 +1,544 @@
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+
+'''
+  An alternative to the synchronous (one blocking round trip at a time) redis
+  client for talking to hubs. A single thread multiplexes the connections to
+  all hubs with select(), commands are pipelined on each connection and every
+  command has its own timeout. Callers on any thread queue commands and get
+  a future back to wait on, so independent reads (on the same or different
+  hubs) are all in flight at the same time.
+
+  EngineRedis bridges it to the existing (threaded) callers - a redis client
+  whose commands and pipelines go through the engine, see Hub's engine
+  argument.
+'''
+
+###############################################################################
+# Imports
+###############################################################################
+
+import collections
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+import rocon_python_redis as redis
+
+from .hub_statistics import payload_size
+
+###############################################################################
+# Constants
+###############################################################################
+
+DEFAULT_COMMAND_TIMEOUT = 5.0  # seconds
+CONNECT_TIMEOUT = 1.0  # seconds
+RECEIVE_BUFFER_SIZE = 65536
+
+###############################################################################
+# Futures
+###############################################################################
+
+
+class HubCommandTimeoutError(redis.exceptions.ConnectionError):
+    pass
+
+
+class HubCommandFuture(object):
+    '''
+      The pending reply to a command queued on the engine. Only the engine
+      thread sets it, waiting is on the engine's condition (shared by all its
+      futures, cheaper than an event apiece).
+    '''
+
+    def __init__(self, args, timeout, condition):
+        self.args = args
+        self.deadline = time.time() + timeout
+        self._condition = condition
+        self._done = False
+        self._reply = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def set_reply(self, reply):
+        if not self._done:
+            self._reply = reply
+            self._done = True
+
+    def set_error(self, error):
+        if not self._done:
+            self._error = error
+            self._done = True
+
+    def result(self, timeout=None):
+        '''
+          Wait for the reply. The command's own timeout applies regardless, this
+          only limits how long this call waits for it.
+
+          @param timeout : maximum time to wait (seconds), None to wait for the command
+          @type float
+          @return the reply, decoded as by redis (str, int, list or None)
+
+          @raise HubCommandTimeoutError if the command timed out
+          @raise redis.exceptions.ConnectionError if the hub couldn't be reached
+          @raise redis.exceptions.ResponseError if redis replied with an error
+        '''
+        if not self._done:
+            deadline = None if timeout is None else time.time() + timeout
+            self._condition.acquire()
+            try:
+                while not self._done:
+                    if deadline is None:
+                        self._condition.wait()
+                    elif time.time() < deadline:
+                        self._condition.wait(deadline - time.time())
+                    else:
+                        raise HubCommandTimeoutError("timed out waiting for %s" % self.args[0])
+            finally:
+                self._condition.release()
+        if self._error is not None:
+            raise self._error
+        return self._reply
+
+###############################################################################
+# Replies
+###############################################################################
+
+
+class IncompleteReplyError(Exception):
+    pass
+
+
+def encode_command(args):
+    '''
+      Encode a command in the redis protocol (RESP).
+
+      @param args : command name and arguments
+      @type list
+      @rtype str
+    '''
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+def parse_reply(data, offset=0):
+    '''
+      Parse one reply from the data received from redis.
+
+      @param data : received data
+      @type str
+      @param offset : where the reply starts
+      @type int
+      @return the reply (errors as ResponseError instances) and the offset after it
+      @rtype (object, int)
+
+      @raise IncompleteReplyError if the data doesn't hold the whole reply yet
+    '''
+    end = data.find('\r\n', offset)
+    if end == -1:
+        raise IncompleteReplyError()
+    kind = data[offset]
+    line = data[offset + 1:end]
+    offset = end + 2
+    if kind == '+':
+        return line, offset
+    if kind == '-':
+        return redis.exceptions.ResponseError(line), offset
+    if kind == ':':
+        return int(line), offset
+    if kind == '$':
+        length = int(line)
+        if length == -1:
+            return None, offset
+        if len(data) < offset + length + 2:
+            raise IncompleteReplyError()
+        return data[offset:offset + length], offset + length + 2
+    if kind == '*':
+        length = int(line)
+        if length == -1:
+            return None, offset
+        replies = []
+        for unused_i in range(length):
+            reply, offset = parse_reply(data, offset)
+            replies.append(reply)
+        return replies, offset
+    raise redis.exceptions.InvalidResponse("protocol error, unknown reply type [%r]" % kind)
+
+###############################################################################
+# Connections
+###############################################################################
+
+
+class _EngineConnection(object):
+    '''
+      A non blocking connection to one hub, only ever used from the engine thread.
+    '''
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.sock = None
+        self.connecting = False
+        self.outgoing = []  # encoded commands not yet written
+        self.unsent = ''  # partially written data
+        self.incoming = ''
+        self.waiting = collections.deque()  # futures, in the order their replies will arrive
+        self.connect_deadline = None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.connecting = True
+        self.connect_deadline = time.time() + CONNECT_TIMEOUT
+        error = self.sock.connect_ex((self.ip, self.port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+
+    def wants_to_write(self):
+        return self.connecting or bool(self.unsent or self.outgoing)
+
+    def fail(self, error):
+        '''
+          Close the connection and fail everything pending on it. The next command
+          queued reconnects.
+        '''
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.connecting = False
+        self.unsent = ''
+        self.incoming = ''
+        self.outgoing = []
+        while self.waiting:
+            self.waiting.popleft().set_error(error)
+
+    def handle_write(self):
+        if self.connecting:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self.connecting = False
+        if not self.unsent:
+            self.unsent = ''.join(self.outgoing)  # pipelined
+            self.outgoing = []
+        if self.unsent:
+            sent = self.sock.send(self.unsent)
+            self.unsent = self.unsent[sent:]
+
+    def handle_read(self):
+        data = self.sock.recv(RECEIVE_BUFFER_SIZE)
+        if not data:
+            raise socket.error(errno.ECONNRESET, "connection closed by the hub")
+        self.incoming += data
+        offset = 0
+        while self.waiting:
+            try:
+                reply, offset = parse_reply(self.incoming, offset)
+            except IncompleteReplyError:
+                break
+            future = self.waiting.popleft()
+            if isinstance(reply, redis.exceptions.ResponseError):
+                future.set_error(reply)
+            else:
+                future.set_reply(reply)  # ignored if the command already timed out
+        self.incoming = self.incoming[offset:]
+
+###############################################################################
+# Engine
+###############################################################################
+
+
+class HubEngine(threading.Thread):
+    '''
+      Multiplexes commands to any number of hubs on a single thread. Thread
+      safe, queue commands from anywhere with execute (blocking) or submit and
+      submit_many (return futures).
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='hub_engine')
+        self.daemon = True
+        self._lock = threading.Lock()
+        self._done_condition = threading.Condition()
+        self._submitted = []  # (uri, future, encoded command) not yet picked up by the engine thread
+        self._connections = {}  # (ip, port) : _EngineConnection
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._shutdown = False
+
+    def submit(self, ip, port, *args, **kwargs):
+        '''
+          Queue a command for a hub.
+
+          @param ip, port : the hub's redis server
+          @param args : command name and arguments, e.g. 'GET', 'rocon:hub:name'
+          @param timeout : seconds before the command fails (keyword only)
+          @type float
+          @return the pending reply
+          @rtype HubCommandFuture
+        '''
+        return self.submit_many([(ip, port, args)], **kwargs)[0]
+
+    def submit_many(self, commands, **kwargs):
+        '''
+          Queue a batch of commands in one go, cheaper than queueing them one by one.
+
+          @param commands : (ip, port, args) for each command
+          @type list
+          @param timeout : seconds before each command fails (keyword only)
+          @type float
+          @return the pending replies, in the same order
+          @rtype HubCommandFuture[]
+
+          @raise redis.exceptions.ConnectionError if the engine has been shut down
+        '''
+        if self._shutdown:
+            raise redis.exceptions.ConnectionError("hub engine shut down")
+        timeout = kwargs.get('timeout', DEFAULT_COMMAND_TIMEOUT)
+        submitted = []
+        for ip, port, args in commands:
+            submitted.append(((ip, port), HubCommandFuture(args, timeout, self._done_condition), encode_command(args)))
+        self._lock.acquire()
+        wakeup = not self._submitted  # otherwise the engine has been woken already
+        self._submitted.extend(submitted)
+        self._lock.release()
+        if wakeup:
+            self._wakeup()
+        return [future for unused_address, future, unused_command in submitted]
+
+    def execute(self, ip, port, *args, **kwargs):
+        '''
+          Run a command on a hub and wait for the reply (see HubCommandFuture.result).
+        '''
+        return self.submit(ip, port, *args, **kwargs).result()
+
+    def shutdown(self):
+        '''
+          Stop the engine, failing whatever is still pending.
+        '''
+        if self._shutdown:
+            return
+        self._shutdown = True
+        self._wakeup()
+        if self.is_alive():
+            self.join()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def _wakeup(self):
+        os.write(self._wakeup_write, 'x')
+
+    def run(self):
+        while not self._shutdown:
+            self._pick_up_submitted()
+            connections = [c for c in self._connections.values() if c.sock is not None]
+            # always watch idle connections too, to notice the hub closing them
+            readers = [self._wakeup_read] + [c.sock for c in connections if not c.connecting]
+            writers = [c.sock for c in connections if c.wants_to_write()]
+            try:
+                readable, writable, unused_errors = select.select(readers, writers, [], self._select_timeout())
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wakeup_read in readable:
+                os.read(self._wakeup_read, 4096)
+            for connection in connections:
+                try:
+                    if connection.sock in writable:
+                        connection.handle_write()
+                    if connection.sock in readable:
+                        connection.handle_read()
+                except socket.error as e:
+                    connection.fail(redis.exceptions.ConnectionError(
+                        "lost connection to the hub [%s:%s][%s]" % (connection.ip, connection.port, str(e))))
+            self._expire()
+            self._notify_done()
+        error = redis.exceptions.ConnectionError("hub engine shut down")
+        self._lock.acquire()
+        for unused_address, future, unused_command in self._submitted:
+            future.set_error(error)
+        self._submitted = []
+        self._lock.release()
+        for connection in self._connections.values():
+            connection.fail(error)
+        self._notify_done()
+
+    def _pick_up_submitted(self):
+        self._lock.acquire()
+        submitted = self._submitted
+        self._submitted = []
+        self._lock.release()
+        for address, future, command in submitted:
+            connection = self._connections.get(address)
+            if connection is None:
+                connection = _EngineConnection(*address)
+                self._connections[address] = connection
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except socket.error as e:
+                    connection.fail(None)
+                    future.set_error(redis.exceptions.ConnectionError(
+                        "couldn't connect to the hub [%s:%s][%s]" % (address[0], address[1], str(e))))
+                    continue
+            connection.outgoing.append(command)
+            connection.waiting.append(future)
+
+    def _notify_done(self):
+        self._done_condition.acquire()
+        self._done_condition.notify_all()
+        self._done_condition.release()
+
+    def _select_timeout(self):
+        deadlines = [future.deadline for connection in self._connections.values()
+                     for future in connection.waiting if not future.done()]
+        deadlines.extend(connection.connect_deadline for connection in self._connections.values()
+                         if connection.connecting)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def _expire(self):
+        '''
+          Fail the commands that have timed out. Their replies are still read
+          (and dropped) when they arrive, to keep the rest in step.
+        '''
+        now = time.time()
+        for connection in self._connections.values():
+            if connection.connecting and now > connection.connect_deadline:
+                connection.fail(HubCommandTimeoutError(
+                    "timed out connecting to the hub [%s:%s]" % (connection.ip, connection.port)))
+                continue
+            for future in connection.waiting:
+                if now > future.deadline:
+                    future.set_error(HubCommandTimeoutError("timed out waiting for %s" % future.args[0]))
+
+###############################################################################
+# Redis Client
+###############################################################################
+
+
+class EngineRedis(redis.Redis):
+    '''
+      A redis client for one hub that sends its commands through a HubEngine,
+      safe to use from any thread. Replies are parsed as by redis.Redis, so it
+      can stand in for it - except for pubsub, blocking commands (e.g. BLPOP,
+      they would hold up everything behind them on the connection) and WATCH.
+    '''
+
+    def __init__(self, engine, ip, port, timeout=DEFAULT_COMMAND_TIMEOUT, statistics=None):
+        '''
+          @param engine : a running engine, shared with the clients for other hubs
+          @type HubEngine
+          @param ip, port : the hub's redis server
+          @param timeout : seconds before a command (or pipeline) fails
+          @type float
+          @param statistics : where to record the commands sent, if anywhere
+          @type hub_statistics.HubStatistics
+        '''
+        redis.Redis.__init__(self, host=ip, port=port)  # its connection pool is never used
+        self.engine = engine
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.statistics = statistics
+
+    def execute_command(self, *args, **options):
+        start_time = time.time()
+        try:
+            reply = self.engine.submit(self.ip, self.port, *args, timeout=self.timeout).result()
+        except redis.exceptions.RedisError:
+            if self.statistics is not None:
+                self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), 0, error=True)
+            raise
+        if self.statistics is not None:
+            self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), payload_size(reply))
+        if args[0] in self.response_callbacks:
+            return self.response_callbacks[args[0]](reply, **options)
+        return reply
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return EnginePipeline(self, transaction)
+
+    def pubsub(self, shard_hint=None):
+        raise redis.exceptions.RedisError("pubsub isn't supported through the hub engine")
+
+
+class EnginePipeline(redis.client.Pipeline):
+    '''
+      Queues commands like redis' pipeline, sending them all in one go through
+      the engine on execute. Transactions are wrapped in MULTI/EXEC, which the
+      engine keeps together on the connection.
+    '''
+
+    def __init__(self, client, transaction):
+        redis.client.Pipeline.__init__(self, client.connection_pool, client.response_callbacks, transaction, None)
+        self._client = client
+
+    def immediate_execute_command(self, *args, **options):
+        raise redis.exceptions.RedisError("WATCH isn't supported through the hub engine")
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        if not stack:
+            return []
+        transaction = self.transaction or self.explicit_transaction
+        commands = [args for args, unused_options in stack]
+        if transaction:
+            commands = [('MULTI',)] + commands + [('EXEC',)]
+        client = self._client
+        start_time = time.time()
+        try:
+            futures = client.engine.submit_many([(client.ip, client.port, args) for args in commands],
+                                                timeout=client.timeout)
+            replies = []
+            for future in futures:
+                try:
+                    replies.append(future.result())
+                except redis.exceptions.ResponseError as e:
+                    replies.append(e)
+            if transaction:
+                queued_errors = [r for r in replies[1:-1] if isinstance(r, redis.exceptions.ResponseError)]
+                if isinstance(replies[-1], redis.exceptions.ResponseError):
+                    raise queued_errors[0] if queued_errors else replies[-1]
+                replies = replies[-1]
+                if replies is None:
+                    raise redis.exceptions.WatchError("Watched variable changed.")
+                if len(replies) != len(stack):
+                    raise redis.exceptions.ResponseError("Wrong number of response items from pipeline execution")
+            if raise_on_error:
+                self.raise_first_error(replies)
+        except redis.exceptions.RedisError:
+            if client.statistics is not None:
+                client.statistics.record('PIPELINE', time.time() - start_time, 0, 0, error=True)
+            raise
+        finally:
+            self.reset()
+        if client.statistics is not None:
+            client.statistics.record('PIPELINE', time.time() - start_time, 0, 0)
+        responses = []
+        for (args, options), reply in zip(stack, replies):
+            if client.statistics is not None:
+                client.statistics.record(args[0], None, payload_size(args[1:]), payload_size(reply),
+                                         error=isinstance(reply, redis.exceptions.ResponseError))
+            if not isinstance(reply, Exception) and args[0] in self.response_callbacks:
+                reply = self.response_callbacks[args[0]](reply, **options)
+            responses.append(reply)
+        return responses
@@ -0,0 +1,202 @@
+#
+# License: BSD
+#   https://raw.github.com/robotics-in-concert/rocon_multimaster/license/LICENSE
+#
+
+'''
+  Per command statistics (calls, errors, payload bytes and a latency histogram)
+  for the commands a gateway sends to a hub. Cheap enough to leave on - a
+  couple of timestamps, a bisect and a lock per command.
+'''
+
+###############################################################################
+# Imports
+###############################################################################
+
+import bisect
+import threading
+import time
+
+import rocon_python_redis as redis
+
+###############################################################################
+# Statistics
+###############################################################################
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket
+# catches everything slower.
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+
+def payload_size(value):
+    '''
+      Rough size of a command's arguments or reply - the bytes in its strings,
+      ignoring the protocol framing.
+
+      @param value : arguments or (parsed) reply
+      @rtype int
+    '''
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum([len(v) if isinstance(v, basestring) else payload_size(v) for v in value])
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.iteritems())
+    if value is None or isinstance(value, bool):
+        return 0
+    return len(str(value))
+
+
+class _CommandStatistics(object):
+
+    __slots__ = ['calls', 'pipelined', 'errors', 'bytes_sent', 'bytes_received',
+                 'total_latency', 'max_latency', 'latency_histogram']
+
+    def __init__(self):
+        self.calls = 0
+        self.pipelined = 0  # calls that were part of a pipeline (no latency of their own)
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+class HubStatistics(object):
+    '''
+      Thread safe statistics for the commands sent to one hub, keyed by command
+      name. Whole pipelines are timed under the name 'PIPELINE', the commands in
+      them are counted under their own names.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._since = time.time()
+
+    def record(self, command, latency, bytes_sent, bytes_received, error=False):
+        '''
+          @param command : command name, e.g. 'GET'
+          @type str
+          @param latency : seconds, or None for commands sent in a pipeline
+          @type float
+          @param bytes_sent, bytes_received : payload sizes
+          @type int
+          @param error : whether it failed
+          @type bool
+        '''
+        self._lock.acquire()
+        statistics = self._commands.get(command)
+        if statistics is None:
+            statistics = self._commands[command] = _CommandStatistics()
+        statistics.calls += 1
+        statistics.bytes_sent += bytes_sent
+        statistics.bytes_received += bytes_received
+        if error:
+            statistics.errors += 1
+        if latency is None:
+            statistics.pipelined += 1
+        else:
+            statistics.total_latency += latency
+            statistics.max_latency = max(statistics.max_latency, latency)
+            statistics.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        self._commands = {}
+        self._since = time.time()
+        self._lock.release()
+
+    def snapshot(self):
+        '''
+          @return the statistics so far, as plain types (ready for yaml)
+          @rtype dict
+        '''
+        self._lock.acquire()
+        try:
+            commands = {}
+            for name, statistics in self._commands.iteritems():
+                timed_calls = statistics.calls - statistics.pipelined
+                commands[name] = {
+                    'calls': statistics.calls,
+                    'pipelined': statistics.pipelined,
+                    'errors': statistics.errors,
+                    'bytes_sent': statistics.bytes_sent,
+                    'bytes_received': statistics.bytes_received,
+                    'mean_latency': statistics.total_latency / timed_calls if timed_calls else 0.0,
+                    'max_latency': statistics.max_latency,
+                    'latency_histogram': list(statistics.latency_histogram),
+                }
+            return {'since': self._since,
+                    'period': time.time() - self._since,
+                    'latency_buckets': LATENCY_BUCKETS,  # upper bounds of all but the last histogram bucket
+                    'commands': commands}
+        finally:
+            self._lock.release()
+
+###############################################################################
+# Instrumented Client
+###############################################################################
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+    statistics = None  # set by InstrumentedRedis.pipeline
+
+    def immediate_execute_command(self, *args, **options):
+        start_time = time.time()
+        try:
+            response = redis.client.Pipeline.immediate_execute_command(self, *args, **options)
+        except redis.exceptions.RedisError:
+            self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), 0, error=True)
+            raise
+        self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), payload_size(response))
+        return response
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        start_time = time.time()
+        try:
+            responses = redis.client.Pipeline.execute(self, raise_on_error)
+        except redis.exceptions.RedisError:
+            self.statistics.record('PIPELINE', time.time() - start_time, 0, 0, error=True)
+            raise
+        self.statistics.record('PIPELINE', time.time() - start_time, 0, 0)
+        for (args, unused_options), response in zip(stack, responses):
+            self.statistics.record(args[0], None, payload_size(args[1:]), payload_size(response),
+                                   error=isinstance(response, redis.exceptions.ResponseError))
+        return responses
+
+
+class InstrumentedRedis(redis.Redis):
+    '''
+      A redis client that records statistics for every command (and pipeline)
+      it sends. Pubsub traffic isn't recorded.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        '''
+          @param statistics : where to record, a new HubStatistics if not given (keyword only)
+          @type HubStatistics
+
+          Otherwise as for redis.Redis.
+        '''
+        self.statistics = kwargs.pop('statistics', None) or HubStatistics()
+        redis.Redis.__init__(self, *args, **kwargs)
+
+    def execute_command(self, *args, **options):
+        start_time = time.time()
+        try:
+            response = redis.Redis.execute_command(self, *args, **options)
+        except redis.exceptions.RedisError:
+            self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), 0, error=True)
+            raise
+        self.statistics.record(args[0], time.time() - start_time, payload_size(args[1:]), payload_size(response))
+        return response
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.statistics = self.statistics
+        return pipe